@@ -1,5 +1,8 @@
 import os
 import sys
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 
 # Add project root to python path to allow running directly
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -9,9 +12,32 @@ if PROJECT_ROOT not in sys.path:
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from api.routes import router
+from fastapi.responses import PlainTextResponse
+from api.routes import router, search_executor
+from services.config import WARMUP_ON_STARTUP, RAW_IMAGES_DIR
+from services import metrics
+from query.search_service import warm_up, get_result_cache
+from embedding.clip_model import get_model_manager
+from vector_index.search import get_searcher
 
-app = FastAPI(title="HerSafe Space Backend API")
+logger = logging.getLogger("api")
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Load and warm up the CLIP model, FAISS index and metadata before accepting requests,
+    so no user pays the cold-start cost. The server does not take traffic until this finishes;
+    /ready reports the state and timing breakdown.
+    """
+    if WARMUP_ON_STARTUP:
+        try:
+            await asyncio.to_thread(warm_up)
+        except Exception as e:
+            # Stay up so /ready can report the failure; searches retry the lazy load
+            logger.error(f"Startup warm-up failed: {e}")
+    yield
+
+app = FastAPI(title="HerSafe Space Backend API", lifespan=lifespan)
 
 # Add CORS so React dev server can talk to backend
 app.add_middleware(
@@ -25,8 +51,30 @@ app.add_middleware(
 # Include the endpoints
 app.include_router(router)
 
+# Gauges are read at scrape time, so they cost nothing on the request path
+metrics.gauge("index_vectors", "Vectors in the live FAISS index (all shards).",
+              lambda: get_searcher().info()[0])
+metrics.gauge("search_queue_depth", "Searches admitted but waiting for a worker.",
+              lambda: search_executor.stats()["queue_depth"])
+metrics.gauge("search_running", "Searches currently running.",
+              lambda: search_executor.stats()["running"])
+metrics.gauge("model_load_seconds", "Time taken to load the CLIP model.",
+              lambda: get_model_manager().timings.get("model_load_s"))
+metrics.gauge("model_warmup_seconds", "Time taken by the CLIP warm-up forward pass.",
+              lambda: get_model_manager().timings.get("warmup_s"))
+metrics.gauge("result_cache_entries", "Responses held by the search result cache.",
+              lambda: get_result_cache().stats()["entries"])
+metrics.gauge("result_cache_bytes", "Estimated memory used by the search result cache.",
+              lambda: get_result_cache().bytes)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """
+    Per-stage latency histograms and service gauges in Prometheus text format.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Serve matched images as static files so the frontend can display them
-RAW_IMAGES_DIR = os.path.join(PROJECT_ROOT, 'data', 'raw_images')
 if os.path.exists(RAW_IMAGES_DIR):
     app.mount("/matched-images", StaticFiles(directory=RAW_IMAGES_DIR), name="matched-images")
 
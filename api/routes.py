@@ -1,34 +1,88 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from services.pipeline_runner import run_indexing_pipeline
-from query.search_service import search_image
-from PIL import Image
+from typing import List
+from fastapi import APIRouter, UploadFile, File, HTTPException, Body, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from services.pipeline_runner import run_indexing_pipeline, run_compaction_pipeline
+from services.jobs import get_job_manager, JobAlreadyRunningError
+from services.tombstones import tombstone_images, tombstone_ratio
+from services.config import (SEARCH_WORKERS, SEARCH_QUEUE_SIZE, PREPROCESS_MIN_SIDE, BULK_MAX_IMAGES,
+                             BULK_BATCH_SIZE, BULK_MAX_FILE_BYTES, TOMBSTONE_COMPACT_RATIO)
+from query.search_service import search_image, search_batch, readiness, get_result_cache
+from services.metadata_service import get_metadata_store
+from api.utils import BoundedExecutor, QueueFullError, read_archive
+from embedding.preprocess import open_image
+from services.metrics import SEARCH_STAGE_SECONDS
 import io
+import json
+import asyncio
 
 router = APIRouter()
 
+# Dedicated pool for CPU-bound search work, with a bounded admission queue
+search_executor = BoundedExecutor(SEARCH_WORKERS, SEARCH_QUEUE_SIZE, name="search")
+
 @router.post("/start-pipeline")
 def start_pipeline():
     """
-    API Endpoint to manually trigger the embedding generation and FAISS indexing
-    pipeline for unindexed raw images.
+    API Endpoint to trigger the embedding generation and FAISS indexing pipeline for
+    unindexed raw images. The pipeline runs as a background job; poll /jobs/{job_id}
+    for progress. Only one indexing job can run at a time.
     """
     try:
-        run_indexing_pipeline()
-        return {
-            "status": "Pipeline started successfully"
-        }
-    except Exception as e:
-        return {
-            "status": "Pipeline failed",
-            "error": str(e)
+        job = get_job_manager().start("indexing", run_indexing_pipeline)
+    except JobAlreadyRunningError as e:
+        return JSONResponse(
+            status_code=409,
+            content={
+                "status": "Pipeline already running",
+                "job_id": e.job.id,
+                "job": e.job.to_dict()
+            }
+        )
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "Pipeline started successfully",
+            "job_id": job.id,
+            "job": job.to_dict()
         }
+    )
+
+@router.get("/jobs")
+def list_jobs():
+    """
+    Recent background jobs, newest first.
+    """
+    return {"jobs": [job.to_dict() for job in get_job_manager().list()]}
+
+@router.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    """
+    Status and progress (indexed / failed / pending counts) of a background job.
+    """
+    job = get_job_manager().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    """
+    Requests cancellation; the job stops once the chunks already in flight are committed.
+    """
+    job = get_job_manager().cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 @router.post("/search-image")
-async def search_image_endpoint(file: UploadFile = File(...)):
+async def search_image_endpoint(file: UploadFile = File(...), robust: bool = False,
+                                platform: List[str] = Query(None)):
     """
     API Endpoint to accept an image upload, process it completely in-memory, 
     search the FAISS index, and return SAFE or FOUND along with metadata.
     Does NOT store the image permanently.
+    ?robust=true also searches crops and flips of the upload (slower, catches edited reposts).
+    ?platform=reddit&platform=twitter only returns sources on those platforms.
     """
     if not file.content_type.startswith("image/"):
         return {
@@ -38,15 +92,175 @@ async def search_image_endpoint(file: UploadFile = File(...)):
         
     try:
         # Read file bytes in memory
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
+        with SEARCH_STAGE_SECONDS.time("upload_read"):
+            contents = await file.read()
+        # Header-only open: rejects decompression bombs and lets JPEGs decode at reduced
+        # scale for both the hash fast path and CLIP preprocessing
+        image = open_image(io.BytesIO(contents), min_side=PREPROCESS_MIN_SIDE)
         
-        # Perform search
-        result = search_image(image, threshold=0.78)
+        # Perform search on the search executor so the event loop stays free
+        # and concurrent uploads can be micro-batched
+        result = await search_executor.run(search_image, image, threshold=0.78, image_bytes=contents,
+                                           robust=robust, platforms=platform)
         return result
         
+    except QueueFullError:
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": "1"},
+            content={
+                "status": "BUSY",
+                "message": "Search queue is full. Please retry shortly."
+            }
+        )
     except Exception as e:
         return {
             "status": "ERROR",
             "message": f"Search failed: {str(e)}"
         }
+
+async def _submit_when_admitted(fn, *args):
+    """
+    Submits to the search executor, waiting for a free slot instead of failing, for
+    batches after the first of an already accepted bulk request.
+    """
+    while True:
+        try:
+            return search_executor.submit(fn, *args)
+        except QueueFullError:
+            await asyncio.sleep(0.05)
+
+@router.post("/search-images")
+async def search_images_endpoint(files: List[UploadFile] = File(...), platform: List[str] = Query(None)):
+    """
+    Bulk search: accepts several image files and/or zip archives of images and streams one
+    NDJSON line per image ({"name": ..., "status": SAFE/FOUND/ERROR, ...}) as each batch
+    finishes. Each batch is decoded in parallel, embedded in one forward pass and searched
+    with one matrix FAISS search on the search executor.
+    ?platform=... filters sources exactly like /search-image.
+    """
+    # 1. Collect (name, bytes) for every image, expanding archives
+    items = []
+    try:
+        for upload in files:
+            with SEARCH_STAGE_SECONDS.time("upload_read"):
+                contents = await upload.read()
+            name = upload.filename or f"file_{len(items)}"
+            if name.lower().endswith(".zip") or upload.content_type in ("application/zip", "application/x-zip-compressed"):
+                items.extend(await asyncio.to_thread(
+                    read_archive, contents, BULK_MAX_IMAGES - len(items), BULK_MAX_FILE_BYTES
+                ))
+            elif upload.content_type and upload.content_type.startswith("image/"):
+                if len(contents) > BULK_MAX_FILE_BYTES:
+                    raise ValueError(f"{name} is larger than {BULK_MAX_FILE_BYTES} bytes")
+                items.append((name, contents))
+            else:
+                raise ValueError(f"{name}: invalid file type. Must be an image or a zip archive.")
+            if len(items) > BULK_MAX_IMAGES:
+                raise ValueError(f"At most {BULK_MAX_IMAGES} images per request")
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"status": "ERROR", "message": f"Search failed: {str(e)}"})
+    
+    if not items:
+        return JSONResponse(status_code=400, content={"status": "ERROR", "message": "Search failed: No images found."})
+    
+    batches = [items[i:i + BULK_BATCH_SIZE] for i in range(0, len(items), BULK_BATCH_SIZE)]
+    
+    # 2. Admission is decided by the first batch, before the response starts
+    try:
+        first = search_executor.submit(search_batch, batches[0], 0.78, platform)
+    except QueueFullError:
+        return JSONResponse(
+            status_code=503,
+            headers={"Retry-After": "1"},
+            content={
+                "status": "BUSY",
+                "message": "Search queue is full. Please retry shortly."
+            }
+        )
+    
+    async def stream():
+        future = first
+        for b, batch in enumerate(batches):
+            try:
+                results = await asyncio.wrap_future(future)
+            except Exception as e:
+                results = [{"name": name, "status": "ERROR", "message": f"Search failed: {str(e)}"}
+                           for name, _ in batch]
+            # Queue the next batch before writing this one out
+            if b + 1 < len(batches):
+                future = await _submit_when_admitted(search_batch, batches[b + 1], 0.78, platform)
+            yield "".join(json.dumps(result) + "\n" for result in results)
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def _maybe_compact():
+    """
+    Starts a background compaction once the tombstone ratio reaches TOMBSTONE_COMPACT_RATIO.
+    Returns the id of the started (or already running) compaction job, or None.
+    """
+    if tombstone_ratio() < TOMBSTONE_COMPACT_RATIO:
+        return None
+    try:
+        return get_job_manager().start("compaction", run_compaction_pipeline).id
+    except JobAlreadyRunningError as e:
+        return e.job.id
+
+def _delete(image_ids):
+    deleted = tombstone_images(image_ids)
+    return {
+        "status": "deleted",
+        "deleted_ids": deleted,
+        "compaction_job_id": _maybe_compact() if deleted else None
+    }
+
+@router.delete("/images/{image_id}")
+def delete_image(image_id: int):
+    """
+    Takedown of one image (and its collapsed near-duplicates). It disappears from search
+    results immediately; a background compaction later removes the vector, file and row.
+    """
+    result = _delete([image_id])
+    if not result["deleted_ids"]:
+        raise HTTPException(status_code=404, detail="Image not found or already deleted")
+    return result
+
+@router.post("/images/delete")
+def delete_images(image_ids: List[int] = Body(..., embed=True)):
+    """
+    Bulk takedown: {"image_ids": [...]}. Unknown or already deleted ids are ignored.
+    """
+    return _delete(image_ids)
+
+@router.get("/platforms")
+def platforms_endpoint():
+    """
+    Number of (non-deleted) images per source platform, aggregated in SQL.
+    """
+    return {"platforms": get_metadata_store().platform_counts()}
+
+@router.get("/status")
+def status():
+    """
+    Health check exposing the current search queue depth and result cache counters.
+    """
+    return {
+        "status": "ok",
+        "search_queue": search_executor.stats(),
+        "result_cache": get_result_cache().stats()
+    }
+
+@router.get("/ready")
+def ready():
+    """
+    Readiness probe: 200 once the model, index and metadata are loaded and warmed up,
+    503 before that (or if warm-up failed). Includes the startup time breakdown.
+    """
+    is_ready, report = readiness()
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={
+            "status": "ready" if is_ready else "not_ready",
+            "startup": report
+        }
+    )
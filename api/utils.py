@@ -0,0 +1,100 @@
+import os
+import io
+import asyncio
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a BoundedExecutor has no free admission slot.
+    """
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a bounded admission queue, used to keep CPU-bound work
+    (CLIP inference, FAISS search, sqlite lookups) off the event loop.
+
+    At most `max_workers` tasks run at once and at most `max_queue` more wait
+    for a worker. Submitting beyond that raises QueueFullError immediately, so
+    the API can shed load instead of letting latency grow without limit.
+    """
+    def __init__(self, max_workers, max_queue, name="worker"):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._running = 0
+
+    def _wrap(self, fn, args, kwargs):
+        with self._lock:
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._admitted -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Admits a task or raises QueueFullError if workers and queue are all taken.
+        Returns a concurrent.futures.Future.
+        """
+        with self._lock:
+            if self._admitted >= self.max_workers + self.max_queue:
+                raise QueueFullError(f"{self._admitted} tasks already admitted")
+            self._admitted += 1
+        try:
+            return self._pool.submit(self._wrap, fn, args, kwargs)
+        except Exception:
+            with self._lock:
+                self._admitted -= 1
+            raise
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Awaitable wrapper around submit() for use inside async endpoints.
+        """
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def stats(self):
+        """
+        Snapshot of current load: tasks running, tasks waiting (queue depth) and capacity.
+        """
+        with self._lock:
+            return {
+                "running": self._running,
+                "queue_depth": self._admitted - self._running,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue
+            }
+
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+
+
+def read_archive(data, max_files, max_file_bytes):
+    """
+    Returns [(name, bytes), ...] for the image members of a zip archive, in archive order.
+    Sizes are checked from the central directory before anything is decompressed, so an
+    archive cannot expand beyond max_files * max_file_bytes.
+    """
+    items = []
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or os.path.basename(name).startswith('.'):
+                continue
+            if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            if info.file_size > max_file_bytes:
+                raise ValueError(f"{name} is larger than {max_file_bytes} bytes")
+            if len(items) >= max_files:
+                raise ValueError(f"Archive contains more than {max_files} images")
+            items.append((name, archive.read(info)))
+    return items
@@ -0,0 +1,347 @@
+import os
+import sys
+import time
+import logging
+import threading
+import torch
+import open_clip
+from PIL import Image
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import CLIP_MODEL_NAME, CLIP_PRETRAINED, MODEL_CACHE_DIR, CLIP_BACKEND
+from embedding.embedding_store import model_key
+
+logger = logging.getLogger("clip_model")
+
+
+def weights_cache_path(key, cache_dir=MODEL_CACHE_DIR):
+    """
+    Local checkpoint for a model/weights pair (see embedding_store.model_key).
+    """
+    return os.path.join(cache_dir, f"{key}.pt")
+
+
+def _load_checkpoint(path):
+    try:
+        # Memory-mapped, tensors-only load: no unpickling of arbitrary objects and no full read up front
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except TypeError:
+        # Older torch without mmap/weights_only
+        return torch.load(path, map_location="cpu")
+
+
+def _save_checkpoint(model, path):
+    """
+    Writes the state_dict plus the preprocessing constants needed to rebuild the
+    transforms without the pretrained config, via a temp file and os.replace.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    checkpoint = {
+        "state_dict": model.state_dict(),
+        "image_mean": list(getattr(model.visual, "image_mean", None) or open_clip.OPENAI_DATASET_MEAN),
+        "image_std": list(getattr(model.visual, "image_std", None) or open_clip.OPENAI_DATASET_STD),
+    }
+    tmp_path = f"{path}.tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_clip_model(model_name=CLIP_MODEL_NAME, pretrained=CLIP_PRETRAINED, device="cpu",
+                    cache_dir=MODEL_CACHE_DIR):
+    """
+    Returns (model, preprocess, weights_source) for an OpenCLIP model in eval mode.
+
+    The first load goes through open_clip's pretrained download/cache and then saves the
+    weights to a local checkpoint; later loads build the bare architecture and load that
+    checkpoint instead, which skips open_clip's pretrained resolution and checkpoint
+    conversion. weights_source is "cache" or "pretrained".
+    """
+    path = weights_cache_path(model_key(model_name, pretrained), cache_dir)
+    model = None
+    if os.path.exists(path):
+        try:
+            checkpoint = _load_checkpoint(path)
+            model, _, preprocess = open_clip.create_model_and_transforms(
+                model_name, pretrained=None,
+                image_mean=checkpoint["image_mean"], image_std=checkpoint["image_std"]
+            )
+            model.load_state_dict(checkpoint["state_dict"])
+            weights_source = "cache"
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable model cache {path}: {e}")
+            model = None
+
+    if model is None:
+        model, _, preprocess = open_clip.create_model_and_transforms(model_name, pretrained=pretrained)
+        weights_source = "pretrained"
+        try:
+            _save_checkpoint(model, path)
+        except OSError as e:
+            logger.warning(f"Could not write model cache {path}: {e}")
+
+    model.to(device)
+    model.eval()
+    return model, preprocess, weights_source
+
+
+BACKENDS = ("torch", "int8", "torchscript", "onnx")
+
+# Example input shape used for tracing / export; the batch dimension stays dynamic
+_EXAMPLE_BATCH = 2
+
+
+def _image_size(model):
+    size = model.visual.image_size
+    return tuple(size) if isinstance(size, (tuple, list)) else (size, size)
+
+
+class TorchEncoder:
+    """
+    Eager PyTorch image encoder (the fp32 reference, or its int8 dynamically quantized copy).
+    """
+    def __init__(self, visual):
+        self.visual = visual
+
+    def __call__(self, batch_tensor):
+        with torch.no_grad():
+            return self.visual(batch_tensor)
+
+
+class OnnxEncoder:
+    """
+    Image encoder exported to ONNX and run with onnxruntime on CPU.
+    """
+    def __init__(self, path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("CLIP_BACKEND=onnx requires the onnxruntime package (pip install onnxruntime)")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, batch_tensor):
+        features = self.session.run(["features"], {"image": batch_tensor.cpu().numpy()})[0]
+        return torch.from_numpy(features)
+
+
+def build_image_encoder(model, backend=CLIP_BACKEND, key=None, cache_dir=MODEL_CACHE_DIR):
+    """
+    Returns a callable mapping an (N, C, H, W) float tensor to unnormalized (N, dim) features.
+
+    - torch:       the fp32 model as loaded (reference).
+    - int8:        dynamic int8 quantization of the nn.Linear layers, i.e. the transformer MLPs;
+                   weights quantized once, activations per batch. nn.MultiheadAttention keeps
+                   its fp32 in/out projections (quantize_dynamic does not replace them).
+    - torchscript: traced, frozen and optimized for inference; cached as <key>.ts next to the weights.
+    - onnx:        exported once to <key>.onnx and run with onnxruntime (optional dependency).
+
+    All backends compute the same model, so their vectors stay compatible with an index
+    built by any other backend (see validate_backends for the measured drift). The
+    non-torch backends run on CPU.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown CLIP backend '{backend}'. Expected one of {BACKENDS}")
+    visual = model.visual
+    if backend == "torch":
+        return TorchEncoder(visual)
+
+    visual = visual.to("cpu").eval()
+    if backend == "int8":
+        quantized = torch.ao.quantization.quantize_dynamic(visual, {torch.nn.Linear}, dtype=torch.qint8)
+        return TorchEncoder(quantized)
+
+    example = torch.zeros((_EXAMPLE_BATCH, 3) + _image_size(model))
+    base = os.path.join(cache_dir, key) if key else None
+    if backend == "torchscript":
+        path = f"{base}.ts" if base else None
+        if path and os.path.exists(path):
+            return TorchEncoder(torch.jit.load(path, map_location="cpu"))
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(visual, example))
+            traced = torch.jit.optimize_for_inference(traced)
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            torch.jit.save(traced, f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+        return TorchEncoder(traced)
+
+    # onnx
+    path = f"{base}.onnx" if base else os.path.join(cache_dir, "clip_visual.onnx")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        with torch.no_grad():
+            torch.onnx.export(
+                visual, example, f"{path}.tmp",
+                input_names=["image"], output_names=["features"],
+                dynamic_axes={"image": {0: "batch"}, "features": {0: "batch"}},
+                opset_version=17
+            )
+        os.replace(f"{path}.tmp", path)
+    return OnnxEncoder(path)
+
+
+class ClipModelManager:
+    """
+    Owns the process-wide EmbeddingGenerator.
+
+    The model is loaded once (from the local weights cache when possible) and warmed up
+    with a dummy forward pass, so the first real request does not pay for lazy
+    initialisation. `status()` reports readiness and how long each step took.
+    """
+    def __init__(self, model_name=CLIP_MODEL_NAME, pretrained=CLIP_PRETRAINED, backend=CLIP_BACKEND):
+        self.model_name = model_name
+        self.pretrained = pretrained
+        self.backend = backend
+        self.state = "cold"
+        self.error = None
+        self.timings = {}
+        self._generator = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the shared EmbeddingGenerator, loading it on first use.
+        """
+        if self._generator is None:
+            with self._lock:
+                if self._generator is None:
+                    self._load()
+        return self._generator
+
+    def _load(self):
+        # Imported here: generate_embeddings itself uses load_clip_model from this module
+        from embedding.generate_embeddings import EmbeddingGenerator
+
+        self.state = "loading"
+        t0 = time.time()
+        try:
+            generator = EmbeddingGenerator(self.model_name, self.pretrained, backend=self.backend)
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            raise
+        self.timings["model_load_s"] = round(time.time() - t0, 4)
+        self.timings["weights_source"] = generator.weights_source
+        self._generator = generator
+        self.state = "loaded"
+
+    def warm_up(self, batch_size=1):
+        """
+        Runs one dummy batch through preprocessing and the image encoder so lazy allocations
+        and kernel selection happen now rather than on the first request.
+        """
+        generator = self.get()
+        t0 = time.time()
+        tensor = generator.preprocess_image(Image.new("RGB", (256, 256)))
+        generator.encode_tensors(torch.stack([tensor] * max(1, batch_size)))
+        self.timings["warmup_s"] = round(time.time() - t0, 4)
+        self.state = "ready"
+        logger.info(f"CLIP model warm: {self.timings}")
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def status(self):
+        return {
+            "state": self.state,
+            "model": self.model_name,
+            "pretrained": self.pretrained,
+            "backend": self.backend,
+            "timings": dict(self.timings),
+            "error": self.error
+        }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_model_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = ClipModelManager()
+    return _manager
+
+def get_generator():
+    """
+    The shared EmbeddingGenerator for this process (search and in-process indexing).
+    """
+    return get_model_manager().get()
+
+
+def validate_backends(image_paths, backends=BACKENDS, batch_size=16):
+    """
+    Embeds the same images with the fp32 reference and each backend and reports, per backend,
+    throughput (images/sec through the encoder) and cosine similarity to the fp32 vectors.
+    A backend is safe to use against an existing index when its drift is far below the gap
+    between the search threshold and typical non-match scores.
+    """
+    import numpy as np
+    from embedding.generate_embeddings import EmbeddingGenerator
+
+    reference = EmbeddingGenerator(backend="torch")
+    tensors = [t for t in (reference._try_preprocess(path) for path in image_paths) if t is not None]
+    if not tensors:
+        raise ValueError("No readable images to validate with")
+    batches = [torch.stack(tensors[i:i + batch_size]) for i in range(0, len(tensors), batch_size)]
+
+    def run(generator):
+        generator.encode_tensors(batches[0][:1])  # warm-up, not timed
+        t0 = time.time()
+        vectors = np.concatenate([generator.encode_tensors(batch) for batch in batches])
+        return vectors, len(tensors) / (time.time() - t0)
+
+    baseline, baseline_rate = run(reference)
+    report = {}
+    for backend in backends:
+        if backend == "torch":
+            vectors, rate = baseline, baseline_rate
+        else:
+            try:
+                generator = EmbeddingGenerator(backend=backend)
+                vectors, rate = run(generator)
+            except Exception as e:
+                report[backend] = {"error": str(e)}
+                continue
+        cosine = np.sum(vectors * baseline, axis=1)
+        report[backend] = {
+            "images": len(tensors),
+            "images_per_sec": round(rate, 2),
+            "speedup": round(rate / baseline_rate, 2),
+            "cosine_mean": round(float(cosine.mean()), 6),
+            "cosine_min": round(float(cosine.min()), 6)
+        }
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    from services.config import RAW_IMAGES_DIR
+
+    parser = argparse.ArgumentParser(description="Compare CLIP inference backends against fp32.")
+    parser.add_argument("--validate", action="store_true", help="Embed a sample set with every backend and report drift")
+    parser.add_argument("--images", default=RAW_IMAGES_DIR, help="Directory of sample images")
+    parser.add_argument("--limit", type=int, default=64, help="Max number of sample images")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    args = parser.parse_args()
+
+    if args.validate:
+        valid_extensions = {'.png', '.jpg', '.jpeg', '.webp'}
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(args.images)
+            for name in names if os.path.splitext(name)[1].lower() in valid_extensions
+        )[:args.limit]
+        print(json.dumps(validate_backends(paths, args.backends), indent=2))
+    else:
+        manager = get_model_manager()
+        manager.warm_up()
+        print(json.dumps(manager.status(), indent=2))
@@ -0,0 +1,191 @@
+import os
+import re
+import sys
+import shutil
+import sqlite3
+import threading
+import numpy as np
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import EMBEDDING_STORE_DIR, EMBEDDING_STORE_DTYPE, CLIP_MODEL_NAME, CLIP_PRETRAINED
+
+
+def model_key(model_name=CLIP_MODEL_NAME, pretrained=CLIP_PRETRAINED):
+    """
+    Directory-safe key for a model/weights pair. Each key gets its own store, so switching
+    models never touches (or trusts) vectors produced by another one.
+    """
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", f"{model_name}__{pretrained}")
+
+
+class EmbeddingStore:
+    """
+    Append-only, content-addressed store of image embeddings for one model.
+
+    Vectors live in a raw row-major matrix file (`vectors.bin`) that is read through a
+    numpy memmap; a small SQLite table maps images.hash to its row. Appends write and fsync
+    the vectors before committing the offsets, so a crash can only leave unreferenced rows
+    at the end of the file, never an offset pointing at missing data.
+
+    Only a `writer` (opened under faiss_index.indexing_lock, so there is one at a time) may
+    append or repair the file. Readers (search re-ranking, shard workers) may see a
+    partially written trailing row while the writer appends and simply ignore it.
+    """
+    def __init__(self, key=None, dim=None, store_dir=EMBEDDING_STORE_DIR, dtype=EMBEDDING_STORE_DTYPE,
+                 writer=False):
+        self.key = key or model_key()
+        self.writer = writer
+        self.path = os.path.join(store_dir, self.key)
+        os.makedirs(self.path, exist_ok=True)
+        self.vectors_path = os.path.join(self.path, "vectors.bin")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(self.path, "offsets.db"), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+        meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+        if meta:
+            # An existing store fixes its own layout
+            self.dim = int(meta["dim"])
+            self.dtype = np.dtype(meta["dtype"])
+            if dim is not None and dim != self.dim:
+                raise ValueError(f"Embedding dimension ({dim}) != store dimension ({self.dim}) for {self.key}")
+        else:
+            if dim is None:
+                raise ValueError(f"No embedding store for {self.key} yet; a dimension is required to create one")
+            self.dim = dim
+            self.dtype = np.dtype(dtype)
+            with self._conn:
+                self._conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                       [("dim", str(dim)), ("dtype", self.dtype.name)])
+
+        self.row_bytes = self.dim * self.dtype.itemsize
+        self._rows = self._recover_rows()
+        self._memmap = None
+
+    def _recover_rows(self):
+        """
+        Number of complete rows in vectors.bin. The writer truncates a torn trailing row left
+        by a crash; for a reader the same size may be an append in progress, so it is ignored.
+        """
+        if not os.path.exists(self.vectors_path):
+            open(self.vectors_path, "ab").close()
+            return 0
+        size = os.path.getsize(self.vectors_path)
+        if size % self.row_bytes and self.writer:
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(size - size % self.row_bytes)
+        return size // self.row_bytes
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def vectors(self):
+        """
+        Memory-mapped (rows, dim) view of every stored vector, including unreferenced ones.
+        """
+        with self._lock:
+            if self._memmap is None or len(self._memmap) != self._rows:
+                self._memmap = np.memmap(self.vectors_path, dtype=self.dtype, mode="r",
+                                         shape=(self._rows, self.dim)) if self._rows else \
+                    np.zeros((0, self.dim), dtype=self.dtype)
+            return self._memmap
+
+    def rows_for(self, hashes):
+        """
+        Returns an int64 array of row numbers aligned with `hashes`, -1 where missing.
+        """
+        rows = np.full(len(hashes), -1, dtype=np.int64)
+        positions = {}
+        for i, file_hash in enumerate(hashes):
+            positions.setdefault(file_hash, []).append(i)
+        unique = list(positions)
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(unique), 500):
+            part = unique[start:start + 500]
+            placeholders = ",".join("?" * len(part))
+            for file_hash, row in self._conn.execute(
+                f"SELECT hash, row FROM embeddings WHERE hash IN ({placeholders})", part
+            ):
+                rows[positions[file_hash]] = row
+        return rows
+
+    def get_many(self, hashes):
+        """
+        Returns (vectors, found) where vectors is (N, dim) float32 and found is a boolean mask.
+        """
+        # Serialized with put_many: lookups and appends may come from different pipeline threads
+        with self._lock:
+            rows = self.rows_for(hashes)
+            if len(rows) and rows.max() >= self._rows:
+                # Appended by another process (the indexing pipeline) since this store was opened;
+                # offsets are only committed after the vectors are fsynced, so the file covers them
+                self._rows = os.path.getsize(self.vectors_path) // self.row_bytes
+        found = rows >= 0
+        vectors = np.zeros((len(hashes), self.dim), dtype=np.float32)
+        if found.any():
+            vectors[found] = self.vectors()[rows[found]]
+        return vectors, found
+
+    def put_many(self, hashes, vectors):
+        """
+        Appends vectors for hashes that are not stored yet. Returns how many were added.
+        """
+        if not self.writer:
+            raise ValueError(f"Embedding store {self.key} was opened read-only")
+        with self._lock:
+            rows = self.rows_for(hashes)
+            seen = set()
+            new = []
+            for i, file_hash in enumerate(hashes):
+                if rows[i] < 0 and file_hash is not None and file_hash not in seen:
+                    seen.add(file_hash)
+                    new.append(i)
+            if not new:
+                return 0
+
+            data = np.ascontiguousarray(np.asarray(vectors)[new], dtype=self.dtype)
+            with open(self.vectors_path, "ab") as f:
+                # Row numbers come from the file itself, not a count cached at open time
+                end = f.seek(0, os.SEEK_END)
+                if end % self.row_bytes:
+                    f.truncate(end - end % self.row_bytes)
+                first_row = end // self.row_bytes
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            with self._conn:
+                self._conn.executemany("INSERT INTO embeddings (hash, row) VALUES (?, ?)",
+                                       [(hashes[i], first_row + n) for n, i in enumerate(new)])
+            self._rows = first_row + len(new)
+            return len(new)
+
+    def close(self):
+        self._memmap = None
+        self._conn.close()
+
+
+def open_store(key=None, dim=None, writer=False):
+    """
+    Opens the store for `key` (default: the configured CLIP model), or returns None
+    if it does not exist and no dimension was given to create it. Pass `writer` only
+    while holding faiss_index.indexing_lock.
+    """
+    key = key or model_key()
+    store_dir = os.path.join(EMBEDDING_STORE_DIR, key)
+    if dim is None and not os.path.exists(os.path.join(store_dir, "offsets.db")):
+        return None
+    return EmbeddingStore(key, dim, writer=writer)
+
+
+def remove_store(key):
+    """
+    Deletes every stored embedding for one model, leaving other models untouched.
+    """
+    shutil.rmtree(os.path.join(EMBEDDING_STORE_DIR, key), ignore_errors=True)
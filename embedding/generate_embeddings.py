@@ -1,7 +1,8 @@
 import os
 import sys
+import numpy as np
 import torch
-import open_clip
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 # Add project root to python path
@@ -9,23 +10,113 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
+from services.config import (CLIP_MODEL_NAME, CLIP_PRETRAINED, CLIP_BACKEND, PREPROCESS_FAST,
+                             EMBED_BATCH_SIZE, EMBED_WORKERS)
+from embedding.embedding_store import model_key
+from embedding.clip_model import load_clip_model, build_image_encoder
+from embedding.preprocess import ImagePreprocessor, check_image_size, augmented_views
+
 class EmbeddingGenerator:
     """
     Handles loading the OpenCLIP model and generating embeddings for images.
     """
-    def __init__(self, model_name="ViT-B-32", pretrained="laion2b_s34b_b79k"):
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+    def __init__(self, model_name=CLIP_MODEL_NAME, pretrained=CLIP_PRETRAINED, backend=CLIP_BACKEND):
+        self.model_name = model_name
+        self.pretrained = pretrained
+        self.backend = backend
+        # Embedding store key: vectors are only reused for the same model and weights.
+        # The backend is not part of the key: every backend computes the same model.
+        self.model_key = model_key(model_name, pretrained)
+        # Quantized / exported backends are CPU-only
+        self.device = "cuda" if torch.cuda.is_available() and backend == "torch" else "cpu"
         print(f"Loading OpenCLIP model '{model_name}' on {self.device}...")
-        self.model, _, self.preprocess = open_clip.create_model_and_transforms(
-            model_name, pretrained=pretrained
+        # Weights come from the local checkpoint cache after the first load
+        self.model, self.preprocess, self.weights_source = load_clip_model(
+            model_name, pretrained, device=self.device
         )
-        self.model.to(self.device)
-        self.model.eval()
+        self.encoder = build_image_encoder(self.model, backend, key=self.model_key)
+
+        # Reduced-scale decode + vectorized normalize; falls back to the open_clip transform
+        self.fast_preprocess = ImagePreprocessor.from_transform(self.preprocess) if PREPROCESS_FAST else None
 
         # Dimension of the embedding depends on the model architecture
         # For ViT-L-14 it is 768.
         self.embedding_dim = self.model.visual.output_dim
-        print(f"Model loaded successfully. Embedding dimension: {self.embedding_dim}")
+        print(f"Model loaded successfully ({self.weights_source}, {backend} backend). Embedding dimension: {self.embedding_dim}")
+
+    def preprocess_image(self, image_input, out=None):
+        """
+        Loads an image from a path or takes a PIL Image and applies the model transform.
+        Returns a (C, H, W) tensor; with the fast path it is written into `out`
+        (a row of a preallocated float32 batch) when given.
+        """
+        if self.fast_preprocess is not None:
+            return torch.from_numpy(self.fast_preprocess(image_input, out))
+        if isinstance(image_input, str):
+            image = Image.open(image_input)
+        else:
+            image = image_input
+        check_image_size(image)
+        return self.preprocess(image.convert("RGB"))
+
+    def preprocess_views(self, image_input):
+        """
+        Robust search mode: the crops and flips of one image (see preprocess.ROBUST_VIEWS)
+        as a (V, C, H, W) tensor, ready for a single forward pass.
+        """
+        if self.fast_preprocess is not None:
+            return torch.from_numpy(self.fast_preprocess.views(image_input))
+        image = Image.open(image_input) if isinstance(image_input, str) else image_input
+        check_image_size(image)
+        return torch.stack([self.preprocess(view) for view in augmented_views(image.convert("RGB"))])
+
+    def _try_preprocess(self, image_input, out=None):
+        """
+        Worker-pool variant of preprocess_image: returns None instead of raising.
+        """
+        try:
+            return self.preprocess_image(image_input, out)
+        except Exception as e:
+            print(f"Failed to preprocess {image_input}: {e}")
+            return None
+
+    def collate(self, batch, tensors):
+        """
+        Turns per-image preprocess results (None for failures) into one (N, C, H, W) tensor.
+        With the fast path the rows already live in `batch`, so nothing is copied unless some
+        images failed. Returns (batch_tensor or None, positions of the images it holds).
+        """
+        valid = [i for i, t in enumerate(tensors) if t is not None]
+        if not valid:
+            return None, valid
+        if batch is not None:
+            return torch.from_numpy(batch if len(valid) == len(tensors) else batch[valid]), valid
+        return torch.stack([tensors[i] for i in valid]), valid
+
+    def preprocess_batch(self, image_inputs, pool):
+        """
+        Decodes and preprocesses one batch in parallel on `pool`. The indexing engine calls
+        this on its read/decode stage and encode_tensors on its embed stage, so decoding the
+        next batch overlaps the forward pass of the current one.
+        Returns (batch_tensor or None, positions of the images that could be read).
+        """
+        image_inputs = list(image_inputs)
+        batch = self.fast_preprocess.new_batch(len(image_inputs)) if self.fast_preprocess is not None else None
+        rows = [None] * len(image_inputs) if batch is None else list(batch)
+        return self.collate(batch, list(pool.map(self._try_preprocess, image_inputs, rows)))
+
+    def encode_tensors(self, batch_tensor):
+        """
+        Runs a stacked (N, C, H, W) tensor through the image encoder and returns
+        L2-normalized float32 embeddings of shape (N, dim).
+        """
+        image_features = self.encoder(batch_tensor.to(self.device))
+
+        # Normalize embedding (L2 normalization is important for FAISS cosine similarity/IndexFlatIP)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+
+        # Convert back to numpy array on CPU
+        return image_features.cpu().numpy().astype(np.float32, copy=False)
 
     def generate_embedding(self, image_input):
         """
@@ -34,28 +125,34 @@ class EmbeddingGenerator:
         Returns None if the image cannot be read.
         """
         try:
-            # Load and preprocess image
-            if isinstance(image_input, str):
-                image = Image.open(image_input).convert("RGB")
-            else:
-                image = image_input.convert("RGB")
-                
-            image_input_tensor = self.preprocess(image).unsqueeze(0).to(self.device)
-
-            # Generate embedding
-            with torch.no_grad():
-                image_features = self.model.encode_image(image_input_tensor)
-
-            # Normalize embedding (L2 normalization is important for FAISS cosine similarity/IndexFlatIP)
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-            
-            # Convert back to numpy array on CPU
-            return image_features.cpu().numpy().flatten()
+            image_input_tensor = self.preprocess_image(image_input).unsqueeze(0)
+            return self.encode_tensors(image_input_tensor).flatten()
             
         except Exception as e:
-            print(f"Failed to generate embedding for {image_path}: {e}")
+            print(f"Failed to generate embedding for {image_input}: {e}")
             return None
 
+    def generate_embeddings(self, image_inputs, batch_size=EMBED_BATCH_SIZE, num_workers=EMBED_WORKERS):
+        """
+        Batched version of generate_embedding for paths and/or PIL Images: preprocess_batch
+        then encode_tensors per batch. The indexing engine pipelines those two stages itself;
+        this is the simple entry point for scripts and one-off batches.
+        Returns (embeddings, ok) where embeddings is an (N, dim) float32 array and ok is
+        a boolean mask; rows whose image could not be read are left as zeros with ok=False.
+        """
+        image_inputs = list(image_inputs)
+        embeddings = np.zeros((len(image_inputs), self.embedding_dim), dtype=np.float32)
+        ok = np.zeros(len(image_inputs), dtype=bool)
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            for start in range(0, len(image_inputs), batch_size):
+                batch_tensor, valid = self.preprocess_batch(image_inputs[start:start + batch_size], pool)
+                if batch_tensor is None:
+                    continue
+                positions = [start + i for i in valid]
+                embeddings[positions] = self.encode_tensors(batch_tensor)
+                ok[positions] = True
+        return embeddings, ok
+
 # Simple test if run directly
 if __name__ == "__main__":
     generator = EmbeddingGenerator()
@@ -0,0 +1,258 @@
+import os
+import sys
+import sqlite3
+import threading
+import numpy as np
+from PIL import Image
+
+# Add the project root to the Python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import DB_PATH, NEAR_DUPLICATE_DISTANCE
+from services.db_service import ensure_schema
+from services.metadata_service import BackgroundSnapshot
+from services.tombstones import Tombstones
+
+HASH_SIZE = 8           # 8x8 = 64-bit hashes
+PHASH_HIGHFREQ = 4      # pHash is computed from a 32x32 DCT
+
+
+def _dct_matrix(n):
+    """
+    Orthonormal DCT-II basis, so a 2D DCT is just D @ X @ D.T.
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(HASH_SIZE * PHASH_HIGHFREQ)
+
+
+def _grayscale(image, size):
+    """
+    Small grayscale copy of a PIL Image as a float array.
+    """
+    return np.asarray(image.convert("L").resize(size, Image.LANCZOS), dtype=np.float64)
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def compute_phash(image):
+    """
+    64-bit perceptual hash: low-frequency 8x8 block of a 32x32 DCT, thresholded at its median.
+    """
+    size = HASH_SIZE * PHASH_HIGHFREQ
+    pixels = _grayscale(image, (size, size))
+    dct = _DCT @ pixels @ _DCT.T
+    low = dct[:HASH_SIZE, :HASH_SIZE]
+    return _bits_to_int(low > np.median(low))
+
+
+def compute_dhash(image):
+    """
+    64-bit difference hash: sign of horizontal gradients on a 9x8 thumbnail.
+    """
+    pixels = _grayscale(image, (HASH_SIZE + 1, HASH_SIZE))
+    return _bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def compute_hashes(image_input):
+    """
+    Returns (phash, dhash) as unsigned 64-bit ints for a file path or PIL Image.
+    """
+    if isinstance(image_input, str):
+        with Image.open(image_input) as image:
+            # Files we open ourselves can be decoded at reduced scale (JPEG only)
+            image.draft("L", (128, 128))
+            return compute_phash(image), compute_dhash(image)
+    return compute_phash(image_input), compute_dhash(image_input)
+
+
+def to_signed(value):
+    """
+    SQLite INTEGER is signed 64-bit; store hashes in two's complement.
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with Hamming distance.
+    Radius queries only visit children whose edge distance lies within
+    [d - radius, d + radius], so small-radius lookups touch a tiny part of the tree.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, hash_value, item):
+        node = [hash_value, item, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value, radius):
+        """
+        Returns [(distance, item), ...] for every stored hash within `radius`, closest first.
+        """
+        results = []
+        if self.root is None:
+            return results
+        stack = [self.root]
+        while stack:
+            node_hash, item, children = stack.pop()
+            distance = hamming(hash_value, node_hash)
+            if distance <= radius:
+                results.append((distance, item))
+            for edge, child in children.items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+
+def find_near_duplicate(tree, phash, dhash, max_distance=NEAR_DUPLICATE_DISTANCE, exclude=None):
+    """
+    Returns (image_id, phash_distance) of the closest near-duplicate in a tree built with
+    items of the form (image_id, dhash), or None. Ids for which exclude(image_id) is true
+    are skipped.
+    """
+    for distance, (image_id, other_dhash) in tree.search(phash, max_distance):
+        if exclude is not None and exclude(image_id):
+            continue
+        if hamming(dhash, other_dhash) <= max_distance:
+            return image_id, distance
+    return None
+
+
+def collapse_near_duplicates(conn, max_distance=NEAR_DUPLICATE_DISTANCE):
+    """
+    Computes missing perceptual hashes for unindexed rows and marks every unindexed row
+    that is a near-duplicate of an earlier canonical row with duplicate_of, so it is
+    never embedded. Returns the number of rows collapsed.
+    """
+    ensure_schema(conn)
+
+    # 1. Fill in hashes for rows ingested without them
+    missing = conn.execute(
+        "SELECT id, file_path FROM images WHERE indexed = 0 AND duplicate_of IS NULL AND phash IS NULL"
+    ).fetchall()
+    updates = []
+    for image_id, file_path in missing:
+        try:
+            phash, dhash = compute_hashes(file_path)
+        except Exception as e:
+            print(f"Could not hash {file_path}: {e}")
+            continue
+        updates.append((to_signed(phash), to_signed(dhash), image_id))
+    if updates:
+        with conn:
+            conn.executemany("UPDATE images SET phash = ?, dhash = ? WHERE id = ?", updates)
+
+    # 2. Canonical rows in id order: indexed rows first claim their hashes, then each
+    #    unindexed row either joins the tree or collapses onto an earlier one
+    tree = BKTree()
+    duplicates = []
+    rows = conn.execute(
+        "SELECT id, phash, dhash, indexed FROM images "
+        "WHERE duplicate_of IS NULL AND phash IS NOT NULL AND deleted_at IS NULL ORDER BY indexed DESC, id"
+    )
+    for image_id, phash, dhash, indexed in rows:
+        phash, dhash = to_unsigned(phash), to_unsigned(dhash)
+        if not indexed:
+            match = find_near_duplicate(tree, phash, dhash, max_distance)
+            if match is not None:
+                duplicates.append((match[0], image_id))
+                continue
+        tree.add(phash, (image_id, dhash))
+
+    if duplicates:
+        with conn:
+            conn.executemany("UPDATE images SET duplicate_of = ? WHERE id = ?", duplicates)
+        print(f"Collapsed {len(duplicates)} near-duplicate images before embedding.")
+    return len(duplicates)
+
+
+class HashIndex:
+    """
+    In-memory lookup of canonical images by perceptual hash for the query-time fast path.
+
+    The BK-tree is rebuilt on a background thread after another connection has committed
+    to the database (see BackgroundSnapshot) and swapped in when done, so ingest commits
+    never stall searches. Until then the previous tree answers: images added since are
+    simply not found here (search falls through to CLIP), and taken-down images are
+    skipped through the tombstone bitset, which is always current.
+    """
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._schema_lock = threading.Lock()
+        self._schema_checked = False
+        self._snapshot = BackgroundSnapshot(db_path, self._build, "hash-index")
+        self._tombstones = Tombstones(db_path)
+
+    def _ensure_schema(self):
+        # The tree is built on read-only connections; migrate an old database once first
+        with self._schema_lock:
+            if not self._schema_checked:
+                conn = sqlite3.connect(self.db_path)
+                try:
+                    ensure_schema(conn)
+                finally:
+                    conn.close()
+                self._schema_checked = True
+
+    def _build(self, conn):
+        tree = BKTree()
+        for image_id, phash, dhash in conn.execute(
+            "SELECT id, phash, dhash FROM images "
+            "WHERE duplicate_of IS NULL AND phash IS NOT NULL AND deleted_at IS NULL"
+        ):
+            tree.add(to_unsigned(phash), (image_id, to_unsigned(dhash)))
+        return tree
+
+    def find(self, image, max_distance):
+        """
+        Returns (image_id, phash_distance) of the closest stored near-duplicate of a PIL Image, or None.
+        """
+        phash, dhash = compute_hashes(image)
+        if not self._schema_checked:
+            self._ensure_schema()
+        tree, current = self._snapshot.get()
+        exclude = None
+        if not current:
+            bits = self._tombstones.bits()
+            exclude = lambda image_id: bool(self._tombstones.contains([image_id], bits)[0])
+        return find_near_duplicate(tree, phash, dhash, max_distance, exclude)
+
+
+if __name__ == "__main__":
+    conn = sqlite3.connect(DB_PATH)
+    collapse_near_duplicates(conn)
+    conn.close()
@@ -0,0 +1,54 @@
+import os
+import sys
+import sqlite3
+
+# Add the project root to the Python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from query.result_mapper import parse_source
+from services.config import DB_PATH
+
+# Rows updated per executemany when back-filling
+BACKFILL_BATCH = 5000
+
+
+def source_columns(source_url):
+    """
+    (host, platform) column values for a new images row, parsed once at ingest so search
+    never has to look at the URL string again.
+    """
+    return parse_source(source_url)
+
+
+def backfill_sources(conn, rebuild=False):
+    """
+    Fills host / platform for rows ingested before those columns existed, or for every row
+    with `rebuild` (after the domain registry in query/result_mapper.py changed).
+    Commits and returns the number of rows updated.
+    """
+    where = "" if rebuild else " WHERE platform IS NULL"
+    rows = conn.execute(f"SELECT id, source_url FROM images{where}").fetchall()
+    updates = [source_columns(source_url) + (image_id,) for image_id, source_url in rows]
+    for i in range(0, len(updates), BACKFILL_BATCH):
+        with conn:
+            conn.executemany("UPDATE images SET host = ?, platform = ? WHERE id = ?",
+                             updates[i:i + BACKFILL_BATCH])
+    return len(updates)
+
+
+if __name__ == "__main__":
+    import argparse
+    from services.db_service import ensure_schema
+
+    parser = argparse.ArgumentParser(description="Parse source host and platform for the images table.")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--rebuild", action="store_true", help="Re-parse every row, not only missing ones")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    ensure_schema(conn)
+    updated = backfill_sources(conn, rebuild=args.rebuild)
+    conn.close()
+    print(f"Updated source host/platform for {updated} rows")
@@ -0,0 +1,466 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import hashlib
+import sqlite3
+import mimetypes
+import xml.etree.ElementTree as ET
+from contextlib import asynccontextmanager
+from html.parser import HTMLParser
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin, urlparse
+
+import httpx
+
+# Add the project root to the Python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import (
+    DB_PATH, RAW_IMAGES_DIR,
+    SCRAPER_MAX_CONNECTIONS, SCRAPER_PER_HOST_CONCURRENCY, SCRAPER_PER_HOST_RATE,
+    SCRAPER_RETRIES, SCRAPER_TIMEOUT, SCRAPER_MAX_IMAGE_BYTES
+)
+from services.db_service import ensure_schema
+from ingestion.metadata_builder import source_columns
+from ingestion.deduplicate import compute_hashes, to_signed
+
+SCRAPED_DIR = os.path.join(RAW_IMAGES_DIR, 'scraped')
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 64 * 1024
+
+
+class _ImageLinkParser(HTMLParser):
+    """
+    Collects <img src> and og:image URLs from an HTML page.
+    """
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "img" and attrs.get("src"):
+            self.urls.append(attrs["src"])
+        elif tag == "meta" and attrs.get("property") in ("og:image", "twitter:image") and attrs.get("content"):
+            self.urls.append(attrs["content"])
+
+
+def _is_image_url(url):
+    return os.path.splitext(urlparse(url).path)[1].lower() in IMAGE_EXTENSIONS
+
+
+class HostLimiter:
+    """
+    Per-host concurrency cap plus a minimum interval between request starts.
+    """
+    def __init__(self, concurrency, rate):
+        self.concurrency = concurrency
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._semaphores = {}
+        self._next_start = {}
+
+    @asynccontextmanager
+    async def slot(self, url):
+        host = urlparse(url).netloc
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(self.concurrency))
+        async with semaphore:
+            if self.interval:
+                # Reserve the next start time for this host before sleeping, so waiters queue up
+                now = time.monotonic()
+                start = max(now, self._next_start.get(host, now))
+                self._next_start[host] = start + self.interval
+                if start > now:
+                    await asyncio.sleep(start - now)
+            yield
+
+
+class Scraper:
+    """
+    Asyncio image scraper.
+
+    Takes page URLs, direct image URLs or sitemaps, fetches them over one pooled HTTP
+    client with per-host concurrency and rate limits, conditional requests (ETag /
+    Last-Modified, for pages, sitemaps and images alike) and retries with exponential
+    backoff. An unchanged page (304) is not parsed again; an unchanged sitemap is expanded
+    from the locations stored on the previous crawl. Image bodies are SHA-256 hashed
+    while they stream into a temporary file; duplicates of known images are dropped
+    instead of being moved into data/raw_images, and new images are inserted into the
+    images table with the page they were found on as source_url.
+    """
+    def __init__(self, db_path=DB_PATH, output_dir=SCRAPED_DIR,
+                 max_connections=SCRAPER_MAX_CONNECTIONS,
+                 per_host_concurrency=SCRAPER_PER_HOST_CONCURRENCY,
+                 per_host_rate=SCRAPER_PER_HOST_RATE,
+                 retries=SCRAPER_RETRIES, timeout=SCRAPER_TIMEOUT,
+                 max_image_bytes=SCRAPER_MAX_IMAGE_BYTES, transport=None):
+        self.db_path = db_path
+        self.output_dir = output_dir
+        self.max_connections = max_connections
+        self.retries = retries
+        self.timeout = timeout
+        self.max_image_bytes = max_image_bytes
+        # Custom httpx transport (tests use httpx.MockTransport)
+        self.transport = transport
+        self.limiter = HostLimiter(per_host_concurrency, per_host_rate)
+        self.stats = {
+            "pages": 0, "images": 0, "duplicates": 0, "not_modified": 0,
+            "errors": 0, "bytes": 0
+        }
+        self._seen_hashes = set()
+        self._seen_urls = set()
+        self._conn = None
+        self._client = None
+
+    # --- persistence -----------------------------------------------------
+
+    def _open_db(self):
+        conn = sqlite3.connect(self.db_path)
+        ensure_schema(conn)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fetch_cache (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Locations of each sitemap from its last full fetch, reused when it answers 304
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sitemap_locations (
+                sitemap TEXT NOT NULL,
+                loc TEXT NOT NULL,
+                nested INTEGER NOT NULL,
+                PRIMARY KEY (sitemap, loc)
+            )
+        ''')
+        conn.commit()
+        return conn
+
+    def _conditional_headers(self, url):
+        row = self._conn.execute("SELECT etag, last_modified FROM fetch_cache WHERE url = ?", (url,)).fetchone()
+        headers = {}
+        if row:
+            if row[0]:
+                headers["If-None-Match"] = row[0]
+            if row[1]:
+                headers["If-Modified-Since"] = row[1]
+        return headers
+
+    def _remember(self, url, response):
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        if etag or last_modified:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO fetch_cache (url, etag, last_modified) VALUES (?, ?, ?)",
+                (url, etag, last_modified)
+            )
+
+    def _hash_known(self, file_hash):
+        if file_hash in self._seen_hashes:
+            return True
+        return self._conn.execute("SELECT 1 FROM images WHERE hash = ?", (file_hash,)).fetchone() is not None
+
+    # --- HTTP ----------------------------------------------------------
+
+    async def _request(self, method, url, headers=None, stream=False):
+        """
+        Sends a request with retries on connection errors, 429 and 5xx, backing off
+        exponentially (with jitter) or as long as Retry-After asks.
+        Returns an httpx.Response (not yet read when `stream` is set).
+        """
+        for attempt in range(self.retries + 1):
+            delay = min(30.0, 0.5 * (2 ** attempt)) * (0.5 + random.random())
+            try:
+                request = self._client.build_request(method, url, headers=headers)
+                response = await self._client.send(request, stream=stream)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                retry_after = response.headers.get("retry-after")
+                if retry_after:
+                    delay = self._retry_after_seconds(retry_after, delay)
+                await response.aclose()
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _retry_after_seconds(value, default):
+        try:
+            return min(60.0, float(value))
+        except ValueError:
+            try:
+                return min(60.0, max(0.0, parsedate_to_datetime(value).timestamp() - time.time()))
+            except Exception:
+                return default
+
+    # --- fetching ------------------------------------------------------
+
+    async def _fetch(self, url, stream=False):
+        """
+        Conditional GET with the validators stored for `url`.
+        Returns the response, or None if the server answered 304 Not Modified.
+        """
+        response = await self._request("GET", url, headers=self._conditional_headers(url), stream=stream)
+        if response.status_code == 304:
+            await response.aclose()
+            self.stats["not_modified"] += 1
+            return None
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return response
+
+    async def expand_sitemap(self, url, seen=None):
+        """
+        Returns every <loc> in a sitemap, following nested sitemap indexes. An unchanged
+        sitemap (304) yields the locations stored on the previous crawl. `seen` holds the
+        sitemaps already expanded in this crawl, so an index that lists itself or an
+        ancestor (live or replayed from storage) is not followed again.
+        """
+        if seen is None:
+            seen = set()
+        if url in seen:
+            return []
+        seen.add(url)
+        async with self.limiter.slot(url):
+            response = await self._fetch(url)
+        if response is None:
+            rows = self._conn.execute("SELECT loc, nested FROM sitemap_locations WHERE sitemap = ?", (url,)).fetchall()
+            locations = [loc for loc, _ in rows]
+            nested = bool(rows) and bool(rows[0][1])
+        else:
+            self.stats["bytes"] += len(response.content)
+            root = ET.fromstring(response.content)
+            namespace = root.tag.split("}")[0] + "}" if root.tag.startswith("{") else ""
+            locations = [loc.text.strip() for loc in root.iter(f"{namespace}loc") if loc.text]
+            nested = root.tag.endswith("sitemapindex")
+            with self._conn:
+                self._conn.execute("DELETE FROM sitemap_locations WHERE sitemap = ?", (url,))
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO sitemap_locations (sitemap, loc, nested) VALUES (?, ?, ?)",
+                    [(url, loc, int(nested)) for loc in locations]
+                )
+                self._remember(url, response)
+        if nested:
+            groups = await asyncio.gather(*(self.expand_sitemap(loc, seen) for loc in locations))
+            return [loc for group in groups for loc in group]
+        return locations
+
+    async def scrape_page(self, url):
+        """
+        Downloads every image referenced by an HTML page, with the page as source_url.
+        A URL that turns out to be an image is saved from the same response.
+        """
+        received = html = None
+        try:
+            async with self.limiter.slot(url):
+                response = await self._fetch(url, stream=True)
+                if response is None:
+                    return
+                try:
+                    if response.headers.get("content-type", "").startswith("image/"):
+                        received = await self._receive_image(url, response)
+                    else:
+                        body = await response.aread()
+                        self.stats["bytes"] += len(body)
+                        html = response.text
+                finally:
+                    await response.aclose()
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Failed to fetch page {url}: {e}")
+            return
+        self.stats["pages"] += 1
+
+        if html is None:
+            if received is not None:
+                await self._store_image(url, *received, source_url=url, response=response)
+            return
+
+        parser = _ImageLinkParser()
+        parser.feed(html)
+        image_urls = []
+        for src in parser.urls:
+            image_url = urljoin(url, src)
+            if urlparse(image_url).scheme in ("http", "https") and image_url not in self._seen_urls:
+                self._seen_urls.add(image_url)
+                image_urls.append(image_url)
+        errors_before = self.stats["errors"]
+        await asyncio.gather(*(self.download_image(image_url, source_url=url) for image_url in image_urls))
+        # Only an entirely processed page may be skipped as unchanged next time
+        if self.stats["errors"] == errors_before:
+            self._remember(url, response)
+            self._conn.commit()
+
+    async def download_image(self, url, source_url=None):
+        """
+        Streams one image to a temp file while hashing it; keeps it only if it is new.
+        """
+        try:
+            async with self.limiter.slot(url):
+                response = await self._fetch(url, stream=True)
+                if response is None:
+                    return
+                try:
+                    received = await self._receive_image(url, response)
+                finally:
+                    await response.aclose()
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Failed to download image {url}: {e}")
+            return
+        if received is not None:
+            await self._store_image(url, *received, source_url=source_url, response=response)
+
+    async def _receive_image(self, url, response):
+        """
+        Streams an image response into a temp file, hashing it on the way and enforcing the
+        size limit. Returns (tmp_path, file_hash, content_type), or None if it was skipped.
+        """
+        content_type = response.headers.get("content-type", "").split(";")[0].strip()
+        if not content_type.startswith("image/"):
+            return None
+        declared = int(response.headers.get("content-length") or 0)
+        if declared > self.max_image_bytes:
+            print(f"Skipping {url}: {declared} bytes exceeds the image size limit")
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        sha256_hash = hashlib.sha256()
+        size = 0
+        tmp_path = os.path.join(self.output_dir, f".partial-{os.getpid()}-{id(response)}")
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_image_bytes:
+                        print(f"Skipping {url}: exceeds the image size limit")
+                        os.remove(tmp_path)
+                        return None
+                    sha256_hash.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.stats["bytes"] += size
+        return tmp_path, sha256_hash.hexdigest(), content_type
+
+    async def _store_image(self, url, tmp_path, file_hash, content_type, source_url=None, response=None):
+        """
+        Keeps a received image if its hash is new: moves it into place and inserts its row.
+        The validators of `response` are remembered only once the image is stored (or known),
+        so a failed store is fetched again on the next crawl instead of answering 304.
+        """
+        try:
+            if self._hash_known(file_hash):
+                self.stats["duplicates"] += 1
+                if response is not None:
+                    self._remember(url, response)
+                    self._conn.commit()
+                return
+            self._seen_hashes.add(file_hash)
+
+            extension = os.path.splitext(urlparse(url).path)[1].lower()
+            if extension not in IMAGE_EXTENSIONS:
+                extension = mimetypes.guess_extension(content_type) or ".jpg"
+            final_path = os.path.join(self.output_dir, f"{file_hash}{extension}")
+            os.replace(tmp_path, final_path)
+
+            try:
+                phash, dhash = await asyncio.to_thread(compute_hashes, final_path)
+                phash, dhash = to_signed(phash), to_signed(dhash)
+            except Exception:
+                phash, dhash = None, None
+
+            self._conn.execute('''
+                INSERT OR IGNORE INTO images (file_path, source_url, hash, phash, dhash, host, platform, indexed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            ''', (final_path.replace('\\', '/'), source_url or url, file_hash, phash, dhash)
+                + source_columns(source_url or url))
+            if response is not None:
+                self._remember(url, response)
+            self._conn.commit()
+            self.stats["images"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Failed to store image {url}: {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def run(self, urls=(), sitemaps=()):
+        """
+        Scrapes the given URLs (pages or direct image links) and every URL listed in
+        the given sitemaps. Returns the stats dict with pages/sec and bytes/sec added.
+        """
+        self._conn = self._open_db()
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections)
+        t0 = time.time()
+        try:
+            async with httpx.AsyncClient(limits=limits, timeout=self.timeout, follow_redirects=True,
+                                         transport=self.transport,
+                                         headers={"User-Agent": "HerSafeSpace-ImageScraper/1.0"}) as client:
+                self._client = client
+                targets = list(urls)
+                expanded = set()
+                for sitemap in sitemaps:
+                    try:
+                        targets.extend(await self.expand_sitemap(sitemap, expanded))
+                    except Exception as e:
+                        self.stats["errors"] += 1
+                        print(f"Failed to read sitemap {sitemap}: {e}")
+
+                tasks = []
+                for url in dict.fromkeys(targets):
+                    if _is_image_url(url):
+                        self._seen_urls.add(url)
+                        tasks.append(self.download_image(url))
+                    else:
+                        tasks.append(self.scrape_page(url))
+                await asyncio.gather(*tasks)
+            self._conn.commit()
+        finally:
+            self._client = None
+            self._conn.close()
+            self._conn = None
+
+        elapsed = max(time.time() - t0, 1e-9)
+        self.stats["seconds"] = round(elapsed, 3)
+        self.stats["pages_per_sec"] = round(self.stats["pages"] / elapsed, 2)
+        self.stats["bytes_per_sec"] = round(self.stats["bytes"] / elapsed, 1)
+        return self.stats
+
+
+def scrape(urls=(), sitemaps=(), **kwargs):
+    """
+    Synchronous entry point around Scraper.run().
+    """
+    return asyncio.run(Scraper(**kwargs).run(urls, sitemaps))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Scrape images into data/raw_images and the metadata DB")
+    parser.add_argument("urls", nargs="*", help="Page or image URLs")
+    parser.add_argument("--url-file", help="File with one URL per line")
+    parser.add_argument("--sitemap", action="append", default=[], help="Sitemap URL (repeatable)")
+    args = parser.parse_args()
+
+    url_list = list(args.urls)
+    if args.url_file:
+        with open(args.url_file) as f:
+            url_list.extend(line.strip() for line in f if line.strip() and not line.startswith("#"))
+
+    result = scrape(url_list, args.sitemap)
+    print(f"\nScraping finished. Pages: {result['pages']}, New images: {result['images']}, "
+          f"Duplicates: {result['duplicates']}, Not modified: {result['not_modified']}, Errors: {result['errors']}")
+    print(f"Throughput: {result['pages_per_sec']} pages/sec, {result['bytes_per_sec']} bytes/sec")
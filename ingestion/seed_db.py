@@ -2,14 +2,21 @@ import os
 import sys
 import sqlite3
 import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Add the project root to the Python path
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-DB_PATH = os.path.join(PROJECT_ROOT, 'data', 'sqlite_db', 'metadata.db')
-RAW_IMAGES_DIR = os.path.join(PROJECT_ROOT, 'data', 'raw_images')
+from services.db_service import ensure_schema
+from ingestion.metadata_builder import source_columns
+from services.config import DB_PATH, RAW_IMAGES_DIR, SEED_WORKERS
+from ingestion.deduplicate import compute_hashes, to_signed, collapse_near_duplicates
+
+# Large reads keep the hashing workers in C (hashlib releases the GIL) instead of the Python loop
+HASH_READ_SIZE = 1024 * 1024
 
 def generate_file_hash(filepath):
     """
@@ -18,25 +25,64 @@ def generate_file_hash(filepath):
     sha256_hash = hashlib.sha256()
     try:
         with open(filepath, "rb") as f:
-            # Read and update hash string value in blocks of 4K
-            for byte_block in iter(lambda: f.read(4096), b""):
+            # Read and update hash string value in blocks of 1 MB
+            for byte_block in iter(lambda: f.read(HASH_READ_SIZE), b""):
                 sha256_hash.update(byte_block)
         return sha256_hash.hexdigest()
     except Exception as e:
         print(f"Error reading file {filepath}: {e}")
         return None
 
-def seed_database():
+def scan_images(root, valid_extensions):
+    """
+    Recursively yields (path, size, mtime_ns) for image files under `root` using os.scandir,
+    which returns file metadata without an extra stat call per entry on most platforms.
+    Hidden files and directories (e.g. the scraper's .partial downloads) are skipped.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in valid_extensions:
+                        st = entry.stat()
+                        yield entry.path, st.st_size, st.st_mtime_ns
+        except OSError as e:
+            print(f"Could not scan {directory}: {e}")
+
+def hash_image_file(filepath):
+    """
+    Worker task: SHA-256 of the bytes plus the perceptual hashes used for near-duplicate detection.
+    Returns (file_hash, phash, dhash); perceptual hashes are None if the image cannot be decoded.
+    """
+    file_hash = generate_file_hash(filepath)
+    if not file_hash:
+        return None, None, None
+    try:
+        phash, dhash = compute_hashes(filepath)
+        return file_hash, to_signed(phash), to_signed(dhash)
+    except Exception as e:
+        print(f"Could not compute perceptual hash for {filepath}: {e}")
+        return file_hash, None, None
+
+def seed_database(workers=SEED_WORKERS, db_path=DB_PATH, raw_images_dir=RAW_IMAGES_DIR):
     """
-    Scans the raw_images directory, computes hashes, and inserts metadata into SQLite.
+    Scans the raw_images directory (recursively), computes hashes for new or changed files
+    on a thread pool, and inserts metadata into SQLite in one batched transaction.
+    Files whose (path, size, mtime) are unchanged since the last run are not re-read.
     """
-    if not os.path.exists(DB_PATH):
-        print(f"Error: Database not found at {DB_PATH}. Please run init_db.py first.")
+    if not os.path.exists(db_path):
+        print(f"Error: Database not found at {db_path}. Please run init_db.py first.")
         return
 
-    if not os.path.exists(RAW_IMAGES_DIR):
-        print(f"Directory {RAW_IMAGES_DIR} does not exist. Creating it now.")
-        os.makedirs(RAW_IMAGES_DIR, exist_ok=True)
+    if not os.path.exists(raw_images_dir):
+        print(f"Directory {raw_images_dir} does not exist. Creating it now.")
+        os.makedirs(raw_images_dir, exist_ok=True)
         print("Please place images in data/raw_images/ and run this script again.")
         return
 
@@ -53,58 +99,86 @@ def seed_database():
         "pinterest.com/pin"
     ]
 
-    # 1. Connect to Database
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    t0 = time.time()
 
-    inserted_count = 0
-    skipped_count = 0
+    # 1. Connect to Database
+    conn = sqlite3.connect(db_path)
+    ensure_schema(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS seed_state (
+            file_path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL
+        )
+    ''')
+    known_files = {path: (size, mtime_ns) for path, size, mtime_ns in
+                   conn.execute("SELECT file_path, size, mtime_ns FROM seed_state")}
 
     print("Scanning data/raw_images/ for images...")
 
-    # 2. Read Images
-    for filename in os.listdir(RAW_IMAGES_DIR):
-        filepath = os.path.join(RAW_IMAGES_DIR, filename)
-        
-        if os.path.isfile(filepath):
-            ex = os.path.splitext(filename)[1].lower()
-            if ex in valid_extensions:
-                
-                # 3. Generate Metadata (Hash from bytes)
-                file_hash = generate_file_hash(filepath)
-                if not file_hash:
-                    continue
-                
-                # Normalize the filepath using forward slashes for cross-platform DB consistency
-                db_filepath = filepath.replace('\\', '/')
-                
-                # Generate a random social media source URL
-                platform = random.choice(platforms)
-                random_id = ''.join(random.choices('0123456789abcdefghijklmnopqrstuvwxyz', k=10))
-                source_url = f"https://www.{platform}/{random_id}"
-                
-                # 4. Insert into SQLite (Skip duplicates using INSERT OR IGNORE)
-                try:
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO images (file_path, source_url, hash, indexed)
-                        VALUES (?, ?, ?, 0)
-                    ''', (db_filepath, source_url, file_hash))
-                    
-                    if cursor.rowcount > 0:
-                        inserted_count += 1
-                        print(f"Inserted: {filename}")
-                    else:
-                        skipped_count += 1
-                        print(f"Skipped (Duplicate): {filename}")
-                except sqlite3.Error as e:
-                    print(f"Database error on {filename}: {e}")
-
-    # 5. Finalize
-    conn.commit()
+    # 2. Find new or changed images
+    scanned_count = 0
+    changed_files = []
+    for filepath, size, mtime_ns in scan_images(raw_images_dir, valid_extensions):
+        scanned_count += 1
+        # Normalize the filepath using forward slashes for cross-platform DB consistency
+        db_filepath = filepath.replace('\\', '/')
+        if known_files.get(db_filepath) != (size, mtime_ns):
+            changed_files.append((filepath, db_filepath, size, mtime_ns))
+
+    # 3. Generate Metadata (Hash from bytes) in parallel
+    image_rows = []
+    state_rows = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(hash_image_file, [filepath for filepath, _, _, _ in changed_files])
+        for (filepath, db_filepath, size, mtime_ns), (file_hash, phash, dhash) in zip(changed_files, hashes):
+            if not file_hash:
+                continue
+            
+            # Generate a random social media source URL
+            platform = random.choice(platforms)
+            random_id = ''.join(random.choices('0123456789abcdefghijklmnopqrstuvwxyz', k=10))
+            source_url = f"https://www.{platform}/{random_id}"
+            
+            image_rows.append((db_filepath, source_url, file_hash, phash, dhash) + source_columns(source_url))
+            state_rows.append((db_filepath, size, mtime_ns))
+
+    # 4. Insert into SQLite in one transaction (Skip duplicates using INSERT OR IGNORE)
+    changes_before = conn.total_changes
+    try:
+        with conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO images (file_path, source_url, hash, phash, dhash, host, platform, indexed)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            ''', image_rows)
+            inserted_count = conn.total_changes - changes_before
+            conn.executemany("INSERT OR REPLACE INTO seed_state (file_path, size, mtime_ns) VALUES (?, ?, ?)",
+                             state_rows)
+    except sqlite3.Error as e:
+        print(f"Database error while seeding: {e}")
+        conn.close()
+        return
+    skipped_count = len(image_rows) - inserted_count
+    unchanged_count = scanned_count - len(changed_files)
+
+    # 5. Mark near-duplicates of existing images so they are never embedded
+    collapse_near_duplicates(conn)
     conn.close()
     
-    print(f"\nSeeding finished. Inserted: {inserted_count}, Skipped: {skipped_count}")
+    elapsed = max(time.time() - t0, 1e-9)
+    print(f"\nSeeding finished. Inserted: {inserted_count}, Skipped (Duplicate): {skipped_count}, "
+          f"Unchanged: {unchanged_count}")
+    print(f"Scanned {scanned_count} files, hashed {len(changed_files)} in {elapsed:.2f}s "
+          f"({scanned_count / elapsed:.1f} files/sec)")
     print("Metadata seeding completed successfully")
+    return {
+        "scanned": scanned_count,
+        "hashed": len(changed_files),
+        "inserted": inserted_count,
+        "skipped": skipped_count,
+        "unchanged": unchanged_count,
+        "files_per_sec": scanned_count / elapsed
+    }
 
 if __name__ == "__main__":
     seed_database()
@@ -0,0 +1,120 @@
+import os
+import sys
+import queue
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+import numpy as np
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import SEARCH_BATCH_WINDOW_MS, SEARCH_MAX_BATCH_SIZE, SEARCH_TOP_K
+from services.metrics import SEARCH_STAGE_SECONDS
+
+logger = logging.getLogger("embed_query")
+
+
+class QueryBatcher:
+    """
+    Dynamic micro-batcher for query images.
+
+    Request threads preprocess their own upload and hand the tensor to `search()`.
+    A single worker thread waits up to `window_ms` after the first pending query
+    (or until `max_batch_size` queries are waiting), then runs one encode_image
+    call and one FAISS search (single index or all shards) over the resulting (N, dim) matrix and hands each
+    row of the result back to the request that submitted it.
+    """
+    def __init__(self, generator, searcher, max_batch_size=SEARCH_MAX_BATCH_SIZE,
+                 window_ms=SEARCH_BATCH_WINDOW_MS, top_k=SEARCH_TOP_K):
+        self.generator = generator
+        self.searcher = searcher
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = window_ms / 1000.0
+        self.top_k = top_k
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+        self._worker.start()
+
+    def search(self, image_input, lookup=None):
+        """
+        Embeds one query image as part of the next batch and searches the index.
+        Blocks until the batch completes and returns (embedding, distances, indices)
+        for this image, each a 1D array.
+
+        `lookup(embedding)` is called on the batch thread right after the forward pass; if it
+        returns True the caller already has an answer for this embedding (result cache), the
+        FAISS search is skipped for this image and distances / indices are None.
+        """
+        with SEARCH_STAGE_SECONDS.time("preprocess"):
+            tensor = self.generator.preprocess_image(image_input)
+        future = Future()
+        self._queue.put((tensor, lookup, future))
+        return future.result()
+
+    def _collect_batch(self):
+        """
+        Blocks for the first pending query, then gathers more until the window
+        closes or the batch is full.
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            futures = [future for _, _, future in batch]
+            try:
+                # The generator owns the tensor type: collate stacks the rows into one batch
+                batch_tensor, _ = self.generator.collate(None, [tensor for tensor, _, _ in batch])
+                results = self._process(batch_tensor, [lookup for _, lookup, _ in batch])
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            except Exception as e:
+                logger.error(f"Query batch of {len(batch)} failed: {e}")
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch_tensor, lookups):
+        """
+        One forward pass and one FAISS search for the whole batch (minus cache hits).
+        """
+        with SEARCH_STAGE_SECONDS.time("embed"):
+            embeddings = self.generator.encode_tensors(batch_tensor)
+
+        results = [(embedding, None, None) for embedding in embeddings]
+        rows = [i for i, (lookup, embedding) in enumerate(zip(lookups, embeddings))
+                if lookup is None or not lookup(embedding)]
+        if not rows:
+            return results
+
+        ntotal, dim = self.searcher.info()
+        if embeddings.shape[1] != dim:
+            raise ValueError(f"Embedding dimension ({embeddings.shape[1]}) != FAISS dimension ({dim})")
+
+        k = min(self.top_k, ntotal)
+        if k == 0:
+            empty = np.zeros(0, dtype=np.float32)
+            for i in rows:
+                results[i] = (embeddings[i], empty, empty.astype(np.int64))
+            return results
+
+        with SEARCH_STAGE_SECONDS.time("faiss_search"):
+            distances, indices = self.searcher.search(embeddings[rows], k)
+        for row, i in enumerate(rows):
+            results[i] = (embeddings[i], distances[row], indices[row])
+        return results
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import DB_PATH, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL, RESULT_CACHE_EMBEDDING_TIER
+from services.metadata_service import connect_readonly
+from services.metrics import RESULT_CACHE_LOOKUPS
+
+# Bookkeeping per entry on top of the response itself (key tuple, OrderedDict node, expiry)
+ENTRY_OVERHEAD = 256
+
+
+def embedding_key(embedding):
+    """
+    Cache key of a query embedding: its L2-normalized values rounded to 1e-3, so the same
+    pixels uploaded as different bytes (re-saved metadata, lossless re-encode) map to the
+    same entry. Lossy re-encodes usually move some component across a rounding boundary
+    and miss, which only costs the FAISS search the cache would have saved.
+    """
+    rounded = np.round(np.asarray(embedding, dtype=np.float32) * 1000).astype(np.int16)
+    return hashlib.blake2b(rounded.tobytes(), digest_size=16).digest()
+
+
+class ResultCache:
+    """
+    Bounded LRU + TTL cache of search responses in front of search_image, in two tiers:
+
+    1. "sha256":    SHA-256 of the uploaded bytes + threshold. A repeat upload skips decoding,
+                    CLIP, FAISS and the metadata lookup.
+    2. "embedding": query embedding (see embedding_key) + threshold, optional. A re-encoded
+                    copy still pays for the forward pass but skips FAISS and metadata.
+
+    Every entry belongs to the (index generation, database data_version) pair that was
+    current when it was stored. Lookups pass the current pair and the whole cache is
+    dropped when it changed, so a reindex, a takedown or a metadata update is never
+    answered from stale results. Memory is bounded by `max_bytes`, estimated per entry
+    from the response's JSON size; least recently used entries are evicted first.
+    Cached responses are shared between requests and must not be modified.
+    """
+    def __init__(self, generation_fn, db_path=DB_PATH, max_bytes=RESULT_CACHE_MAX_BYTES,
+                 ttl=RESULT_CACHE_TTL, embedding_tier=RESULT_CACHE_EMBEDDING_TIER):
+        self.generation_fn = generation_fn
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.embedding_tier = embedding_tier and max_bytes > 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._conn = None
+        self._conn_lock = threading.Lock()
+        self.bytes = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _data_version(self):
+        # One dedicated connection: PRAGMA data_version is only comparable within a connection
+        with self._conn_lock:
+            if self._conn is None:
+                if not os.path.exists(self.db_path):
+                    return None
+                self._conn = connect_readonly(self.db_path, check_same_thread=False)
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def version(self):
+        """
+        The current (index generation, data_version) pair; pass it to get() and put().
+        """
+        try:
+            generation = self.generation_fn()
+        except FileNotFoundError:
+            generation = None
+        return generation, self._data_version()
+
+    def _sync(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.bytes = 0
+            self._version = version
+
+    def get(self, tier, key, version):
+        """
+        Returns the cached response for `key` in `tier`, or None.
+        """
+        if not self.enabled or (tier == "embedding" and not self.embedding_tier):
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._sync(version)
+            entry = self._entries.get((tier, key))
+            if entry is not None and entry[1] < now:
+                del self._entries[(tier, key)]
+                self.bytes -= entry[2]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end((tier, key))
+        RESULT_CACHE_LOOKUPS.inc(f"{tier}_{'hit' if entry is not None else 'miss'}")
+        return entry[0] if entry is not None else None
+
+    def put(self, tier, key, response, version):
+        """
+        Stores a response computed under `version`. It is dropped if the index or the
+        database has changed since (the next get() with the new version clears it anyway).
+        """
+        if not self.enabled or (tier == "embedding" and not self.embedding_tier):
+            return
+        size = len(json.dumps(response)) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            old = self._entries.pop((tier, key), None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[(tier, key)] = (response, time.monotonic() + self.ttl, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            **{f"{tier}_{outcome}": RESULT_CACHE_LOOKUPS.value(f"{tier}_{outcome}")
+               for tier in ("sha256", "embedding") for outcome in ("hit", "miss")}
+        }
@@ -0,0 +1,91 @@
+import os
+import sys
+from urllib.parse import urlsplit
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+# Registered domain -> platform. A host matches its own entry or that of any parent
+# domain (www.reddit.com and old.reddit.com are both reddit).
+DOMAIN_PLATFORMS = {
+    "facebook.com": "facebook",
+    "twitter.com": "twitter",
+    "reddit.com": "reddit",
+    "instagram.com": "instagram",
+}
+
+# Platform of hosts that are not registered, and of rows without a usable source URL
+OTHER_PLATFORM = "other"
+UNKNOWN_PLATFORM = "unknown"
+
+# Platform -> vulnerability assessment (score, level, description).
+# Mock values; in a real deployment these would come from threat intelligence or domain analysis.
+PLATFORM_RISKS = {
+    "facebook": (45, "Medium", "Found on public social media. Potential for unauthorized cloning."),
+    "twitter": (65, "High", "Found on microblogging site. High risk of rapid viral dissemination."),
+    "reddit": (85, "Critical", "Found on anonymous forum. High risk of malicious manipulation."),
+    "instagram": (30, "Low", "Found on visual platform. Monitor for unauthorized commercial use."),
+}
+DEFAULT_RISK = (0, "Low", "Standard public profile. Low risk of impersonation.")
+
+
+def parse_host(source_url):
+    """
+    Lower-cased host name of a source URL (without port or credentials), or None.
+    Scheme-less URLs such as "reddit.com/r/pics" are read as host + path.
+    """
+    if not source_url:
+        return None
+    if "://" not in source_url:
+        source_url = "//" + source_url
+    try:
+        host = urlsplit(source_url.strip()).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    return host.rstrip(".") or None
+
+
+def platform_for_host(host):
+    """
+    Platform of a host name: the registered entry of the host or its closest parent domain.
+    """
+    if not host:
+        return UNKNOWN_PLATFORM
+    labels = host.split(".")
+    for i in range(len(labels) - 1):
+        platform = DOMAIN_PLATFORMS.get(".".join(labels[i:]))
+        if platform is not None:
+            return platform
+    return OTHER_PLATFORM
+
+
+def parse_source(source_url):
+    """
+    (host, platform) of a source URL, computed once at ingest and stored on the images row.
+    """
+    host = parse_host(source_url)
+    return host, platform_for_host(host)
+
+
+def build_match(score, source_url, file_path, platform):
+    """
+    One search match. The vulnerability assessment is a lookup on the platform stored at ingest.
+    """
+    platform = platform or UNKNOWN_PLATFORM
+    vuln_score, vuln_level, vuln_desc = PLATFORM_RISKS.get(platform, DEFAULT_RISK)
+    return {
+        "similarity": round(score, 4),
+        "source_url": source_url or "Unknown Source",
+        "file_path": file_path,
+        "platform": platform,
+        "vulnerability": {
+            "score": vuln_score,
+            "level": vuln_level,
+            "description": vuln_desc
+        }
+    }
+
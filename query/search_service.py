@@ -1,10 +1,13 @@
 import os
 import sys
-import sqlite3
-import faiss
-import numpy as np
+import hashlib
 import logging
 import time
+import threading
+import io
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(name)s - %(message)s')
@@ -15,146 +18,412 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-from embedding.generate_embeddings import EmbeddingGenerator
+from embedding.clip_model import get_generator, get_model_manager
+from vector_index.search import get_searcher, fuse_scores
+from query.embed_query import QueryBatcher
+from query.result_cache import ResultCache, embedding_key
+from query.result_mapper import build_match
+from ingestion.deduplicate import HashIndex
+from services.config import (DB_PATH, FAISS_INDEX_PATH, PHASH_MATCH_DISTANCE, SEARCH_TOP_K, EMBED_WORKERS,
+                             PREPROCESS_MIN_SIDE, ROBUST_FUSION)
+from embedding.preprocess import open_image
+from services.metadata_service import get_metadata_store
+from services.metrics import SEARCH_STAGE_SECONDS
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+# Decode / preprocess pool shared by bulk searches
+_bulk_pool = ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="bulk-decode")
+_hash_index = None
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_query_batcher():
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = QueryBatcher(get_generator(), get_searcher())
+    return _batcher
+
+def get_hash_index():
+    global _hash_index
+    if _hash_index is None:
+        _hash_index = HashIndex(DB_PATH)
+    return _hash_index
+
+def get_result_cache():
+    """
+    Process-wide search result cache, invalidated by index generation and database changes.
+    """
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache(lambda: get_searcher().generation(), DB_PATH)
+    return _result_cache
+
+_startup = {"state": "cold", "timings": {}, "index": None, "error": None}
+
+def warm_up():
+    """
+    Loads and warms up everything the first search would otherwise initialise lazily:
+    the CLIP model (dummy forward pass), the FAISS index or shards (dummy search), the
+    query batcher and the metadata / perceptual-hash lookups. Records a per-step timing
+    breakdown for readiness(). A missing index is reported but does not block readiness,
+    since the pipeline may not have run yet.
+    """
+    _startup["state"] = "warming"
+    t_start = time.time()
+    try:
+        # 1. Model load + dummy forward pass
+        manager = get_model_manager()
+        manager.warm_up()
+        _startup["timings"].update(manager.timings)
+        
+        # 2. Index load + dummy search
+        t0 = time.time()
+        try:
+            ntotal, dim = get_searcher().info()
+            if ntotal > 0:
+                get_searcher().search(np.zeros((1, dim), dtype=np.float32), 1)
+            _startup["index"] = {"vectors": ntotal, "dim": dim}
+        except FileNotFoundError:
+            logger.warning("No FAISS index yet; searches will fail until the pipeline has run")
+            _startup["index"] = {"vectors": 0, "missing": True}
+        _startup["timings"]["index_load_s"] = round(time.time() - t0, 4)
+        
+        # 3. Batcher thread, metadata cache and perceptual-hash tree
+        t0 = time.time()
+        get_query_batcher()
+        try:
+            get_metadata_store().get_many([0])
+            get_hash_index().find(Image.new("RGB", (64, 64)), 0)
+        except Exception as e:
+            logger.warning(f"Metadata warm-up skipped: {e}")
+        _startup["timings"]["metadata_load_s"] = round(time.time() - t0, 4)
+    except Exception as e:
+        _startup["state"] = "failed"
+        _startup["error"] = str(e)
+        logger.error(f"Warm-up failed: {e}")
+        raise
+    
+    _startup["timings"]["total_s"] = round(time.time() - t_start, 4)
+    _startup["state"] = "ready"
+    logger.info(f"Search service ready: {_startup['timings']}")
+
+def readiness():
+    """
+    Returns (ready, report) with the warm-up state and startup time breakdown.
+    """
+    report = dict(_startup)
+    report["model"] = get_model_manager().status()
+    return _startup["state"] == "ready", report
 
-DB_PATH = os.path.join(PROJECT_ROOT, 'data', 'sqlite_db', 'metadata.db')
-FAISS_INDEX_PATH = os.path.join(PROJECT_ROOT, 'vector_index', 'faiss.index')
+def _fetch_matches(scored_ids, rows_by_id=None, platforms=None):
+    """
+    Builds match entries for [(image_id, score), ...] with one metadata lookup (or from
+    `rows_by_id` if the caller already fetched them). Each matched image also reports every
+    near-duplicate collapsed onto it at ingest, so each known source of the picture is listed.
+    With `platforms`, only sources on those platforms are kept (filtered in SQL).
+    """
+    if rows_by_id is None:
+        rows_by_id = get_metadata_store().get_many((image_id for image_id, _ in scored_ids), platforms)
+    matches = []
+    for image_id, score in scored_ids:
+        rows = rows_by_id.get(image_id)
+        if rows is None:
+            # No row: deleted by compaction while this worker still serves the old
+            # generation, or filtered out by `platforms`. Never report it as a match.
+            continue
+        for source_url, file_path, platform in rows:
+            matches.append(build_match(score, source_url, file_path, platform))
+    return matches
 
-# Initialize generator once. In a real prod environment this would be singleton/cached.
-# We'll instantiate it lazily here to avoid loading CUDA if this module is just imported.
-_generator = None
+def _find_exact_match(image_input, file_hash=None):
+    """
+    Fast path before CLIP: an upload whose SHA-256 is already in the images table, or whose
+    perceptual hash is within PHASH_MATCH_DISTANCE of a stored image, is a known image.
+    Returns (image_id, similarity) or None.
+    """
+    if file_hash is not None:
+        image_id = get_metadata_store().find_by_hash(file_hash)
+        if image_id is not None:
+            logger.info("Exact SHA-256 match")
+            return image_id, 1.0
+    
+    match = get_hash_index().find(image_input, PHASH_MATCH_DISTANCE)
+    if match is not None:
+        image_id, distance = match
+        logger.info(f"Perceptual hash match (distance {distance})")
+        return image_id, 1.0 - distance / 64.0
+    return None
 
-def get_generator():
-    global _generator
-    if _generator is None:
-        _generator = EmbeddingGenerator()
-    return _generator
+def _robust_search(image_input, threshold, fusion=ROBUST_FUSION):
+    """
+    Robust mode: every view of the upload in one forward pass, one (V, dim) matrix search,
+    then per-image score fusion before the threshold. Costs about V single queries of
+    encoder and FAISS time but only one request round trip and one metadata lookup.
+    """
+    generator = get_generator()
+    searcher = get_searcher()
+    with SEARCH_STAGE_SECONDS.time("robust_preprocess"):
+        batch_tensor = generator.preprocess_views(image_input)
+    with SEARCH_STAGE_SECONDS.time("robust_embed"):
+        embeddings = generator.encode_tensors(batch_tensor)
+    ntotal, dim = searcher.info()
+    if embeddings.shape[1] != dim:
+        raise ValueError(f"Embedding dimension ({embeddings.shape[1]}) != FAISS dimension ({dim})")
+    with SEARCH_STAGE_SECONDS.time("robust_faiss_search"):
+        distances, indices = searcher.search(embeddings, min(SEARCH_TOP_K, ntotal))
+    return [(image_id, score) for image_id, score in fuse_scores(distances, indices, fusion)
+            if score >= threshold]
 
-def search_image(image_input, threshold=0.78):
+def search_image(image_input, threshold=0.78, image_bytes=None, robust=False, platforms=None):
     """
     Takes an uploaded image (PIL Image or file path), generates OpenCLIP embedding,
     searches the FAISS index for the 5 nearest neighbors, applies the threshold,
     and returns a structured JSON-like dict with SAFE or FOUND status.
+    If the raw upload bytes are given, repeat uploads are answered from the result cache
+    and exact (SHA-256) and perceptual-hash matches without running CLIP at all.
+    With `robust`, crops and flips of the upload are searched together and their scores
+    fused (see _robust_search), which catches cropped, mirrored or framed reposts.
+    With `platforms`, only sources on those platforms are returned; FOUND responses also
+    count their sources per platform.
     """
     logger.info("Received user image")
     
-    # 1. Load FAISS index
-    if not os.path.exists(FAISS_INDEX_PATH):
-        logger.error(f"FAISS index file not found at {FAISS_INDEX_PATH}")
-        raise FileNotFoundError(f"faiss.index file does not exist at {FAISS_INDEX_PATH}")
-        
-    logger.info("Loading FAISS index...")
-    t0 = time.time()
-    faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-    t_load = time.time() - t0
+    cache = get_result_cache()
+    version = cache.version() if cache.enabled else None
+    file_hash = hashlib.sha256(image_bytes).hexdigest() if image_bytes is not None else None
+    # Robust and standard results for the same upload differ, so they are cached apart
+    platforms = tuple(sorted(set(platforms))) if platforms else None
+    cache_key = (file_hash, threshold, robust, platforms)
     
-    logger.info("FAISS index loaded successfully")
-    print("Total vectors in FAISS:", faiss_index.ntotal)
-    logger.info(f"Time to load FAISS: {t_load:.4f}s")
+    # Repeat upload of the same file against the same index and metadata
+    if file_hash is not None:
+        cached = cache.get("sha256", cache_key, version)
+        if cached is not None:
+            logger.info("Result cache hit (sha256)")
+            return cached
     
-    if faiss_index.ntotal == 0:
+    # Decode once up front; the hash fast path and CLIP preprocessing share the pixels
+    if isinstance(image_input, Image.Image):
+        try:
+            with SEARCH_STAGE_SECONDS.time("decode"):
+                image_input.load()
+        except Exception as e:
+            logger.error(f"Failed to decode upload: {e}")
+            raise ValueError("Could not decode the uploaded image")
+    
+    # 0. Exact / near-exact match fast path
+    try:
+        with SEARCH_STAGE_SECONDS.time("hash_lookup"):
+            exact_match = _find_exact_match(image_input, file_hash)
+    except Exception as e:
+        logger.error(f"Hash lookup failed: {e}")
+        exact_match = None
+        
+    if exact_match is not None:
+        return _respond([exact_match], cache, version, file_hash and cache_key, platforms=platforms)
+    
+    # 1. Get the resident FAISS index or shards (loaded once, hot-reloaded when the files change)
+    try:
+        ntotal, _ = get_searcher().info()
+    except FileNotFoundError:
+        logger.error(f"FAISS index file not found at {FAISS_INDEX_PATH}")
+        raise
+        
+    if ntotal == 0:
         logger.warning("FAISS index is empty.")
         logger.info("Search completed")
         return {"status": "SAFE"}
-        
-    # 2 & 3. Accept User Image & Generate Query Embedding
-    logger.info("Generating CLIP embedding...")
-    t1 = time.time()
-    generator = get_generator()
-    embedding = generator.generate_embedding(image_input)
-    t_embed = time.time() - t1
-    logger.info(f"Time to generate embedding: {t_embed:.4f}s")
     
-    if embedding is None:
-        logger.error("Failed to generate embedding.")
-        raise ValueError("Failed to generate embedding for the uploaded image")
+    if robust:
+        try:
+            scored_ids = _robust_search(image_input, threshold)
+        except ValueError as e:
+            logger.error(str(e))
+            raise
+        except Exception as e:
+            logger.error(f"Failed to generate embeddings: {e}")
+            raise ValueError("Failed to generate embeddings for the uploaded image")
+        return _respond(scored_ids, cache, version, file_hash and cache_key, platforms=platforms)
         
-    logger.info(f"Embedding vector shape: [{len(embedding)}]")
+    # 2, 3 & 4. Generate Query Embedding and Perform Similarity Search.
+    # Concurrent uploads are micro-batched into one forward pass and one FAISS search.
+    # Stage latencies (preprocess, embed, faiss_search) are recorded by the batcher.
+    # A re-encoded copy of a recently searched picture is answered by the embedding tier
+    # of the result cache right after the forward pass, skipping FAISS and metadata.
+    embedding_hit = {}
+    def lookup(embedding):
+        embedding_hit["response"] = cache.get("embedding", (embedding_key(embedding), threshold, platforms), version)
+        return embedding_hit["response"] is not None
     
-    if len(embedding) != faiss_index.d:
-        error_msg = f"Embedding dimension ({len(embedding)}) != FAISS dimension ({faiss_index.d})"
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-        
-    query_vector = np.array([embedding], dtype=np.float32)
+    try:
+        embedding, distances, indices = get_query_batcher().search(
+            image_input, lookup=lookup if cache.embedding_tier else None
+        )
+    except ValueError as e:
+        logger.error(str(e))
+        raise
+    except Exception as e:
+        logger.error(f"Failed to generate embedding: {e}")
+        raise ValueError("Failed to generate embedding for the uploaded image")
     
-    # 4. Perform Similarity Search
-    logger.info("Performing FAISS search...")
-    t2 = time.time()
+    if distances is None:
+        logger.info("Result cache hit (embedding)")
+        response = embedding_hit["response"]
+        if file_hash is not None:
+            cache.put("sha256", cache_key, response, version)
+        return response
     
-    # Increase Search Neighbors from k=1 to k=5
     # For IndexFlatIP, distances are dot products descending (higher = more similar)
-    k = min(5, faiss_index.ntotal)
-    distances, indices = faiss_index.search(query_vector, k=k)
-    t_search = time.time() - t2
-    logger.info(f"Time to search: {t_search:.4f}s")
+    k = len(indices)
     
-    # distances[0] and indices[0] contain the top-k results
+    # distances and indices contain the top-k results for this image
+    scored_ids = [(int(indices[i]), float(distances[i])) for i in range(k) if float(distances[i]) >= threshold]
+    return _respond(scored_ids, cache, version, file_hash and cache_key, platforms=platforms,
+                    embedding_cache_key=(embedding_key(embedding), threshold, platforms))
+
+def _respond(scored_ids, cache, version, cache_key=None, platforms=None, embedding_cache_key=None):
+    """
+    Fetches metadata for the thresholded matches, builds the SAFE / FOUND response and
+    stores it in the result cache tiers it has keys for.
+    """
     matches = []
-    
+    platform_counts = {}
+    cacheable = True
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        for i in range(k):
-            score = float(distances[0][i])
-            match_id = int(indices[0][i])
-            
-            if score >= threshold:
-                cursor.execute("SELECT source_url, file_path FROM images WHERE id = ?", (match_id,))
-                row = cursor.fetchone()
-                
-                source_url = row[0] if row else "Unknown Source"
-                file_path = row[1] if row else None
-                
-                # Mock Vulnerability Assessment Logic
-                # In a real scenario, this would rely on a threat intelligence API or domain analysis
-                vuln_score = 0
-                vuln_level = "Low"
-                vuln_desc = "Standard public profile. Low risk of impersonation."
-                
-                if "facebook.com" in source_url:
-                    vuln_score = 45
-                    vuln_level = "Medium"
-                    vuln_desc = "Found on public social media. Potential for unauthorized cloning."
-                elif "twitter.com" in source_url:
-                    vuln_score = 65
-                    vuln_level = "High"
-                    vuln_desc = "Found on microblogging site. High risk of rapid viral dissemination."
-                elif "reddit.com" in source_url:
-                    vuln_score = 85
-                    vuln_level = "Critical"
-                    vuln_desc = "Found on anonymous forum. High risk of malicious manipulation."
-                elif "instagram.com" in source_url:
-                    vuln_score = 30
-                    vuln_level = "Low"
-                    vuln_desc = "Found on visual platform. Monitor for unauthorized commercial use."
-                
-                matches.append({
-                    "similarity": round(score, 4),
-                    "source_url": source_url,
-                    "file_path": file_path,
-                    "vulnerability": {
-                        "score": vuln_score,
-                        "level": vuln_level,
-                        "description": vuln_desc
-                    }
-                })
-                
-        conn.close()
+        with SEARCH_STAGE_SECONDS.time("metadata_fetch"):
+            matches = _fetch_matches(scored_ids, platforms=platforms)
+            if matches:
+                platform_counts = get_metadata_store().platform_counts(
+                    (image_id for image_id, _ in scored_ids), platforms
+                )
     except Exception as e:
         logger.error(f"Error fetching metadata: {e}")
+        cacheable = False
         
     logger.info("Search completed")
     
     if len(matches) > 0:
         logger.info(f"Found {len(matches)} valid matches above threshold")
-        return {
+        response = {
             "status": "FOUND",
-            "matches": matches
+            "matches": matches,
+            "platforms": platform_counts
         }
     else:
-        return {
+        response = {
             "status": "SAFE"
         }
+    
+    if cacheable:
+        if embedding_cache_key is not None:
+            cache.put("embedding", embedding_cache_key, response, version)
+        if cache_key:
+            cache.put("sha256", cache_key, response, version)
+    return response
 
+def _decode_upload(image_bytes):
+    """
+    Header check plus reduced-scale decode of one uploaded file.
+    """
+    image = open_image(io.BytesIO(image_bytes), min_side=PREPROCESS_MIN_SIDE)
+    image.load()
+    return image
+
+def _try(fn, *args):
+    """
+    Runs fn on the bulk pool's thread and returns (result, None) or (None, error message).
+    """
+    try:
+        return fn(*args), None
+    except Exception as e:
+        return None, str(e)
+
+def search_batch(items, threshold=0.78, platforms=None):
+    """
+    Bulk variant of search_image for [(name, image_bytes), ...].
+    
+    Images are decoded and preprocessed in parallel, exact / perceptual-hash matches are
+    answered directly, and the rest go through one forward pass and one matrix search over
+    the index, followed by a single metadata lookup and a single per-platform GROUP BY for
+    the whole batch. Returns one dict per item in input order: {"name": ...} plus the same
+    status / matches / platforms structure as search_image (including the `platforms`
+    filter), or status ERROR with a message for files that could not be read.
+    """
+    results = [None] * len(items)
+    names = [name for name, _ in items]
+    
+    # 1. Decode in parallel
+    with SEARCH_STAGE_SECONDS.time("bulk_decode"):
+        decoded = list(_bulk_pool.map(lambda item: _try(_decode_upload, item[1]), items))
+    
+    # 2. Hash fast path; everything else needs CLIP
+    scored = {}
+    pending = []
+    with SEARCH_STAGE_SECONDS.time("bulk_hash_lookup"):
+        for i, ((image, error), (name, image_bytes)) in enumerate(zip(decoded, items)):
+            if error is not None:
+                results[i] = {"name": name, "status": "ERROR", "message": f"Could not decode image: {error}"}
+                continue
+            try:
+                exact_match = _find_exact_match(image, hashlib.sha256(image_bytes).hexdigest())
+            except Exception as e:
+                logger.error(f"Hash lookup failed for {name}: {e}")
+                exact_match = None
+            if exact_match is not None:
+                scored[i] = [exact_match]
+            else:
+                pending.append(i)
+    
+    # 3. One forward pass and one matrix search for the rest
+    if pending:
+        ntotal, dim = get_searcher().info()
+        if ntotal == 0:
+            for i in pending:
+                scored[i] = []
+        else:
+            generator = get_generator()
+            with SEARCH_STAGE_SECONDS.time("bulk_preprocess"):
+                batch_tensor, valid = generator.preprocess_batch([decoded[i][0] for i in pending], _bulk_pool)
+            valid_set = set(valid)
+            for j, i in enumerate(pending):
+                if j not in valid_set:
+                    results[i] = {"name": names[i], "status": "ERROR", "message": "Could not preprocess image"}
+            
+            if valid:
+                with SEARCH_STAGE_SECONDS.time("bulk_embed"):
+                    embeddings = generator.encode_tensors(batch_tensor)
+                if embeddings.shape[1] != dim:
+                    raise ValueError(f"Embedding dimension ({embeddings.shape[1]}) != FAISS dimension ({dim})")
+                with SEARCH_STAGE_SECONDS.time("bulk_faiss_search"):
+                    distances, indices = get_searcher().search(embeddings, min(SEARCH_TOP_K, ntotal))
+                for row, j in enumerate(valid):
+                    scored[pending[j]] = [(int(image_id), float(score))
+                                          for image_id, score in zip(indices[row], distances[row])
+                                          if image_id >= 0 and score >= threshold]
+    
+    # 4. One metadata lookup and one platform aggregation for every match in the batch
+    with SEARCH_STAGE_SECONDS.time("bulk_metadata_fetch"):
+        store = get_metadata_store()
+        matched_ids = [image_id for scored_ids in scored.values() for image_id, _ in scored_ids]
+        rows_by_id = store.get_many(matched_ids, platforms)
+        counts_by_id = store.platform_counts_by_image(matched_ids, platforms) if matched_ids else {}
+        for i, scored_ids in scored.items():
+            matches = _fetch_matches(scored_ids, rows_by_id, platforms)
+            if matches:
+                platform_counts = {}
+                for image_id in dict.fromkeys(image_id for image_id, _ in scored_ids):
+                    for platform, count in counts_by_id.get(image_id, {}).items():
+                        platform_counts[platform] = platform_counts.get(platform, 0) + count
+                results[i] = {"name": names[i], "status": "FOUND", "matches": matches,
+                              "platforms": platform_counts}
+            else:
+                results[i] = {"name": names[i], "status": "SAFE"}
+    
+    logger.info(f"Bulk search completed: {len(items)} images, {len(pending)} embedded")
+    return results
@@ -0,0 +1,126 @@
+import os
+
+# Define the absolute paths dynamically based on the project root.
+# Each can be pointed elsewhere (a scratch database for benchmarks, a data volume) via the environment.
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.environ.get("DB_PATH", os.path.join(PROJECT_ROOT, 'data', 'sqlite_db', 'metadata.db'))
+RAW_IMAGES_DIR = os.environ.get("RAW_IMAGES_DIR", os.path.join(PROJECT_ROOT, 'data', 'raw_images'))
+FAISS_INDEX_PATH = os.environ.get("FAISS_INDEX_PATH", os.path.join(PROJECT_ROOT, 'vector_index', 'faiss.index'))
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+# How often (seconds) the in-memory index checks faiss.index for a newer generation
+INDEX_RELOAD_INTERVAL = _env_float("INDEX_RELOAD_INTERVAL", 2.0)
+
+# Batched embedding: images per forward pass and decode/preprocess worker threads
+EMBED_BATCH_SIZE = _env_int("EMBED_BATCH_SIZE", 32)
+EMBED_WORKERS = _env_int("EMBED_WORKERS", 4)
+
+# Query micro-batching for /search-image: collection window, max images per batch, neighbours per query
+SEARCH_BATCH_WINDOW_MS = _env_float("SEARCH_BATCH_WINDOW_MS", 5.0)
+SEARCH_MAX_BATCH_SIZE = _env_int("SEARCH_MAX_BATCH_SIZE", 16)
+SEARCH_TOP_K = _env_int("SEARCH_TOP_K", 5)
+
+# Search executor: worker threads and how many extra requests may wait before /search-image returns 503
+SEARCH_WORKERS = _env_int("SEARCH_WORKERS", 16)
+SEARCH_QUEUE_SIZE = _env_int("SEARCH_QUEUE_SIZE", 64)
+
+# Incremental indexing: rows per chunk (embed + index add), and how much the index must grow
+# (fraction of its size at the last checkpoint, at least one chunk) before it is written out again
+INDEX_CHUNK_SIZE = _env_int("INDEX_CHUNK_SIZE", 512)
+INDEX_CHECKPOINT_GROWTH = _env_float("INDEX_CHECKPOINT_GROWTH", 0.25)
+
+# Approximate index tuning: IVF lists probed and HNSW candidate list size per query, training sample size
+INDEX_NPROBE = _env_int("INDEX_NPROBE", 16)
+INDEX_EF_SEARCH = _env_int("INDEX_EF_SEARCH", 64)
+INDEX_TRAIN_SAMPLE = _env_int("INDEX_TRAIN_SAMPLE", 100000)
+
+# Perceptual-hash deduplication: max Hamming distance (of 64 bits) for pHash and dHash to count as
+# a near-duplicate at ingest, and to return FOUND at query time without running CLIP
+NEAR_DUPLICATE_DISTANCE = _env_int("NEAR_DUPLICATE_DISTANCE", 6)
+PHASH_MATCH_DISTANCE = _env_int("PHASH_MATCH_DISTANCE", 2)
+
+# CLIP model used for every embedding; also the key of the persistent embedding store
+CLIP_MODEL_NAME = os.environ.get("CLIP_MODEL_NAME", "ViT-B-32")
+CLIP_PRETRAINED = os.environ.get("CLIP_PRETRAINED", "laion2b_s34b_b79k")
+
+# Persistent content-addressed embedding store (one sub-directory per model), stored as float32 or float16
+EMBEDDING_STORE_DIR = os.environ.get("EMBEDDING_STORE_DIR", os.path.join(PROJECT_ROOT, 'data', 'embeddings'))
+EMBEDDING_STORE_DTYPE = os.environ.get("EMBEDDING_STORE_DTYPE", "float32")
+
+# Sharding: number of index shards (1 = single faiss.index), where shard files live,
+# and how many searches each shard worker process runs at once
+INDEX_NUM_SHARDS = _env_int("INDEX_NUM_SHARDS", 1)
+SHARD_DIR = os.environ.get("SHARD_DIR", os.path.join(PROJECT_ROOT, 'vector_index', 'shards'))
+SHARD_SEARCH_THREADS = _env_int("SHARD_SEARCH_THREADS", 4)
+
+# Scraper: pooled connections, per-host concurrency and requests/sec, retries, timeout (s), max image size
+SCRAPER_MAX_CONNECTIONS = _env_int("SCRAPER_MAX_CONNECTIONS", 64)
+SCRAPER_PER_HOST_CONCURRENCY = _env_int("SCRAPER_PER_HOST_CONCURRENCY", 4)
+SCRAPER_PER_HOST_RATE = _env_float("SCRAPER_PER_HOST_RATE", 10.0)
+SCRAPER_RETRIES = _env_int("SCRAPER_RETRIES", 3)
+SCRAPER_TIMEOUT = _env_float("SCRAPER_TIMEOUT", 20.0)
+SCRAPER_MAX_IMAGE_BYTES = _env_int("SCRAPER_MAX_IMAGE_BYTES", 25 * 1024 * 1024)
+
+# Seeding: hashing worker threads
+SEED_WORKERS = _env_int("SEED_WORKERS", min(32, (os.cpu_count() or 1) + 4))
+
+# Search metadata: keep an in-memory id -> (source_url, file_path) cache instead of querying SQLite (1/0)
+METADATA_CACHE = bool(_env_int("METADATA_CACHE", 1))
+
+# CLIP weights checkpoint cache, and whether the API loads and warms up the model and index at startup (1/0)
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", os.path.join(PROJECT_ROOT, 'data', 'models'))
+WARMUP_ON_STARTUP = bool(_env_int("WARMUP_ON_STARTUP", 1))
+
+# CLIP image encoder backend: torch (fp32 reference), int8 (dynamic quantization), torchscript or onnx
+CLIP_BACKEND = os.environ.get("CLIP_BACKEND", "torch")
+
+# Image preprocessing: fast reduced-scale decode path (1/0), minimum shorter side kept when decoding
+# at reduced scale, and the largest image (in pixels) accepted before decoding
+PREPROCESS_FAST = bool(_env_int("PREPROCESS_FAST", 1))
+PREPROCESS_MIN_SIDE = _env_int("PREPROCESS_MIN_SIDE", 448)
+MAX_IMAGE_PIXELS = _env_int("MAX_IMAGE_PIXELS", 50_000_000)
+
+# Bulk search (/search-images): max images per request, images per forward pass / FAISS search,
+# max size of one file (or archive member)
+BULK_MAX_IMAGES = _env_int("BULK_MAX_IMAGES", 1000)
+BULK_BATCH_SIZE = _env_int("BULK_BATCH_SIZE", 32)
+BULK_MAX_FILE_BYTES = _env_int("BULK_MAX_FILE_BYTES", 25 * 1024 * 1024)
+
+# Indexing pipeline: max items waiting between stages (decode -> embed -> add -> commit)
+INDEX_QUEUE_SIZE = _env_int("INDEX_QUEUE_SIZE", 4)
+
+# Compressed indexes (sq_fp16 / sq8 / pq / ivf_pq): fetch top_k * factor candidates and re-rank them with
+# the full-precision vectors from the embedding store (0 disables the re-rank)
+INDEX_RERANK_FACTOR = _env_int("INDEX_RERANK_FACTOR", 4)
+
+# Serving: memory-map flat / IVF index files so worker processes share one copy (1/0), and how many
+# published index generations (vector_index/generations) to keep on disk
+INDEX_MMAP = bool(_env_int("INDEX_MMAP", 1))
+INDEX_KEEP_GENERATIONS = _env_int("INDEX_KEEP_GENERATIONS", 3)
+
+# Takedowns: extra neighbours fetched per query while tombstones exist (so top-k stays full), and the
+# share of tombstoned rows at which a background compaction rebuilds the index and deletes them
+TOMBSTONE_OVERFETCH = _env_int("TOMBSTONE_OVERFETCH", 10)
+TOMBSTONE_COMPACT_RATIO = _env_float("TOMBSTONE_COMPACT_RATIO", 0.05)
+# Seconds that ids removed by compaction stay filtered, while API workers and shard processes
+# still serve the previous index generation (must exceed INDEX_RELOAD_INTERVAL plus a reload)
+TOMBSTONE_RETIRE_SECONDS = _env_float("TOMBSTONE_RETIRE_SECONDS", 3600)
+
+# Search result cache: memory budget in bytes (0 disables it), entry lifetime (s), and whether
+# re-encoded copies of a picture are also looked up by their query embedding (1/0)
+RESULT_CACHE_MAX_BYTES = _env_int("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+RESULT_CACHE_TTL = _env_float("RESULT_CACHE_TTL", 600.0)
+RESULT_CACHE_EMBEDDING_TIER = bool(_env_int("RESULT_CACHE_EMBEDDING_TIER", 1))
+
+# Robust (multi-crop / flip) search: share of each side kept by the corner and center crops,
+# and how the per-view scores of an image are fused ("max" or "mean")
+ROBUST_CROP_FRACTION = _env_float("ROBUST_CROP_FRACTION", 0.8)
+ROBUST_FUSION = os.environ.get("ROBUST_FUSION", "max")
@@ -1,19 +1,63 @@
 import sqlite3
 import os
 
-# Define the absolute path to the database file dynamically based on the project root
-PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-DB_PATH = os.path.join(PROJECT_ROOT, 'data', 'sqlite_db', 'metadata.db')
+from services.config import DB_PATH
 
-def initialize_database():
+# Columns added after the original schema. ensure_schema() adds any that an
+# existing database is missing, so older metadata.db files keep working.
+ADDED_IMAGE_COLUMNS = [
+    ("phash", "INTEGER"),          # 64-bit perceptual (DCT) hash, stored signed
+    ("dhash", "INTEGER"),          # 64-bit difference hash, stored signed
+    ("duplicate_of", "INTEGER"),   # id of the canonical near-duplicate; never embedded
+    ("deleted_at", "REAL"),        # takedown tombstone (unix time); row and file removed by compaction
+    ("host", "TEXT"),              # lower-cased host of source_url, parsed at ingest
+    ("platform", "TEXT"),          # platform of that host (query/result_mapper.py registry)
+]
+
+# Secondary indexes. hash already has the implicit index of its UNIQUE constraint.
+IMAGE_INDEXES = [
+    # Pipeline scans: WHERE indexed = 0 AND duplicate_of IS NULL AND id > ? ORDER BY id
+    ("idx_images_indexed", "images (indexed, duplicate_of, id)"),
+    # Search results: every near-duplicate collapsed onto a matched image
+    ("idx_images_duplicate_of", "images (duplicate_of)"),
+    # Tombstone loads: only the (few) deleted rows are in this partial index
+    ("idx_images_deleted", "images (deleted_at) WHERE deleted_at IS NOT NULL"),
+    # Platform filters and per-platform aggregates; host for per-site lookups
+    ("idx_images_platform", "images (platform, id)"),
+    ("idx_images_host", "images (host)"),
+]
+
+def ensure_schema(conn):
+    """
+    Bring an existing images table up to date with ADDED_IMAGE_COLUMNS and IMAGE_INDEXES,
+    and switch the database to WAL so search readers never block the writers.
+    """
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(images)")}
+    for column, column_type in ADDED_IMAGE_COLUMNS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE images ADD COLUMN {column} {column_type}")
+    for index_name, definition in IMAGE_INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {definition}")
+    # Ids whose rows compaction deleted; searches keep excluding them until every reader
+    # has reloaded the index without them (ids are AUTOINCREMENT, so never reused)
+    conn.execute("CREATE TABLE IF NOT EXISTS retired_images (id INTEGER PRIMARY KEY, retired_at REAL NOT NULL)")
+    conn.commit()
+    if "platform" not in existing:
+        # Imported here: the parser lives with the ingestion code, which imports this module
+        from ingestion.metadata_builder import backfill_sources
+        backfill_sources(conn)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.commit()
+
+def initialize_database(db_path=DB_PATH):
     """
     Initialize the SQLite database and create the images table if it does not exist.
     """
     # Ensure the directory exists
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
     
     # Connect to the database (creates it if it doesn't exist)
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
     
     # Create the main table
@@ -29,4 +73,5 @@ def initialize_database():
     ''')
     
     conn.commit()
+    ensure_schema(conn)
     conn.close()
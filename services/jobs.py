@@ -0,0 +1,138 @@
+import time
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger("jobs")
+
+# Finished jobs kept for status queries
+MAX_FINISHED_JOBS = 50
+
+
+class JobAlreadyRunningError(RuntimeError):
+    """
+    Raised when a job of the same kind is still queued or running (single flight).
+    """
+    def __init__(self, job):
+        super().__init__(f"A {job.kind} job is already {job.status} ({job.id})")
+        self.job = job
+
+
+class Job:
+    """
+    One background run: id, status, latest progress snapshot and final result or error.
+    Status moves queued -> running -> completed | failed | cancelled.
+    """
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "queued"
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("completed", "failed", "cancelled")
+
+    def update_progress(self, progress):
+        self.progress = progress
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "cancel_requested": self.cancel_event.is_set(),
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class JobManager:
+    """
+    Runs long tasks (indexing) on background threads so API requests return immediately.
+
+    At most one job per kind is active at a time. The task is called as
+    fn(cancel_event=..., progress=..., **kwargs) and should stop early once the event is
+    set and report progress snapshots through the callback.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._active = {}
+
+    def start(self, kind, fn, **kwargs):
+        """
+        Starts a job and returns it, or raises JobAlreadyRunningError with the active one.
+        """
+        with self._lock:
+            active = self._active.get(kind)
+            if active is not None and not active.finished:
+                raise JobAlreadyRunningError(active)
+            job = Job(kind)
+            self._jobs[job.id] = job
+            self._active[kind] = job
+            self._prune()
+        thread = threading.Thread(target=self._run, args=(job, fn, kwargs), name=f"job-{kind}", daemon=True)
+        thread.start()
+        return job
+
+    def _run(self, job, fn, kwargs):
+        job.status = "running"
+        job.started_at = time.time()
+        try:
+            job.result = fn(cancel_event=job.cancel_event, progress=job.update_progress, **kwargs)
+            job.status = "cancelled" if job.cancel_event.is_set() else "completed"
+        except Exception as e:
+            logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+            job.error = str(e)
+            job.status = "failed"
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if self._active.get(job.kind) is job:
+                    del self._active[job.kind]
+
+    def _prune(self):
+        finished = sorted((job for job in self._jobs.values() if job.finished), key=lambda job: job.created_at)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return sorted(jobs, key=lambda job: job.created_at, reverse=True)
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation; the job stops after the work already in flight is committed.
+        Returns the job, or None if it does not exist.
+        """
+        job = self._jobs.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel_event.set()
+        return job
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_job_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = JobManager()
+    return _manager
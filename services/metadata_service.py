@@ -0,0 +1,358 @@
+import os
+import sys
+import sqlite3
+import logging
+import threading
+import numpy as np
+
+# Add the project root to the Python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import DB_PATH, METADATA_CACHE
+
+# Stay well below SQLite's host-parameter limit (999 on older builds); ids are bound twice per query
+MAX_IN_PARAMS = 400
+
+logger = logging.getLogger("metadata_service")
+
+
+def _grouped(rows):
+    """
+    Groups (id, duplicate_of, source_url, file_path, platform) rows ordered by id into
+    {canonical_id: [(source_url, file_path, platform), ...]}.
+    """
+    groups = {}
+    for image_id, duplicate_of, source_url, file_path, platform in rows:
+        groups.setdefault(duplicate_of or image_id, []).append((source_url, file_path, platform))
+    return groups
+
+
+class StringColumn:
+    """
+    Immutable column of optional strings packed into one UTF-8 buffer plus int64 offsets,
+    instead of one Python str object (~50 bytes of overhead each) per value.
+    """
+    def __init__(self, values):
+        encoded = [value.encode("utf-8") if value is not None else b"" for value in values]
+        self.buffer = b"".join(encoded)
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=self.offsets[1:])
+        self.null = np.fromiter((value is None for value in values), dtype=bool, count=len(values))
+
+    def __len__(self):
+        return len(self.null)
+
+    def __getitem__(self, i):
+        if self.null[i]:
+            return None
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def nbytes(self):
+        return len(self.buffer) + self.offsets.nbytes + self.null.nbytes
+
+
+class CodedColumn:
+    """
+    Column of a few distinct strings (e.g. platforms) stored as int16 codes into a name table.
+    """
+    def __init__(self, values):
+        self.names = sorted({value for value in values if value is not None})
+        lookup = {name: code for code, name in enumerate(self.names)}
+        self.codes = np.fromiter((lookup.get(value, -1) for value in values), dtype=np.int16, count=len(values))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        code = self.codes[i]
+        return self.names[code] if code >= 0 else None
+
+    def nbytes(self):
+        return self.codes.nbytes
+
+
+class MetadataTable:
+    """
+    One immutable build of the metadata cache. Canonical ids are kept in a sorted int64
+    array; each one points at a contiguous run of rows (itself first, then its collapsed
+    near-duplicates) in the source_url, file_path and platform columns.
+    """
+    def __init__(self, rows):
+        ids, starts, source_urls, file_paths, platforms = [], [], [], [], []
+        for canonical, source_url, file_path, platform in rows:
+            if not ids or ids[-1] != canonical:
+                ids.append(canonical)
+                starts.append(len(source_urls))
+            source_urls.append(source_url)
+            file_paths.append(file_path)
+            platforms.append(platform)
+        starts.append(len(source_urls))
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.source_urls = StringColumn(source_urls)
+        self.file_paths = StringColumn(file_paths)
+        self.platforms = CodedColumn(platforms)
+
+    def get_many(self, image_ids):
+        results = {}
+        if len(self.ids) == 0:
+            return results
+        wanted = np.asarray(list(image_ids), dtype=np.int64)
+        positions = np.searchsorted(self.ids, wanted)
+        for image_id, position in zip(wanted.tolist(), positions.tolist()):
+            if position < len(self.ids) and self.ids[position] == image_id:
+                start, end = int(self.starts[position]), int(self.starts[position + 1])
+                results[image_id] = [(self.source_urls[row], self.file_paths[row], self.platforms[row])
+                                     for row in range(start, end)]
+        return results
+
+    def nbytes(self):
+        return (self.ids.nbytes + self.starts.nbytes + self.source_urls.nbytes()
+                + self.file_paths.nbytes() + self.platforms.nbytes())
+
+    def __len__(self):
+        return len(self.source_urls)
+
+
+class MetadataCache:
+    """
+    Compact in-memory copy of id -> [(source_url, file_path, platform), ...] for every
+    canonical image (see MetadataTable): a lookup is one np.searchsorted and a slice.
+
+    After another connection commits (e.g. the indexing pipeline checkpointing a chunk),
+    the table is rebuilt on a background thread and swapped in (see BackgroundSnapshot).
+    While a rebuild is pending get_many() returns None and the store answers from SQL, so
+    results are never stale and the request path never re-reads the whole table.
+    """
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._snapshot = BackgroundSnapshot(db_path, self._build, "metadata-cache")
+
+    def _build(self, conn):
+        return MetadataTable(conn.execute(
+            "SELECT COALESCE(duplicate_of, id) AS canonical, source_url, file_path, platform FROM images "
+            "WHERE deleted_at IS NULL ORDER BY canonical, id"
+        ))
+
+    def get_many(self, image_ids):
+        """
+        Returns {image_id: [(source_url, file_path, platform), ...]} for the ids that exist,
+        or None if the database has changed since the last build.
+        """
+        table, current = self._snapshot.get()
+        if not current:
+            return None
+        return table.get_many(image_ids)
+
+    def nbytes(self):
+        return self._snapshot.get()[0].nbytes()
+
+    def __len__(self):
+        return len(self._snapshot.get()[0])
+
+
+def _platform_clause(platforms):
+    """
+    SQL fragment and parameters restricting a query to the given platforms (none: no filter).
+    """
+    if not platforms:
+        return "", []
+    platforms = sorted(set(platforms))
+    return f" AND platform IN ({','.join('?' * len(platforms))})", platforms
+
+
+class BackgroundSnapshot:
+    """
+    An in-memory structure built from the database by `build(conn)` and rebuilt on a
+    background thread after another connection has committed (PRAGMA data_version).
+
+    get() never waits for a rebuild: it returns the last finished build and whether that
+    build is still current, and callers decide how to treat a stale one. Only the very
+    first build runs on the caller. At most one rebuild runs at a time; commits that land
+    during a rebuild trigger another one on the next get().
+    """
+    def __init__(self, db_path, build, name):
+        self.db_path = db_path
+        self.build = build
+        self.name = name
+        self._conn = None
+        self._build_conn = None
+        self._lock = threading.Lock()
+        self._first_build_lock = threading.Lock()
+        self._value = None
+        self._version = None
+        self._building = False
+
+    def _data_version(self):
+        # Versions are only comparable within one connection, so all checks use this one
+        if self._conn is None:
+            self._conn = connect_readonly(self.db_path, check_same_thread=False)
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _build(self):
+        if self._build_conn is None:
+            self._build_conn = connect_readonly(self.db_path, check_same_thread=False)
+        return self.build(self._build_conn)
+
+    def get(self):
+        """
+        Returns (value, current). `current` is False while a rebuild is pending or running.
+        """
+        with self._lock:
+            version = self._data_version()
+            if self._value is not None:
+                current = version == self._version
+                if not current and not self._building:
+                    self._building = True
+                    threading.Thread(target=self._rebuild, args=(version,), name=f"{self.name}-rebuild",
+                                     daemon=True).start()
+                return self._value, current
+        with self._first_build_lock:
+            if self._value is None:
+                value = self._build()
+                with self._lock:
+                    self._value, self._version = value, version
+        return self.get()
+
+    def _rebuild(self, version):
+        try:
+            # The version was read before the build started, so a commit during the build
+            # leaves it stale and the next get() schedules another rebuild
+            value = self._build()
+            with self._lock:
+                self._value, self._version = value, version
+        except Exception as e:
+            logger.warning(f"Rebuilding {self.name} failed: {e}")
+        finally:
+            self._building = False
+
+
+def connect_readonly(db_path=DB_PATH, check_same_thread=True):
+    """
+    Opens a read-only connection. Writers put the database in WAL mode (see
+    db_service.ensure_schema), so readers never block the indexing pipeline or the scraper.
+    """
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=check_same_thread)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class MetadataStore:
+    """
+    Read side of the images table used by search.
+
+    Each thread reuses one pooled read-only connection instead of opening a new one per
+    request, and all matched ids are fetched with a single IN (...) query. With
+    use_cache=True unfiltered lookups are served from a MetadataCache instead while it is
+    current; platform filters and per-platform counts always run in SQL on the indexed
+    platform column.
+    """
+    def __init__(self, db_path=DB_PATH, use_cache=METADATA_CACHE):
+        self.db_path = db_path
+        self._local = threading.local()
+        self.cache = MetadataCache(db_path) if use_cache else None
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect_readonly(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, image_ids, platforms=None):
+        """
+        Returns {image_id: [(source_url, file_path, platform), ...]} for each matched canonical
+        image together with every near-duplicate collapsed onto it at ingest, ordered by id.
+        Tombstoned (deleted) rows are left out, and with `platforms` so are rows from any
+        other platform (images with no row left are missing from the result).
+        """
+        image_ids = list(dict.fromkeys(int(image_id) for image_id in image_ids))
+        if not image_ids:
+            return {}
+        if self.cache is not None and not platforms:
+            results = self.cache.get_many(image_ids)
+            if results is not None:
+                return results
+
+        conn = self._connection()
+        platform_filter, platform_params = _platform_clause(platforms)
+        results = {}
+        for i in range(0, len(image_ids), MAX_IN_PARAMS):
+            chunk = image_ids[i:i + MAX_IN_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT id, duplicate_of, source_url, file_path, platform FROM images "
+                f"WHERE (id IN ({placeholders}) OR duplicate_of IN ({placeholders})) AND deleted_at IS NULL"
+                f"{platform_filter} ORDER BY id",
+                chunk + chunk + platform_params
+            )
+            results.update(_grouped(rows))
+        return results
+
+    def platform_counts(self, image_ids=None, platforms=None):
+        """
+        Returns {platform: number of rows}, over the matched images and their collapsed
+        near-duplicates, or over the whole (non-deleted) collection when image_ids is None.
+        """
+        conn = self._connection()
+        platform_filter, platform_params = _platform_clause(platforms)
+        if image_ids is None:
+            rows = conn.execute(
+                f"SELECT platform, COUNT(*) FROM images WHERE deleted_at IS NULL{platform_filter} "
+                f"GROUP BY platform",
+                platform_params
+            )
+            return dict(rows)
+
+        counts = {}
+        for image_counts in self.platform_counts_by_image(image_ids, platforms).values():
+            for platform, count in image_counts.items():
+                counts[platform] = counts.get(platform, 0) + count
+        return counts
+
+    def platform_counts_by_image(self, image_ids, platforms=None):
+        """
+        Returns {canonical_id: {platform: number of rows}} for the matched images and their
+        collapsed near-duplicates, in one GROUP BY per chunk of ids (bulk search).
+        """
+        image_ids = list(dict.fromkeys(int(image_id) for image_id in image_ids))
+        conn = self._connection()
+        platform_filter, platform_params = _platform_clause(platforms)
+        counts = {}
+        for i in range(0, len(image_ids), MAX_IN_PARAMS):
+            chunk = image_ids[i:i + MAX_IN_PARAMS]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT COALESCE(duplicate_of, id) AS canonical, platform, COUNT(*) FROM images "
+                f"WHERE (id IN ({placeholders}) OR duplicate_of IN ({placeholders})) AND deleted_at IS NULL"
+                f"{platform_filter} GROUP BY canonical, platform",
+                chunk + chunk + platform_params
+            )
+            for canonical, platform, count in rows:
+                counts.setdefault(canonical, {})[platform] = count
+        return counts
+
+    def find_by_hash(self, file_hash):
+        """
+        Returns the canonical image id for a SHA-256 content hash, or None.
+        """
+        row = self._connection().execute(
+            "SELECT id, duplicate_of FROM images WHERE hash = ? AND deleted_at IS NULL", (file_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        return row[1] or row[0]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_metadata_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = MetadataStore()
+    return _store
@@ -0,0 +1,170 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Latency buckets (seconds): sub-millisecond hash/metadata lookups up to multi-second CLIP batches
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    """
+    Latency histogram with one series per value of a single label (e.g. stage="embed").
+
+    observe() is a bisect plus three integer/float updates under a lock, so it is cheap
+    enough to call on every request; buckets are only made cumulative when rendered.
+    """
+    def __init__(self, name, documentation, label="stage", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        position = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    @contextmanager
+    def time(self, label_value):
+        """
+        Records the duration of the `with` block under `label_value`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label_value, time.perf_counter() - start)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for label_value, (counts, total, count) in sorted(snapshot.items()):
+            labels = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{_format_value(bound)}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {_format_value(total)}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+
+class Counter:
+    """
+    Monotonic counter with one series per value of a single label (e.g. result="sha256_hit").
+    """
+    def __init__(self, name, documentation, label="result"):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value):
+        return self._values.get(label_value, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        for label_value, value in snapshot:
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {_format_value(value)}')
+        return lines
+
+
+class Gauge:
+    """
+    Gauge whose value is read from a callback at scrape time, so the hot path never touches it.
+    """
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self):
+        try:
+            value = self.function()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(value)}"]
+
+
+def histogram(name, documentation, label="stage", buckets=DEFAULT_BUCKETS):
+    """
+    Returns the registered histogram `name`, creating it on first use.
+    """
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Histogram(name, documentation, label, buckets)
+        return metric
+
+
+def counter(name, documentation, label="result"):
+    """
+    Returns the registered counter `name`, creating it on first use.
+    """
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = Counter(name, documentation, label)
+        return metric
+
+
+def gauge(name, documentation, function):
+    """
+    Registers (or replaces) a callback gauge.
+    """
+    with _registry_lock:
+        metric = _registry[name] = Gauge(name, documentation, function)
+        return metric
+
+
+def render():
+    """
+    All registered metrics in the Prometheus text exposition format (version 0.0.4).
+    """
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Per-stage latency of /search-image: upload_read, decode, hash_lookup, preprocess, embed,
+# faiss_search, metadata_fetch. embed and faiss_search are observed once per micro-batch.
+# /search-images records the same stages prefixed with bulk_, once per batch.
+SEARCH_STAGE_SECONDS = histogram("search_stage_seconds", "Latency of each /search-image stage in seconds.")
+
+# Per-stage latency of the indexing pipeline: decode and embed (per batch), add (per chunk
+# and shard) and commit (index checkpoint per shard, then the DB flags per chunk)
+INDEXING_STAGE_SECONDS = histogram("indexing_stage_seconds", "Latency of each indexing pipeline stage in seconds.")
+
+# Search result cache lookups by tier and outcome: sha256_hit / sha256_miss / embedding_hit / embedding_miss
+RESULT_CACHE_LOOKUPS = counter("result_cache_lookups_total", "Search result cache lookups by tier and outcome.")
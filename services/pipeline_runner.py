@@ -1,24 +1,21 @@
 import os
 import sys
-import sqlite3
-import faiss
-import numpy as np
 
 # Add project root to python path
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
-from embedding.generate_embeddings import EmbeddingGenerator
+from vector_index.faiss_index import run_incremental_indexing, compact_index
+from services.config import DB_PATH, FAISS_INDEX_PATH
 
-DB_PATH = os.path.join(PROJECT_ROOT, 'data', 'sqlite_db', 'metadata.db')
-FAISS_INDEX_PATH = os.path.join(PROJECT_ROOT, 'vector_index', 'faiss.index')
-
-def run_indexing_pipeline():
+def run_indexing_pipeline(cancel_event=None, progress=None):
     """
     Controller function to handle loading unindexed images, 
     generating CLIP embeddings, updating the FAISS index, 
     and marking images as indexed in SQLite.
+    The work itself is done chunk by chunk by the crash-safe indexing engine;
+    `cancel_event` and `progress` are passed through so it can run as a background job.
     """
     # STEP 6 Logs 
     print("Loading images...")
@@ -27,66 +24,29 @@ def run_indexing_pipeline():
         print("Database not found at data/sqlite_db/metadata.db")
         return
         
-    # STEP 1: Connect to SQLite database.
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # STEP 2: Fetch all images that are NOT indexed
-    cursor.execute("SELECT id, file_path FROM images WHERE indexed = 0;")
-    unindexed_images = cursor.fetchall()
-    
-    if not unindexed_images:
-        print("No new images to index.")
-        print("Pipeline completed successfully")
-        conn.close()
-        return
-        
-    # STEP 6 Logs
-    print("Generating embeddings...")
-    generator = EmbeddingGenerator()
-    dim = generator.embedding_dim
-    
-    os.makedirs(os.path.dirname(FAISS_INDEX_PATH), exist_ok=True)
-    
-    # Initialize FAISS Index (IndexFlatIP for Cosine Similarity since embeddings are L2 normalized)
-    if os.path.exists(FAISS_INDEX_PATH):
-        faiss_index = faiss.read_index(FAISS_INDEX_PATH)
-    else:
-        base_index = faiss.IndexFlatIP(dim)
-        faiss_index = faiss.IndexIDMap(base_index)
-        
-    # STEP 6 Logs
+    # STEPS 1-5: Fetch unindexed images, embed, add to FAISS, checkpoint, mark indexed
     print("Building FAISS index...")
-    
-    # STEP 3: For each image load, embed, add to FAISS
-    for image_id, file_path in unindexed_images:
-        if not os.path.exists(file_path):
-            print(f"Warning: Missing file at {file_path}")
-            continue
-            
-        embedding = generator.generate_embedding(file_path)
-        if embedding is None:
-            continue
-            
-        vector = np.array([embedding], dtype=np.float32)
-        idx_array = np.array([image_id], dtype=np.int64)
-        
-        faiss_index.add_with_ids(vector, idx_array)
-        
-        # STEP 4: Update database
-        try:
-            cursor.execute("UPDATE images SET indexed = 1 WHERE id = ?", (image_id,))
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"Error updating DB for image {image_id}: {e}")
-            
-    # STEP 5: Save FAISS index
-    faiss.write_index(faiss_index, FAISS_INDEX_PATH)
-    
-    conn.close()
+    summary = run_incremental_indexing(db_path=DB_PATH, index_path=FAISS_INDEX_PATH,
+                                       cancel_event=cancel_event, progress=progress)
     
     # STEP 6: Print final log
-    print("Pipeline completed successfully")
+    print(f"Indexed: {summary['indexed']}, Failed or Skipped: {summary['failed']}")
+    if summary["cancelled"]:
+        print("Pipeline cancelled")
+    else:
+        print("Pipeline completed successfully")
+    return summary
+
+def run_compaction_pipeline(cancel_event=None, progress=None):
+    """
+    Removes tombstoned (deleted) images from the FAISS index, the image folder and SQLite.
+    Started in the background by the delete endpoints once enough images are tombstoned.
+    """
+    print("Compacting FAISS index...")
+    summary = compact_index(db_path=DB_PATH, index_path=FAISS_INDEX_PATH,
+                            cancel_event=cancel_event, progress=progress)
+    print(f"Removed vectors: {summary['removed_vectors']}, Deleted rows: {summary['deleted_rows']}")
+    return summary
 
 if __name__ == "__main__":
     run_indexing_pipeline()
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+import numpy as np
+
+# Add the project root to the Python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import DB_PATH, TOMBSTONE_OVERFETCH
+from services.db_service import ensure_schema
+from services.metadata_service import connect_readonly, MAX_IN_PARAMS
+
+
+class Tombstones:
+    """
+    Bitset of deleted image ids (one bit per id) used to drop taken-down images from
+    search results until compaction removes them from the index.
+
+    The bits are loaded from images.deleted_at, plus the retired_images ids that compaction
+    has already deleted but a reader may still find in the generation it serves, and rebuilt
+    whenever another connection has committed to the database (PRAGMA data_version), so
+    every API worker sees a takedown on its next search.
+    """
+    def __init__(self, db_path=DB_PATH, overfetch=TOMBSTONE_OVERFETCH):
+        self.db_path = db_path
+        self.overfetch = overfetch
+        self._conn = None
+        self._lock = threading.Lock()
+        self._data_version = None
+        self._bits = np.zeros(0, dtype=np.uint8)
+        self.count = 0
+
+    def _refresh(self):
+        if self._conn is None:
+            if not os.path.exists(self.db_path):
+                return
+            self._conn = connect_readonly(self.db_path, check_same_thread=False)
+        data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return
+        ids = np.zeros(0, dtype=np.int64)
+        # Older schemas lack retired_images (nothing compacted yet) or even deleted_at (nothing deleted)
+        for query in ("SELECT id FROM images WHERE deleted_at IS NOT NULL UNION ALL SELECT id FROM retired_images",
+                      "SELECT id FROM images WHERE deleted_at IS NOT NULL"):
+            try:
+                ids = np.fromiter((row[0] for row in self._conn.execute(query)), dtype=np.int64)
+                break
+            except sqlite3.OperationalError:
+                continue
+        bits = np.zeros((int(ids.max()) >> 3) + 1 if len(ids) else 0, dtype=np.uint8)
+        np.bitwise_or.at(bits, ids >> 3, (1 << (ids & 7)).astype(np.uint8))
+        self._bits = bits
+        self.count = len(ids)
+        self._data_version = data_version
+
+    def bits(self):
+        """
+        Returns the current bitset, refreshed if the database changed.
+        """
+        with self._lock:
+            self._refresh()
+            return self._bits
+
+    def contains(self, image_ids, bits=None):
+        """
+        Boolean mask (same shape as `image_ids`) of the ids that are tombstoned.
+        """
+        bits = self.bits() if bits is None else bits
+        image_ids = np.asarray(image_ids, dtype=np.int64)
+        in_range = (image_ids >= 0) & ((image_ids >> 3) < len(bits))
+        safe_ids = np.where(in_range, image_ids, 0)
+        if len(bits) == 0:
+            return np.zeros(image_ids.shape, dtype=bool)
+        return in_range & ((bits[safe_ids >> 3] >> (safe_ids & 7).astype(np.uint8)) & 1).astype(bool)
+
+    def extra_k(self):
+        """
+        Additional neighbours to fetch per query so top-k stays full after filtering.
+        """
+        with self._lock:
+            self._refresh()
+            return min(self.count, self.overfetch)
+
+    def filter(self, distances, indices):
+        """
+        Replaces tombstoned hits with (-inf, -1) in FAISS-shaped search results.
+        """
+        dead = self.contains(indices)
+        if not dead.any():
+            return distances, indices
+        return np.where(dead, -np.inf, distances).astype(np.float32), np.where(dead, -1, indices)
+
+
+_tombstones = None
+_tombstones_lock = threading.Lock()
+
+def get_tombstones():
+    global _tombstones
+    if _tombstones is None:
+        with _tombstones_lock:
+            if _tombstones is None:
+                _tombstones = Tombstones()
+    return _tombstones
+
+
+def tombstone_images(image_ids, db_path=DB_PATH):
+    """
+    Marks images as deleted (takedown). Near-duplicates collapsed onto a deleted image are
+    the same picture, so they are tombstoned with it. Searches stop returning them at once;
+    the rows, files and vectors are removed later by compaction.
+    Returns the ids newly tombstoned.
+    """
+    image_ids = list(dict.fromkeys(int(image_id) for image_id in image_ids))
+    conn = sqlite3.connect(db_path)
+    try:
+        ensure_schema(conn)
+        deleted = []
+        now = time.time()
+        with conn:
+            for i in range(0, len(image_ids), MAX_IN_PARAMS):
+                chunk = image_ids[i:i + MAX_IN_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT id FROM images WHERE (id IN ({placeholders}) OR duplicate_of IN ({placeholders})) "
+                    f"AND deleted_at IS NULL",
+                    chunk + chunk
+                ).fetchall()
+                deleted.extend(row[0] for row in rows)
+            conn.executemany("UPDATE images SET deleted_at = ? WHERE id = ?",
+                             [(now, image_id) for image_id in deleted])
+        return deleted
+    finally:
+        conn.close()
+
+
+def tombstone_ratio(db_path=DB_PATH):
+    """
+    Share of the index's vectors that belong to tombstoned images; compaction starts once
+    it reaches TOMBSTONE_COMPACT_RATIO. Only indexed canonical rows have a vector, so
+    deleted near-duplicates and never-indexed rows count on neither side.
+    """
+    conn = connect_readonly(db_path)
+    try:
+        dead, total = conn.execute(
+            "SELECT COUNT(deleted_at), COUNT(*) FROM images WHERE indexed = 1 AND duplicate_of IS NULL"
+        ).fetchone()
+    finally:
+        conn.close()
+    return dead / total if dead else 0.0
@@ -0,0 +1,412 @@
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import multiprocessing
+import queue as queue_module
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import SEARCH_TOP_K, EMBED_WORKERS
+
+RESULTS_PATH = os.path.join(PROJECT_ROOT, 'tests', 'benchmark_results.json')
+BASELINE_PATH = os.path.join(PROJECT_ROOT, 'tests', 'benchmark_baseline.json')
+
+
+class Results:
+    """
+    Collects named metrics with their unit and direction, so runs can be compared.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.skipped = {}
+
+    def add(self, name, value, unit, better="lower"):
+        self.metrics[name] = {"value": round(float(value), 4), "unit": unit, "better": better}
+        print(f"  {name:<36} {value:>12.3f} {unit}")
+
+    def add_latencies(self, prefix, latencies_ms):
+        for p in (50, 95, 99):
+            self.add(f"{prefix}_p{p}_ms", np.percentile(latencies_ms, p), "ms")
+
+    def skip(self, stage, reason):
+        self.skipped[stage] = reason
+        print(f"  {stage}: skipped ({reason})")
+
+
+def make_synthetic_images(directory, count, size=(640, 480), seed=0):
+    """
+    Writes `count` JPEGs of smooth random texture (upsampled noise), which decode and
+    compress like photos rather than flat colour. Returns their paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = size
+    paths = []
+    for i in range(count):
+        noise = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(noise).resize(size, Image.BICUBIC)
+        path = os.path.join(directory, f"synthetic_{i:05d}.jpg")
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def synthetic_corpus(n, dim, seed=0, num_clusters=256, chunk=100000):
+    """
+    L2-normalized vectors drawn around random cluster centres, closer to real CLIP
+    embeddings than uniform noise (approximate indexes behave very differently on both).
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk):
+        end = min(n, start + chunk)
+        block = centres[rng.integers(0, num_clusters, end - start)]
+        block += 0.6 * rng.standard_normal(block.shape).astype(np.float32)
+        block /= np.linalg.norm(block, axis=1, keepdims=True)
+        vectors[start:end] = block
+    return vectors
+
+
+def bench_seeding(results, workdir, image_dir):
+    from services.db_service import initialize_database
+    from ingestion.seed_db import seed_database
+
+    db_path = os.path.join(workdir, "metadata.db")
+    initialize_database(db_path)
+    first = seed_database(db_path=db_path, raw_images_dir=image_dir)
+    results.add("seed_files_per_sec", first["files_per_sec"], "files/s", better="higher")
+    # Second pass: nothing changed, measures the incremental (stat-only) path
+    second = seed_database(db_path=db_path, raw_images_dir=image_dir)
+    results.add("seed_rescan_files_per_sec", second["files_per_sec"], "files/s", better="higher")
+
+
+def bench_preprocess(results, paths):
+    from embedding.preprocess import ImagePreprocessor
+
+    preprocessor = ImagePreprocessor((224, 224), (0.48145466, 0.4578275, 0.40821073),
+                                     (0.26862954, 0.26130258, 0.27577711))
+    batch = preprocessor.new_batch(len(paths))
+    t0 = time.perf_counter()
+    for i, path in enumerate(paths):
+        preprocessor(path, out=batch[i])
+    results.add("preprocess_images_per_sec", len(paths) / (time.perf_counter() - t0), "images/s", better="higher")
+
+
+def bench_embedding(results, paths, batch_sizes):
+    try:
+        from embedding.clip_model import get_generator
+        generator = get_generator()
+    except Exception as e:
+        results.skip("embedding", f"model unavailable: {e}")
+        return
+
+    # The indexing engine's own calls: parallel decode into one batch, then one forward pass
+    def embed(pool, batch_size):
+        embedded = 0
+        for start in range(0, len(paths), batch_size):
+            batch_tensor, valid = generator.preprocess_batch(paths[start:start + batch_size], pool)
+            if batch_tensor is not None:
+                generator.encode_tensors(batch_tensor)
+                embedded += len(valid)
+        return embedded
+
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        generator.encode_tensors(generator.preprocess_batch(paths[:max(batch_sizes)], pool)[0])  # warm-up
+        for batch_size in batch_sizes:
+            t0 = time.perf_counter()
+            embedded = embed(pool, batch_size)
+            elapsed = time.perf_counter() - t0
+            results.add(f"embed_images_per_sec_b{batch_size}", embedded / elapsed, "images/s", better="higher")
+
+
+def bench_index(results, sizes, dim, num_queries):
+    from vector_index.faiss_index import build_index, search_index, index_type_of
+
+    for n in sizes:
+        vectors = synthetic_corpus(n, dim, seed=n)
+        ids = np.arange(1, n + 1, dtype=np.int64)
+        t0 = time.perf_counter()
+        faiss_index = build_index(vectors, ids, "auto")
+        results.add(f"index_build_s_{n}", time.perf_counter() - t0, "s")
+        print(f"  ({index_type_of(faiss_index)} index over {n} vectors)")
+
+        # Queries are perturbed corpus vectors, i.e. near-duplicate lookups like real searches
+        rng = np.random.default_rng(n + 1)
+        queries = vectors[rng.integers(0, n, num_queries)]
+        queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        k = min(SEARCH_TOP_K, n)
+
+        latencies = []
+        for query in queries:
+            t0 = time.perf_counter()
+            search_index(faiss_index, query[None, :], k)
+            latencies.append((time.perf_counter() - t0) * 1000)
+        results.add_latencies(f"search_{n}", latencies)
+        del faiss_index, vectors
+
+
+def bench_robust(results, paths, n, dim, num_queries):
+    """
+    Cost of the robust (multi-crop / flip) search mode as a multiple of a standard query:
+    preprocessing and the multi-row FAISS search always, the forward pass when the model
+    is available. The multiple is bounded by the number of views.
+    """
+    from embedding.preprocess import ImagePreprocessor, ROBUST_VIEWS
+    from vector_index.faiss_index import build_index, search_index
+
+    preprocessor = ImagePreprocessor((224, 224), (0.48145466, 0.4578275, 0.40821073),
+                                     (0.26862954, 0.26130258, 0.27577711))
+    generator = None
+    try:
+        from embedding.clip_model import get_generator
+        generator = get_generator()
+        preprocessor = generator.fast_preprocess or preprocessor
+        dim = generator.embedding_dim
+    except Exception as e:
+        results.skip("robust_embed", f"model unavailable: {e}")
+
+    vectors = synthetic_corpus(n, dim, seed=n)
+    faiss_index = build_index(vectors, np.arange(1, n + 1, dtype=np.int64), "auto")
+    rng = np.random.default_rng(n + 2)
+    queries = vectors[rng.integers(0, n, (num_queries, len(ROBUST_VIEWS)))]
+    k = min(SEARCH_TOP_K, n)
+    sample = paths[:num_queries]
+
+    def timed(fn, items):
+        t0 = time.perf_counter()
+        for item in items:
+            fn(item)
+        return (time.perf_counter() - t0) / len(items)
+
+    single = {
+        "preprocess": timed(lambda path: preprocessor(path), sample),
+        "faiss_search": timed(lambda rows: search_index(faiss_index, rows[:1], k), queries)
+    }
+    robust = {
+        "preprocess": timed(lambda path: preprocessor.views(path), sample),
+        "faiss_search": timed(lambda rows: search_index(faiss_index, rows, k), queries)
+    }
+    if generator is not None:
+        import torch
+        single_batch = torch.from_numpy(preprocessor(sample[0]))[None]
+        robust_batch = torch.from_numpy(preprocessor.views(sample[0]))
+        generator.encode_tensors(robust_batch)  # warm-up
+        single["embed"] = timed(generator.encode_tensors, [single_batch] * 10)
+        robust["embed"] = timed(generator.encode_tensors, [robust_batch] * 10)
+
+    print(f"  ({len(ROBUST_VIEWS)} views per robust query)")
+    for stage in single:
+        results.add(f"robust_{stage}_cost_multiple", robust[stage] / single[stage], "x")
+    results.add("robust_cost_multiple", sum(robust.values()) / sum(single.values()), "x")
+    results.add("robust_query_ms", 1000 * sum(robust.values()), "ms")
+
+
+def _api_latencies(image_dir, num_requests, queue):
+    """
+    Runs in a spawned process whose environment points DB_PATH, FAISS_INDEX_PATH and the
+    embedding/shard directories at a scratch fixture, so the startup warm-up (schema
+    migration included) never touches the repository's database or index.
+    Seeds and indexes the benchmark images, then puts ("ok", latencies_ms) or ("skip", reason).
+    """
+    try:
+        from fastapi.testclient import TestClient
+        from api.main import app
+        from services.config import DB_PATH
+        from services.db_service import initialize_database
+        from ingestion.seed_db import seed_database
+        from vector_index.faiss_index import run_incremental_indexing
+    except Exception as e:
+        queue.put(("skip", f"app unavailable: {e}"))
+        return
+
+    try:
+        initialize_database(DB_PATH)
+        seed_database(db_path=DB_PATH, raw_images_dir=image_dir)
+        run_incremental_indexing()
+        paths = sorted(os.path.join(image_dir, name) for name in os.listdir(image_dir))
+        payloads = []
+        for path in paths[:num_requests]:
+            with open(path, "rb") as f:
+                payloads.append((os.path.basename(path), f.read()))
+
+        # Entering the client runs the startup warm-up, so requests measure steady state
+        with TestClient(app) as client:
+            def post(name, data):
+                return client.post("/search-image", files={"file": (name, io.BytesIO(data), "image/jpeg")})
+
+            response = post(*payloads[0]).json()
+            if response.get("status") == "ERROR":
+                queue.put(("skip", response.get("message")))
+                return
+            latencies = []
+            for name, data in payloads:
+                t0 = time.perf_counter()
+                post(name, data)
+                latencies.append((time.perf_counter() - t0) * 1000)
+        queue.put(("ok", latencies))
+    except Exception as e:
+        queue.put(("skip", f"fixture failed: {e}"))
+
+
+def bench_api(results, workdir, image_dir, num_requests):
+    fixture = os.path.join(workdir, "api_fixture")
+    env = {
+        "DB_PATH": os.path.join(fixture, "metadata.db"),
+        "FAISS_INDEX_PATH": os.path.join(fixture, "faiss.index"),
+        "EMBEDDING_STORE_DIR": os.path.join(fixture, "embeddings"),
+        "SHARD_DIR": os.path.join(fixture, "shards"),
+        "RAW_IMAGES_DIR": image_dir,
+    }
+    os.makedirs(fixture, exist_ok=True)
+    # services.config reads the paths at import, which this process has already done,
+    # so the app runs in a fresh (spawned) interpreter that inherits the overrides
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        worker = context.Process(target=_api_latencies, args=(image_dir, num_requests, queue))
+        worker.start()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    status, value = "skip", "worker exited without a result"
+    while worker.is_alive() or not queue.empty():
+        try:
+            status, value = queue.get(timeout=1)
+            break
+        except queue_module.Empty:
+            continue
+    worker.join()
+    if status == "skip":
+        results.skip("api", value)
+        return
+    results.add_latencies("api_search", value)
+
+
+def compare(current, baseline, threshold):
+    """
+    Returns [(name, baseline_value, current_value, relative_change)] for every metric in
+    both runs that got worse by more than `threshold` (0.2 = 20%).
+    """
+    regressions = []
+    for name, metric in current.items():
+        base = baseline.get(name)
+        if base is None or base["value"] == 0:
+            continue
+        change = (metric["value"] - base["value"]) / base["value"]
+        worse = change if metric["better"] == "lower" else -change
+        if worse > threshold:
+            regressions.append((name, base["value"], metric["value"], change))
+    return regressions
+
+
+def run(args):
+    results = Results()
+    workdir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        print(f"Generating {args.images} synthetic images...")
+        image_dir = os.path.join(workdir, "images")
+        paths = make_synthetic_images(image_dir, args.images)
+
+        stages = args.stages
+        if "seed" in stages:
+            print("Seeding:")
+            bench_seeding(results, workdir, image_dir)
+        if "preprocess" in stages:
+            print("Preprocessing:")
+            bench_preprocess(results, paths)
+        if "embed" in stages:
+            print("Embedding:")
+            bench_embedding(results, paths, args.batch_sizes)
+        if "index" in stages:
+            print("Index build and search:")
+            bench_index(results, args.sizes, args.dim, args.queries)
+        if "robust" in stages:
+            print("Robust multi-crop search cost:")
+            bench_robust(results, paths, min(args.sizes), args.dim, min(args.queries, args.images))
+        if "api" in stages:
+            print("End-to-end /search-image:")
+            bench_api(results, workdir, image_dir, args.requests)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark for ingest, indexing and search. Writes a JSON result file "
+                    "and exits with status 1 if a metric regressed against the baseline."
+    )
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10000, 100000, 1000000],
+                        help="Synthetic corpus sizes (ntotal) for index build and search")
+    parser.add_argument("--dim", type=int, default=512, help="Embedding dimension of the synthetic corpora")
+    parser.add_argument("--queries", type=int, default=1000, help="Single-vector searches per corpus size")
+    parser.add_argument("--images", type=int, default=200, help="Synthetic images for seeding/preprocess/embedding")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=50, help="Requests for the end-to-end API benchmark")
+    parser.add_argument("--stages", nargs="+", default=["seed", "preprocess", "embed", "index", "robust", "api"],
+                        choices=["seed", "preprocess", "embed", "index", "robust", "api"])
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed relative regression per metric before the run fails")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    args = parser.parse_args()
+
+    results = run(args)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")}
+        },
+        "metrics": results.metrics,
+        "skipped": results.skipped
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against (run with --save-baseline to create one).")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)["metrics"]
+    regressions = compare(results.metrics, baseline, args.threshold)
+    for name, base, current, change in regressions:
+        print(f"REGRESSION {name}: {base} -> {current} ({change:+.1%})")
+    if regressions:
+        print(f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+        return 1
+    print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
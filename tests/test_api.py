@@ -0,0 +1,120 @@
+import os
+import sys
+import io
+import types
+import time
+import threading
+import importlib
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from PIL import Image
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from api.utils import BoundedExecutor, QueueFullError
+from services.jobs import JobManager
+
+
+def _blocked(executor, count):
+    """
+    Submits `count` tasks that wait on the returned event.
+    """
+    release = threading.Event()
+    futures = [executor.submit(release.wait) for _ in range(count)]
+    return release, futures
+
+
+def test_executor_sheds_beyond_workers_plus_queue():
+    executor = BoundedExecutor(max_workers=2, max_queue=1, name="test")
+    release, futures = _blocked(executor, 3)
+    with pytest.raises(QueueFullError):
+        executor.submit(lambda: None)
+    stats = executor.stats()
+    assert stats["running"] + stats["queue_depth"] == 3
+
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    # Finished tasks give their slots back
+    assert executor.submit(lambda: 42).result(timeout=5) == 42
+    assert executor.stats()["running"] == 0 and executor.stats()["queue_depth"] == 0
+
+
+def test_executor_releases_the_slot_of_a_failed_task():
+    executor = BoundedExecutor(max_workers=1, max_queue=0, name="test")
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        executor.submit(fail).result(timeout=5)
+    assert executor.submit(lambda: "ok").result(timeout=5) == "ok"
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    """
+    api.routes imported against a stand-in search service, so the HTTP layer is tested
+    without loading the model. Every search fails loudly if a test reaches it.
+    """
+    def unexpected(*args, **kwargs):
+        raise AssertionError("the search service should not be called")
+
+    service = types.ModuleType("query.search_service")
+    for name in ("search_image", "search_batch", "readiness", "get_result_cache"):
+        setattr(service, name, unexpected)
+    monkeypatch.setitem(sys.modules, "query.search_service", service)
+    monkeypatch.delitem(sys.modules, "api.routes", raising=False)
+    return importlib.import_module("api.routes")
+
+
+def test_search_image_returns_503_when_the_queue_is_full(routes, monkeypatch):
+    executor = BoundedExecutor(max_workers=1, max_queue=0, name="test")
+    monkeypatch.setattr(routes, "search_executor", executor)
+    release, futures = _blocked(executor, 1)
+    try:
+        app = FastAPI()
+        app.include_router(routes.router)
+        upload = io.BytesIO()
+        Image.new("RGB", (32, 32)).save(upload, format="PNG")
+        response = TestClient(app).post("/search-image",
+                                        files={"file": ("a.png", upload.getvalue(), "image/png")})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        assert response.json()["status"] == "BUSY"
+    finally:
+        release.set()
+        futures[0].result(timeout=5)
+
+
+def test_start_pipeline_returns_409_with_the_running_job(routes, monkeypatch):
+    release = threading.Event()
+
+    def pipeline(cancel_event, progress):
+        release.wait(5)
+
+    manager = JobManager()
+    monkeypatch.setattr(routes, "get_job_manager", lambda: manager)
+    monkeypatch.setattr(routes, "run_indexing_pipeline", pipeline)
+    app = FastAPI()
+    app.include_router(routes.router)
+    client = TestClient(app)
+
+    first = client.post("/start-pipeline")
+    second = client.post("/start-pipeline")
+    assert first.status_code == 202
+    assert second.status_code == 409 and second.json()["job_id"] == first.json()["job_id"]
+
+    release.set()
+    job = manager.get(first.json()["job_id"])
+    deadline = time.time() + 5
+    while not job.finished and time.time() < deadline:
+        time.sleep(0.01)
+    assert job.status == "completed"
+    # Once the job is done the next start gets a new job
+    third = client.post("/start-pipeline")
+    assert third.status_code == 202 and third.json()["job_id"] != first.json()["job_id"]
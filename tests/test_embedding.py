@@ -0,0 +1,92 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from embedding.embedding_store import EmbeddingStore
+
+
+def _vectors(n, dim=8, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+
+
+def test_store_round_trip_and_dedup(tmp_path):
+    store = EmbeddingStore("m", 8, store_dir=str(tmp_path), writer=True)
+    vectors = _vectors(3)
+    assert store.put_many(["a", "b", "a"], vectors) == 2
+    assert store.put_many(["b", "c"], _vectors(2, seed=1)) == 1
+    found_vectors, found = store.get_many(["a", "x", "b"])
+    assert found.tolist() == [True, False, True]
+    np.testing.assert_array_equal(found_vectors[[0, 2]], vectors[:2])
+    store.close()
+
+
+def test_reader_never_truncates_an_append_in_progress(tmp_path):
+    writer = EmbeddingStore("m", 8, store_dir=str(tmp_path), writer=True)
+    writer.put_many(["a"], _vectors(1))
+    # Half a row on disk: what a reader sees while the writer is mid-write
+    with open(writer.vectors_path, "ab") as f:
+        f.write(b"\0" * (writer.row_bytes // 2))
+    size = os.path.getsize(writer.vectors_path)
+
+    reader = EmbeddingStore("m", store_dir=str(tmp_path))
+    assert os.path.getsize(writer.vectors_path) == size
+    assert reader.get_many(["a"])[1].tolist() == [True]
+    with pytest.raises(ValueError):
+        reader.put_many(["b"], _vectors(1))
+    reader.close()
+    writer.close()
+
+    # A writer that reopens after a crash repairs the torn row
+    recovered = EmbeddingStore("m", store_dir=str(tmp_path), writer=True)
+    assert os.path.getsize(recovered.vectors_path) == recovered.row_bytes
+    recovered.close()
+
+
+def test_rows_come_from_the_file_not_the_count_at_open(tmp_path):
+    first = EmbeddingStore("m", 8, store_dir=str(tmp_path), writer=True)
+    second = EmbeddingStore("m", store_dir=str(tmp_path), writer=True)
+    a, b = _vectors(1, seed=1), _vectors(1, seed=2)
+    first.put_many(["a"], a)
+    # `second` was opened before `a` was appended; its rows must still land after it
+    second.put_many(["b"], b)
+    reader = EmbeddingStore("m", store_dir=str(tmp_path))
+    vectors, found = reader.get_many(["a", "b"])
+    assert found.all()
+    np.testing.assert_array_equal(vectors, np.concatenate([a, b]))
+    for store in (first, second, reader):
+        store.close()
+
+
+class FakeGenerator:
+    """
+    Stands in for a loaded EmbeddingGenerator: items are floats, None cannot be read,
+    and an item's embedding is [item] * embedding_dim.
+    """
+    embedding_dim = 4
+
+    def preprocess_batch(self, items, pool):
+        tensors = list(pool.map(lambda item: item, items))
+        valid = [i for i, t in enumerate(tensors) if t is not None]
+        if not valid:
+            return None, valid
+        return np.array([tensors[i] for i in valid], dtype=np.float32), valid
+
+    def encode_tensors(self, batch):
+        return np.repeat(batch[:, None], self.embedding_dim, axis=1)
+
+
+def test_generate_embeddings_masks_unreadable_images():
+    pytest.importorskip("open_clip")
+    from embedding.generate_embeddings import EmbeddingGenerator
+
+    items = [1.0, None, 3.0, None, None, 6.0, 7.0]
+    embeddings, ok = EmbeddingGenerator.generate_embeddings(FakeGenerator(), items, batch_size=2, num_workers=2)
+    assert ok.tolist() == [True, False, True, False, False, True, True]
+    assert embeddings.shape == (7, 4) and embeddings.dtype == np.float32
+    np.testing.assert_array_equal(embeddings[:, 0], [1, 0, 3, 0, 0, 6, 7])
@@ -0,0 +1,323 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+import functools
+import numpy as np
+import faiss
+from PIL import Image
+import pytest
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+import vector_index.faiss_index as faiss_index_module
+import vector_index.search as search_module
+from vector_index.faiss_index import (run_incremental_indexing, get_index_ids, build_index, compact_index,
+                                      _mark_indexed)
+from vector_index.load_index import IndexHolder, write_index_atomic
+from vector_index.search import LocalSearcher, fuse_scores
+from services.tombstones import Tombstones, tombstone_images
+from embedding.embedding_store import EmbeddingStore
+from services.db_service import initialize_database
+
+DIM = 8
+
+
+class FakeGenerator:
+    """
+    Stands in for EmbeddingGenerator in the indexing engine: a deterministic vector per
+    file path, no model. `encoded` counts the images that went through encode_tensors.
+    """
+    model_key = "fake"
+    embedding_dim = DIM
+
+    def __init__(self):
+        self.encoded = 0
+
+    def preprocess_batch(self, paths, pool):
+        rows = [np.random.default_rng(abs(hash(os.path.basename(path))) % (1 << 32)).standard_normal(DIM)
+                for path in paths]
+        return np.array(rows, dtype=np.float32), np.arange(len(paths))
+
+    def encode_tensors(self, batch):
+        self.encoded += len(batch)
+        return batch / np.linalg.norm(batch, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    """
+    A metadata.db with `count` image rows whose files exist, and an index path next to it.
+    The engine's embedding store is redirected into tmp_path.
+    """
+    monkeypatch.setattr(faiss_index_module, "EmbeddingStore",
+                        functools.partial(EmbeddingStore, store_dir=str(tmp_path / "embeddings")))
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+
+    def add(count, indexed=0):
+        conn = sqlite3.connect(db_path)
+        start = conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        with conn:
+            for i in range(start, start + count):
+                path = str(tmp_path / f"{i}.png")
+                noise = np.random.default_rng(i).integers(0, 256, (32, 32, 3), dtype=np.uint8)
+                Image.fromarray(noise).save(path)
+                conn.execute("INSERT INTO images (file_path, source_url, hash, indexed) VALUES (?, ?, ?, ?)",
+                             (path, f"https://example.org/{i}", f"hash-{i}", indexed))
+        conn.close()
+
+    return db_path, str(tmp_path / "faiss.index"), add
+
+
+def _flags(db_path):
+    conn = sqlite3.connect(db_path)
+    flags = [row[0] for row in conn.execute("SELECT indexed FROM images ORDER BY id")]
+    conn.close()
+    return flags
+
+
+def test_missing_index_reindexes_rows_flagged_indexed(corpus):
+    # A fresh checkout: the database says indexed, but faiss.index is not in the repository
+    db_path, index_path, add = corpus
+    add(5, indexed=1)
+    summary = run_incremental_indexing(generator=FakeGenerator(), chunk_size=2,
+                                       db_path=db_path, index_path=index_path, num_shards=1)
+    assert summary["indexed"] == 5
+    assert sorted(get_index_ids(faiss.read_index(index_path)).tolist()) == [1, 2, 3, 4, 5]
+    assert _flags(db_path) == [1] * 5
+
+    # With the index present, flagged rows are left alone
+    summary = run_incremental_indexing(generator=FakeGenerator(), db_path=db_path,
+                                       index_path=index_path, num_shards=1)
+    assert summary["pending"] == 0
+
+
+def test_checkpoints_grow_with_the_index(corpus, monkeypatch):
+    db_path, index_path, add = corpus
+    add(20)
+    writes = []
+    monkeypatch.setattr(faiss_index_module, "write_index_atomic",
+                        lambda index, path: writes.append(index.ntotal) or write_index_atomic(index, path))
+    summary = run_incremental_indexing(generator=FakeGenerator(), chunk_size=2, db_path=db_path,
+                                       index_path=index_path, num_shards=1, checkpoint_growth=1.0)
+    # Each checkpoint waits for the index to double (and for at least one chunk), plus a final one
+    assert writes == [2, 4, 8, 16, 20]
+    assert summary["indexed"] == 20 and _flags(db_path) == [1] * 20
+
+
+def test_crash_before_the_db_commit_is_recovered_from_the_checkpoint(corpus, monkeypatch):
+    db_path, index_path, add = corpus
+    add(6)
+
+    def crash(conn, image_ids):
+        raise RuntimeError("killed")
+
+    monkeypatch.setattr(faiss_index_module, "_mark_indexed", crash)
+    with pytest.raises(RuntimeError):
+        run_incremental_indexing(generator=FakeGenerator(), chunk_size=10, db_path=db_path,
+                                 index_path=index_path, num_shards=1)
+    assert _flags(db_path) == [0] * 6
+    monkeypatch.setattr(faiss_index_module, "_mark_indexed", _mark_indexed)
+
+    # Restart: the rows already in the checkpoint are flagged, nothing is added twice
+    generator = FakeGenerator()
+    summary = run_incremental_indexing(generator=generator, chunk_size=10, db_path=db_path,
+                                       index_path=index_path, num_shards=1)
+    assert summary["recovered"] == 6 and summary["indexed"] == 0
+    assert generator.encoded == 0
+    assert sorted(get_index_ids(faiss.read_index(index_path)).tolist()) == list(range(1, 7))
+    assert _flags(db_path) == [1] * 6
+
+
+def test_crash_before_the_checkpoint_reuses_stored_vectors(corpus, monkeypatch):
+    db_path, index_path, add = corpus
+    add(6)
+
+    def crash(index, path):
+        raise RuntimeError("killed")
+
+    monkeypatch.setattr(faiss_index_module, "write_index_atomic", crash)
+    first = FakeGenerator()
+    with pytest.raises(RuntimeError):
+        run_incremental_indexing(generator=first, chunk_size=2, db_path=db_path,
+                                 index_path=index_path, num_shards=1)
+    assert _flags(db_path) == [0] * 6
+    monkeypatch.setattr(faiss_index_module, "write_index_atomic", write_index_atomic)
+
+    # Restart: the chunk that reached the index stage before the crash comes from the store
+    second = FakeGenerator()
+    summary = run_incremental_indexing(generator=second, chunk_size=2, db_path=db_path,
+                                       index_path=index_path, num_shards=1)
+    assert summary["indexed"] == 6
+    assert summary["reused"] == 2 and second.encoded == 4
+    assert _flags(db_path) == [1] * 6
+
+
+def test_sharded_search_answers_concurrent_queries(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((400, DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = np.arange(1, 401, dtype=np.int64)
+    paths = [str(tmp_path / f"shard-{shard}-of-2.index") for shard in range(2)]
+    for shard, path in enumerate(paths):
+        in_shard = ids % 2 == shard
+        write_index_atomic(build_index(vectors[in_shard], ids[in_shard], "flat"), path)
+    monkeypatch.setattr(search_module, "shard_paths", lambda num_shards: paths)
+
+    searcher = search_module.ShardedSearcher(num_shards=2, tombstones=Tombstones(db_path))
+    try:
+        # Many threads in flight at once: every caller gets the replies to its own request
+        errors = []
+
+        def query(seed):
+            try:
+                for q in np.random.default_rng(seed).integers(0, 400, 10):
+                    _, found = searcher.search(vectors[q:q + 1], 3)
+                    expected = ids[np.argsort(-(vectors @ vectors[q]), kind="stable")[:3]]
+                    assert found[0].tolist() == expected.tolist()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=query, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert searcher.info() == (400, DIM)
+    finally:
+        searcher.close()
+
+
+def test_local_search_skips_tombstones_and_keeps_top_k_full(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO images (file_path, hash) VALUES (?, ?)",
+                         [(f"{i}.jpg", f"hash-{i}") for i in range(1, 41)])
+    conn.close()
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((40, DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    ids = np.arange(1, 41, dtype=np.int64)
+    index_path = str(tmp_path / "faiss.index")
+    write_index_atomic(build_index(vectors, ids, "flat"), index_path)
+
+    searcher = LocalSearcher(IndexHolder(index_path, reload_interval=0), tombstones=Tombstones(db_path))
+    ranking = ids[np.argsort(-(vectors @ vectors[0]), kind="stable")]
+    assert searcher.search(vectors[:1], 3)[1][0].tolist() == ranking[:3].tolist()
+
+    # The three best hits are taken down: the next three fill the top-k
+    tombstone_images(ranking[:3].tolist(), db_path)
+    _, found = searcher.search(vectors[:1], 3)
+    assert found[0].tolist() == ranking[3:6].tolist()
+
+
+def test_fuse_scores_max_and_mean():
+    # Three views of one upload; -1 is an empty slot
+    distances = np.array([[0.9, 0.5, 0.4],
+                          [0.8, 0.7, 0.3],
+                          [0.6, 0.2, 0.0]], dtype=np.float32)
+    indices = np.array([[1, 2, 3],
+                        [2, 1, 4],
+                        [2, 5, -1]], dtype=np.int64)
+
+    fused = dict(fuse_scores(distances, indices, "max", top_k=10))
+    assert fused == pytest.approx({1: 0.9, 2: 0.8, 3: 0.4, 4: 0.3, 5: 0.2})
+
+    # Mean: an image missing from a view counts with that view's lowest score in its top k
+    fused = fuse_scores(distances, indices, "mean", top_k=2)
+    assert [image_id for image_id, _ in fused] == [2, 1]
+    assert fused[0][1] == pytest.approx((0.5 + 0.8 + 0.6) / 3)
+    assert fused[1][1] == pytest.approx((0.9 + 0.7 + 0.2) / 3)
+
+    with pytest.raises(ValueError):
+        fuse_scores(distances, indices, "median")
+
+
+def test_compacted_ids_stay_filtered_for_readers_of_the_old_generation(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO images (file_path, hash, indexed) VALUES (?, ?, 1)",
+                         [(str(tmp_path / f"{i}.jpg"), f"hash-{i}") for i in range(1, 21)])
+    conn.close()
+    vectors = np.random.default_rng(2).standard_normal((20, DIM)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index_path = str(tmp_path / "faiss.index")
+    write_index_atomic(build_index(vectors, np.arange(1, 21, dtype=np.int64), "flat"), index_path)
+
+    # A worker that has loaded the current generation and will not reload for a while
+    searcher = LocalSearcher(IndexHolder(index_path, reload_interval=3600), tombstones=Tombstones(db_path))
+    assert searcher.search(vectors[:1], 1)[1][0].tolist() == [1]
+
+    tombstone_images([1], db_path)
+    summary = compact_index(db_path=db_path, index_path=index_path, num_shards=1)
+    assert summary["removed_vectors"] == 1 and summary["deleted_rows"] == 1
+    assert faiss.read_index(index_path).ntotal == 19
+
+    # The row is gone, but the old generation still holds the vector: it must stay hidden
+    _, found = searcher.search(vectors[:1], 3)
+    assert 1 not in found[0].tolist() and -1 not in found[0].tolist()
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT id FROM retired_images").fetchall() == [(1,)]
+    conn.close()
+
+
+def test_sharded_generation_follows_what_the_workers_serve(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    vectors = np.random.default_rng(3).standard_normal((20, DIM)).astype(np.float32)
+    ids = np.arange(1, 21, dtype=np.int64)
+    paths = [str(tmp_path / f"shard-{shard}-of-2.index") for shard in range(2)]
+    for shard, path in enumerate(paths):
+        write_index_atomic(build_index(vectors[ids % 2 == shard], ids[ids % 2 == shard], "flat"), path)
+    monkeypatch.setattr(search_module, "shard_paths", lambda num_shards: paths)
+
+    pinned = search_module.ShardedSearcher(num_shards=2, reload_interval=3600, tombstones=Tombstones(db_path))
+    live = search_module.ShardedSearcher(num_shards=2, reload_interval=0, tombstones=Tombstones(db_path))
+    try:
+        pinned.search(vectors[:1], 1)
+        live.search(vectors[:1], 1)
+        before = pinned.generation()
+        assert None not in before and before == live.generation()
+
+        write_index_atomic(build_index(vectors[:4], ids[:4] * 2, "flat"), paths[0])
+        # Published, but a worker that has not reloaded still serves (and reports) the old file
+        assert pinned.generation() == before
+        deadline = time.time() + 5
+        while live.generation() == before and time.time() < deadline:
+            time.sleep(0.02)
+        after = live.generation()
+        assert after[0] != before[0] and after[1] == before[1]
+    finally:
+        pinned.close()
+        live.close()
+
+
+def test_index_holder_switches_to_a_new_generation(tmp_path):
+    vectors = np.random.default_rng(4).standard_normal((8, DIM)).astype(np.float32)
+    ids = np.arange(1, 9, dtype=np.int64)
+    path = str(tmp_path / "faiss.index")
+    write_index_atomic(build_index(vectors[:4], ids[:4], "flat"), path)
+
+    holder = IndexHolder(path, reload_interval=0)
+    old = holder.get()
+    assert old.ntotal == 4 and holder.generation == 1
+
+    write_index_atomic(build_index(vectors, ids, "flat"), path)
+    deadline = time.time() + 5
+    while holder.get().ntotal != 8 and time.time() < deadline:
+        time.sleep(0.01)
+    assert holder.get().ntotal == 8 and holder.generation == 2
+    # A search that started on the old generation can still finish on it
+    assert old.search(vectors[:1], 1)[1][0][0] == 1
@@ -0,0 +1,287 @@
+import os
+import sys
+import io
+import time
+import asyncio
+import sqlite3
+import httpx
+import numpy as np
+from PIL import Image
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.db_service import initialize_database
+from ingestion.deduplicate import BKTree, HashIndex, compute_hashes, hamming, to_signed
+import ingestion.scraper as scraper_module
+from ingestion.scraper import Scraper, HostLimiter
+
+
+def _texture(seed, size=(96, 96)):
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, (size[1] // 8, size[0] // 8, 3), dtype=np.uint8)
+    return Image.fromarray(noise).resize(size, Image.BICUBIC)
+
+
+def _insert(db_path, rows):
+    """
+    rows: [(file_path, image), ...]; returns the new ids.
+    """
+    conn = sqlite3.connect(db_path)
+    ids = []
+    with conn:
+        for file_path, image in rows:
+            phash, dhash = compute_hashes(image)
+            cursor = conn.execute(
+                "INSERT INTO images (file_path, source_url, hash, phash, dhash) VALUES (?, ?, ?, ?, ?)",
+                (file_path, f"https://example.org/{file_path}", file_path, to_signed(phash), to_signed(dhash))
+            )
+            ids.append(cursor.lastrowid)
+    conn.close()
+    return ids
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_bktree_radius_search_matches_brute_force():
+    rng = np.random.default_rng(0)
+    hashes = [int(value) for value in rng.integers(0, 1 << 62, 500, dtype=np.int64)]
+    tree = BKTree()
+    for i, value in enumerate(hashes):
+        tree.add(value, i)
+    query = hashes[17] ^ 0b1011  # 3 bits away from an entry
+    for radius in (0, 3, 8, 30):
+        expected = sorted(i for i, value in enumerate(hashes) if hamming(query, value) <= radius)
+        found = sorted(item for _, item in tree.search(query, radius))
+        assert found == expected
+    assert tree.search(query, 3)[0] == (3, 17)
+
+
+def test_hash_index_finds_near_duplicates(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    first, second = _insert(db_path, [("a.jpg", _texture(1)), ("b.jpg", _texture(2))])
+    index = HashIndex(db_path)
+    # A re-encoded copy at a different size is still within a few bits
+    match = index.find(_texture(2).resize((80, 80)), 6)
+    assert match is not None and match[0] == second
+    assert index.find(_texture(99), 2) is None
+
+
+def test_hash_index_refreshes_in_background_and_hides_takedowns(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    (first,) = _insert(db_path, [("a.jpg", _texture(1))])
+    index = HashIndex(db_path)
+    assert index.find(_texture(1), 0)[0] == first
+
+    # A commit from another connection never blocks find(); the new row shows up once
+    # the background rebuild has been swapped in
+    (second,) = _insert(db_path, [("b.jpg", _texture(2))])
+    index.find(_texture(2), 0)
+    assert _wait_until(lambda: (index.find(_texture(2), 0) or (None,))[0] == second)
+
+    # Takedowns are excluded immediately, even before the tree is rebuilt
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE images SET deleted_at = ? WHERE id = ?", (time.time(), first))
+    conn.close()
+    assert index.find(_texture(1), 0) is None
+    assert _wait_until(lambda: index._snapshot.get()[1])
+    assert index.find(_texture(1), 0) is None
+
+
+def _png_bytes(seed):
+    buffer = io.BytesIO()
+    _texture(seed).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _scraper(tmp_path, handler, **kwargs):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    kwargs.setdefault("per_host_rate", 0)
+    return Scraper(db_path=db_path, output_dir=str(tmp_path / "scraped"),
+                   transport=httpx.MockTransport(handler), **kwargs)
+
+
+def _image_rows(scraper):
+    conn = sqlite3.connect(scraper.db_path)
+    rows = conn.execute("SELECT source_url, platform FROM images ORDER BY id").fetchall()
+    conn.close()
+    return rows
+
+
+def test_scraper_honours_retry_after(tmp_path):
+    image = _png_bytes(1)
+    calls = []
+
+    def handler(request):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "0.3"})
+        return httpx.Response(200, headers={"Content-Type": "image/png"}, content=image)
+
+    scraper = _scraper(tmp_path, handler, retries=2)
+    stats = asyncio.run(scraper.run(["https://img.example.org/a.png"]))
+    assert stats["images"] == 1 and stats["errors"] == 0
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.3
+
+
+def test_scraper_gives_up_after_retries(tmp_path):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503, headers={"Retry-After": "0"})
+
+    scraper = _scraper(tmp_path, handler, retries=2)
+    stats = asyncio.run(scraper.run(["https://img.example.org/a.png"]))
+    assert len(calls) == 3
+    assert stats["errors"] == 1 and stats["images"] == 0
+
+
+def test_scraper_recrawl_uses_conditional_requests(tmp_path):
+    image = _png_bytes(2)
+    page = b'<html><img src="/pics/a.png"></html>'
+    requests = []
+
+    def handler(request):
+        requests.append((request.url.path, request.headers.get("if-none-match")))
+        etag = f'"{request.url.path}"'
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        if request.url.path == "/sitemap.xml":
+            body = b'<urlset><url><loc>https://www.reddit.com/r/pics</loc></url></urlset>'
+            return httpx.Response(200, headers={"ETag": etag, "Content-Type": "application/xml"}, content=body)
+        if request.url.path == "/r/pics":
+            return httpx.Response(200, headers={"ETag": etag, "Content-Type": "text/html"}, content=page)
+        return httpx.Response(200, headers={"ETag": etag, "Content-Type": "image/png"}, content=image)
+
+    scraper = _scraper(tmp_path, handler)
+    first = asyncio.run(scraper.run(sitemaps=["https://www.reddit.com/sitemap.xml"]))
+    assert first["images"] == 1 and first["pages"] == 1
+    assert _image_rows(scraper) == [("https://www.reddit.com/r/pics", "reddit")]
+
+    # Second crawl: the sitemap and the page answer 304, so nothing is downloaded or parsed
+    requests.clear()
+    second = asyncio.run(_scraper(tmp_path, handler).run(sitemaps=["https://www.reddit.com/sitemap.xml"]))
+    assert [path for path, _ in requests] == ["/sitemap.xml", "/r/pics"]
+    assert all(etag is not None for _, etag in requests)
+    assert second["not_modified"] == 2 and second["images"] == 0 and second["bytes"] == 0
+
+
+def test_scraper_refetches_an_image_whose_store_failed(tmp_path, monkeypatch):
+    image = _png_bytes(4)
+    requests = []
+
+    def handler(request):
+        requests.append(request.headers.get("if-none-match"))
+        if request.headers.get("if-none-match") == '"v1"':
+            return httpx.Response(304, headers={"ETag": '"v1"'})
+        return httpx.Response(200, headers={"ETag": '"v1"', "Content-Type": "image/png"}, content=image)
+
+    def broken(source_url):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(scraper_module, "source_columns", broken)
+    first = asyncio.run(_scraper(tmp_path, handler).run(["https://img.example.org/a.png"]))
+    assert first["errors"] == 1 and first["images"] == 0
+    monkeypatch.undo()
+
+    # The validators were not kept, so the next crawl downloads and stores the image
+    scraper = _scraper(tmp_path, handler)
+    second = asyncio.run(scraper.run(["https://img.example.org/a.png"]))
+    assert requests == [None, None]
+    assert second["images"] == 1
+    assert _image_rows(scraper) == [("https://img.example.org/a.png", "other")]
+
+
+def test_scraper_stops_at_sitemap_cycles(tmp_path):
+    index = b"""<sitemapindex>
+        <sitemap><loc>https://example.org/index.xml</loc></sitemap>
+        <sitemap><loc>https://example.org/child.xml</loc></sitemap>
+    </sitemapindex>"""
+    child = b"""<sitemapindex>
+        <sitemap><loc>https://example.org/index.xml</loc></sitemap>
+        <sitemap><loc>https://example.org/pages.xml</loc></sitemap>
+    </sitemapindex>"""
+    pages = b"<urlset><url><loc>https://example.org/page</loc></url></urlset>"
+    bodies = {"/index.xml": index, "/child.xml": child, "/pages.xml": pages}
+
+    def handler(request):
+        etag = f'"{request.url.path}"'
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        if request.url.path in bodies:
+            return httpx.Response(200, headers={"ETag": etag}, content=bodies[request.url.path])
+        return httpx.Response(200, headers={"Content-Type": "text/html"}, content=b"<html></html>")
+
+    async def expand(scraper):
+        async with httpx.AsyncClient(transport=scraper.transport) as client:
+            scraper._client = client
+            scraper._conn = scraper._open_db()
+            try:
+                return await asyncio.wait_for(scraper.expand_sitemap("https://example.org/index.xml"), 5)
+            finally:
+                scraper._conn.close()
+
+    # Live, then replayed from the stored locations after 304s
+    assert asyncio.run(expand(_scraper(tmp_path, handler))) == ["https://example.org/page"]
+    assert asyncio.run(expand(_scraper(tmp_path, handler))) == ["https://example.org/page"]
+
+
+def test_scraper_saves_an_image_url_from_a_single_request(tmp_path):
+    image = _png_bytes(3)
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        return httpx.Response(200, headers={"Content-Type": "image/png"}, content=image)
+
+    # No image extension, so it is fetched as a page first
+    scraper = _scraper(tmp_path, handler)
+    stats = asyncio.run(scraper.run(["https://cdn.example.org/photo?id=7"]))
+    assert requests == ["/photo"]
+    assert stats["images"] == 1
+
+
+def test_scraper_enforces_the_size_cap(tmp_path):
+    def handler(request):
+        body = b"\0" * 4096
+        if request.url.path == "/declared.png":
+            return httpx.Response(200, headers={"Content-Type": "image/png"}, content=body)
+        # No Content-Length: the cap is enforced while streaming
+        return httpx.Response(200, headers={"Content-Type": "image/png"}, stream=httpx.ByteStream(body))
+
+    scraper = _scraper(tmp_path, handler, max_image_bytes=1024)
+    stats = asyncio.run(scraper.run(["https://img.example.org/declared.png", "https://img.example.org/streamed.png"]))
+    assert stats["images"] == 0 and stats["errors"] == 0
+    leftovers = os.listdir(scraper.output_dir) if os.path.exists(scraper.output_dir) else []
+    assert leftovers == []
+
+
+def test_host_limiter_spaces_request_starts():
+    limiter = HostLimiter(concurrency=4, rate=20.0)
+    starts = []
+
+    async def hit():
+        async with limiter.slot("https://a.example.org/x"):
+            starts.append(time.monotonic())
+
+    async def main():
+        await asyncio.gather(*(hit() for _ in range(4)))
+
+    asyncio.run(main())
+    starts.sort()
+    assert all(b - a >= 0.045 for a, b in zip(starts, starts[1:]))
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.db_service import initialize_database
+from query.result_cache import ResultCache, ENTRY_OVERHEAD, embedding_key
+from query.result_mapper import (parse_host, platform_for_host, parse_source, build_match,
+                                 PLATFORM_RISKS, DEFAULT_RISK, OTHER_PLATFORM, UNKNOWN_PLATFORM)
+from ingestion.metadata_builder import backfill_sources
+from query.embed_query import QueryBatcher
+
+
+class FakeGenerator:
+    """
+    "Preprocesses" a number into a constant vector and records every forward pass.
+    """
+    def __init__(self, dim=4):
+        self.dim = dim
+        self.batches = []
+
+    def preprocess_image(self, value):
+        return np.full(self.dim, float(value), dtype=np.float32)
+
+    def collate(self, batch, tensors):
+        return np.stack(tensors), list(range(len(tensors)))
+
+    def encode_tensors(self, batch_tensor):
+        self.batches.append(len(batch_tensor))
+        return batch_tensor.astype(np.float32)
+
+
+class FakeSearcher:
+    """
+    Returns each query's own value as its single neighbour id.
+    """
+    def __init__(self, dim=4, fail=False):
+        self.dim = dim
+        self.fail = fail
+        self.calls = []
+
+    def info(self):
+        return 10, self.dim
+
+    def search(self, queries, k):
+        if self.fail:
+            raise RuntimeError("index unavailable")
+        self.calls.append(len(queries))
+        return queries[:, :k].copy(), queries[:, :k].astype(np.int64)
+
+
+def _concurrently(fn, values):
+    results = {}
+
+    def run(value):
+        try:
+            results[value] = fn(value)
+        except Exception as e:
+            results[value] = e
+
+    threads = [threading.Thread(target=run, args=(value,)) for value in values]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batcher_runs_concurrent_queries_as_one_batch():
+    generator, searcher = FakeGenerator(), FakeSearcher()
+    batcher = QueryBatcher(generator, searcher, max_batch_size=8, window_ms=300, top_k=1)
+    results = _concurrently(batcher.search, [1, 2, 3, 4])
+    # One forward pass and one search; every caller gets the row of its own image
+    assert generator.batches == [4] and searcher.calls == [4]
+    for value, (embedding, distances, indices) in results.items():
+        assert embedding[0] == value and indices.tolist() == [value]
+
+
+def test_batcher_caps_the_batch_size():
+    generator = FakeGenerator()
+    batcher = QueryBatcher(generator, FakeSearcher(), max_batch_size=2, window_ms=300, top_k=1)
+    _concurrently(batcher.search, [1, 2, 3, 4, 5])
+    assert max(generator.batches) == 2 and sum(generator.batches) == 5
+
+
+def test_batcher_skips_the_search_for_cache_hits():
+    searcher = FakeSearcher()
+    batcher = QueryBatcher(FakeGenerator(), searcher, window_ms=0, top_k=1)
+    embedding, distances, indices = batcher.search(7, lookup=lambda embedding: True)
+    assert embedding[0] == 7 and distances is None and indices is None
+    assert searcher.calls == []
+
+
+def test_batcher_fails_every_query_of_a_failed_batch():
+    batcher = QueryBatcher(FakeGenerator(), FakeSearcher(fail=True), max_batch_size=8, window_ms=300,
+                           top_k=1)
+    results = _concurrently(batcher.search, [1, 2, 3])
+    assert all(isinstance(result, RuntimeError) for result in results.values())
+    # The worker survives a failed batch
+    batcher.searcher = FakeSearcher()
+    assert batcher.search(9)[2].tolist() == [9]
+
+
+RESPONSE = {"status": "FOUND", "matches": [{"similarity": 0.9, "source_url": "https://example.org/a"}]}
+
+
+def _cache(tmp_path, **kwargs):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    generation = {"value": 1}
+    cache = ResultCache(lambda: generation["value"], db_path, **kwargs)
+    return cache, generation, db_path
+
+
+def _miss_then_put(cache, key, version):
+    """
+    What search_service does: a lookup (which misses) and then storing the computed response.
+    """
+    assert cache.get("sha256", key, version) is None
+    cache.put("sha256", key, RESPONSE, version)
+
+
+def test_result_cache_is_dropped_when_the_index_generation_changes(tmp_path):
+    cache, generation, _ = _cache(tmp_path, max_bytes=1 << 20, ttl=60)
+    _miss_then_put(cache, b"upload", cache.version())
+    assert cache.get("sha256", b"upload", cache.version()) == RESPONSE
+
+    generation["value"] = 2
+    assert cache.get("sha256", b"upload", cache.version()) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_result_cache_is_dropped_after_a_database_commit(tmp_path):
+    cache, _, db_path = _cache(tmp_path, max_bytes=1 << 20, ttl=60)
+    version = cache.version()
+    _miss_then_put(cache, b"upload", version)
+
+    # A takedown (or any metadata write) from another connection
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("INSERT INTO images (file_path, hash) VALUES ('a.jpg', 'a')")
+    conn.close()
+    assert cache.version() != version
+    assert cache.get("sha256", b"upload", cache.version()) is None
+
+    # A response computed before the commit is not stored under the new version
+    cache.put("sha256", b"upload", RESPONSE, version)
+    assert cache.get("sha256", b"upload", cache.version()) is None
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    entry_size = len(json.dumps(RESPONSE)) + ENTRY_OVERHEAD
+    cache, _, _ = _cache(tmp_path, max_bytes=2 * entry_size, ttl=60)
+    version = cache.version()
+    _miss_then_put(cache, b"a", version)
+    _miss_then_put(cache, b"b", version)
+    assert cache.get("sha256", b"a", version) == RESPONSE  # "a" is now the most recent
+    _miss_then_put(cache, b"c", version)
+    assert cache.evictions == 1 and cache.bytes == 2 * entry_size
+    assert cache.get("sha256", b"b", version) is None
+    assert cache.get("sha256", b"a", version) == RESPONSE
+
+
+def test_result_cache_entries_expire(tmp_path):
+    cache, _, _ = _cache(tmp_path, max_bytes=1 << 20, ttl=0.05)
+    _miss_then_put(cache, b"a", cache.version())
+    time.sleep(0.1)
+    assert cache.get("sha256", b"a", cache.version()) is None
+
+
+def test_embedding_key_ignores_tiny_differences():
+    embedding = np.random.default_rng(0).standard_normal(16).astype(np.float32)
+    embedding /= np.linalg.norm(embedding)
+    assert embedding_key(embedding) == embedding_key(embedding.copy())
+    assert embedding_key(embedding) == embedding_key(np.round(embedding, 3) + 1e-6)
+    assert embedding_key(embedding) != embedding_key(-embedding)
+
+
+def test_parse_host_normalizes_urls():
+    assert parse_host("https://User:pw@WWW.Reddit.com:8443/r/pics?x=1") == "www.reddit.com"
+    assert parse_host("reddit.com/r/pics") == "reddit.com"
+    assert parse_host("https://twitter.com./status/1") == "twitter.com"
+    assert parse_host(None) is None and parse_host("") is None
+    assert parse_host("https://[::1") is None
+
+
+def test_platform_is_the_closest_registered_domain():
+    assert platform_for_host("old.reddit.com") == "reddit"
+    assert platform_for_host("instagram.com") == "instagram"
+    # Substrings of a registered domain are not matches
+    assert platform_for_host("notreddit.com") == OTHER_PLATFORM
+    assert platform_for_host("reddit.com.evil.org") == OTHER_PLATFORM
+    assert platform_for_host(None) == UNKNOWN_PLATFORM
+    assert parse_source("https://m.facebook.com/photo") == ("m.facebook.com", "facebook")
+
+
+def test_build_match_looks_up_the_risk_of_the_stored_platform():
+    match = build_match(0.912345, "https://twitter.com/a", "a.jpg", "twitter")
+    score, level, description = PLATFORM_RISKS["twitter"]
+    assert match["similarity"] == 0.9123
+    assert match["vulnerability"] == {"score": score, "level": level, "description": description}
+
+    unknown = build_match(0.8, None, "b.jpg", None)
+    assert unknown["platform"] == UNKNOWN_PLATFORM and unknown["source_url"] == "Unknown Source"
+    assert unknown["vulnerability"]["score"] == DEFAULT_RISK[0]
+
+
+def test_backfill_parses_rows_ingested_without_a_platform(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany("INSERT INTO images (file_path, source_url, hash) VALUES (?, ?, ?)",
+                         [("a.jpg", "https://www.reddit.com/r/pics", "a"), ("b.jpg", None, "b")])
+    assert backfill_sources(conn) == 2
+    assert backfill_sources(conn) == 0
+    rows = conn.execute("SELECT host, platform FROM images ORDER BY id").fetchall()
+    conn.close()
+    assert rows == [("www.reddit.com", "reddit"), (None, UNKNOWN_PLATFORM)]
@@ -0,0 +1,178 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import numpy as np
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services import metrics
+from services.db_service import initialize_database
+from services.metadata_service import MetadataStore, StringColumn, CodedColumn
+from services.tombstones import Tombstones, tombstone_images, tombstone_ratio
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def _seed(db_path, rows):
+    """
+    rows: [(file_path, source_url, duplicate_of), ...] inserted in order (ids 1..n).
+    """
+    initialize_database(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        for file_path, source_url, duplicate_of in rows:
+            conn.execute(
+                "INSERT INTO images (file_path, source_url, hash, duplicate_of, platform) VALUES (?, ?, ?, ?, ?)",
+                (file_path, source_url, file_path, duplicate_of, "other" if source_url else "unknown")
+            )
+    conn.close()
+
+
+def test_string_columns_round_trip():
+    values = ["https://example.org/a", None, "", "ünïcode/ß.jpg"]
+    column = StringColumn(values)
+    assert [column[i] for i in range(len(values))] == values
+    coded = CodedColumn(["reddit", None, "twitter", "reddit"])
+    assert [coded[i] for i in range(4)] == ["reddit", None, "twitter", "reddit"]
+
+
+def test_metadata_cache_matches_sql_and_groups_duplicates(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    _seed(db_path, [("a.jpg", "https://a.org/1", None), ("b.jpg", None, None), ("c.jpg", "https://c.org/3", 1)])
+    cached = MetadataStore(db_path, use_cache=True)
+    uncached = MetadataStore(db_path, use_cache=False)
+    expected = {
+        1: [("https://a.org/1", "a.jpg", "other"), ("https://c.org/3", "c.jpg", "other")],
+        2: [(None, "b.jpg", "unknown")]
+    }
+    assert uncached.get_many([1, 2, 3, 42]) == expected
+    assert cached.get_many([1, 2, 3, 42]) == expected
+
+
+def test_metadata_cache_is_never_stale_after_a_commit(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    _seed(db_path, [("a.jpg", "https://a.org/1", None)])
+    store = MetadataStore(db_path, use_cache=True)
+    assert store.get_many([1]) == {1: [("https://a.org/1", "a.jpg", "other")]}
+
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("INSERT INTO images (file_path, source_url, hash, platform) VALUES ('b.jpg', NULL, 'b', 'unknown')")
+        conn.execute("UPDATE images SET deleted_at = 1 WHERE id = 1")
+    conn.close()
+    # Answered from SQL while the cache rebuilds in the background
+    assert store.get_many([1, 2]) == {2: [(None, "b.jpg", "unknown")]}
+    assert _wait_until(lambda: store.cache.get_many([2]) is not None)
+    assert store.get_many([1, 2]) == {2: [(None, "b.jpg", "unknown")]}
+
+
+def test_platform_filter_and_aggregates_run_in_sql(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    initialize_database(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO images (file_path, source_url, hash, duplicate_of, platform) VALUES (?, ?, ?, ?, ?)",
+            [("a", "https://reddit.com/a", "a", None, "reddit"),
+             ("b", "https://twitter.com/b", "b", 1, "twitter"),
+             ("c", "https://reddit.com/c", "c", 1, "reddit"),
+             ("d", "https://example.org/d", "d", None, "other")]
+        )
+    conn.close()
+    store = MetadataStore(db_path, use_cache=True)
+    assert store.get_many([1, 4], platforms=["twitter"]) == {1: [("https://twitter.com/b", "b", "twitter")]}
+    assert store.platform_counts_by_image([1, 4]) == {1: {"reddit": 2, "twitter": 1}, 4: {"other": 1}}
+    assert store.platform_counts([1, 4], platforms=["reddit"]) == {"reddit": 2}
+    assert store.platform_counts() == {"reddit": 2, "twitter": 1, "other": 1}
+
+
+def test_tombstones_take_duplicates_along_and_filter_results(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    _seed(db_path, [("a.jpg", None, None), ("b.jpg", None, None), ("c.jpg", None, 1), ("d.jpg", None, None)])
+    tombstones = Tombstones(db_path, overfetch=8)
+    assert tombstones.extra_k() == 0
+
+    # Deleting an image also deletes the near-duplicates collapsed onto it
+    assert sorted(tombstone_images([1], db_path)) == [1, 3]
+    assert tombstone_images([1], db_path) == []
+    assert tombstones.contains([1, 2, 3, 4, -1, 10 ** 6]).tolist() == [True, False, True, False, False, False]
+    assert tombstones.extra_k() == 2
+
+    distances = np.array([[0.9, 0.8, 0.7]], dtype=np.float32)
+    indices = np.array([[3, 2, -1]], dtype=np.int64)
+    filtered_distances, filtered_indices = tombstones.filter(distances, indices)
+    assert filtered_indices.tolist() == [[-1, 2, -1]]
+    assert filtered_distances[0, 0] == -np.inf and filtered_distances[0, 1] == np.float32(0.8)
+
+
+def test_tombstone_overfetch_is_capped(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    _seed(db_path, [(f"{i}.jpg", None, None) for i in range(10)])
+    tombstones = Tombstones(db_path, overfetch=3)
+    tombstone_images(range(1, 8), db_path)
+    assert tombstones.extra_k() == 3 and tombstones.count == 7
+
+
+def test_tombstone_ratio_only_counts_vectors(tmp_path):
+    db_path = str(tmp_path / "metadata.db")
+    # 1-4 indexed, 5 a near-duplicate of 1, 6 never indexed
+    _seed(db_path, [(f"{i}.jpg", None, 1 if i == 5 else None) for i in range(1, 7)])
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE images SET indexed = 1 WHERE id <= 4")
+    conn.close()
+
+    # Deleting rows without a vector leaves nothing for compaction to remove
+    tombstone_images([6], db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE images SET deleted_at = 1 WHERE id = 5")
+    conn.close()
+    assert tombstone_ratio(db_path) == 0.0
+
+    tombstone_images([2], db_path)
+    assert tombstone_ratio(db_path) == 0.25
+
+
+def test_metrics_render_is_prometheus_text():
+    stages = metrics.histogram("test_stage_seconds", "Test stage latency.", buckets=(0.1, 1.0))
+    lookups = metrics.counter("test_lookups_total", "Test lookups.")
+    metrics.gauge("test_ratio", "Test ratio.", lambda: 0.25)
+    stages.observe("embed", 0.05)
+    stages.observe("embed", 5.0)
+    lookups.inc("hit", 3)
+
+    sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[a-zA-Z_]\w*="[^"]*"(,[a-zA-Z_]\w*="[^"]*")*\})? (\S+)$')
+    types = {}
+    samples = {}
+    for line in metrics.render().splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            types[name] = kind
+        elif not line.startswith("# HELP "):
+            match = sample.match(line)
+            assert match, line
+            samples[match.group(1) + (match.group(2) or "")] = float(match.group(4))
+
+    assert types["test_stage_seconds"] == "histogram"
+    assert types["test_lookups_total"] == "counter"
+    assert types["test_ratio"] == "gauge"
+    assert samples['test_stage_seconds_bucket{stage="embed",le="0.1"}'] == 1
+    assert samples['test_stage_seconds_bucket{stage="embed",le="1.0"}'] == 1
+    assert samples['test_stage_seconds_bucket{stage="embed",le="+Inf"}'] == 2
+    assert samples['test_stage_seconds_count{stage="embed"}'] == 2
+    assert samples['test_stage_seconds_sum{stage="embed"}'] == 5.05
+    assert samples['test_lookups_total{result="hit"}'] == 3
+    assert samples["test_ratio"] == 0.25
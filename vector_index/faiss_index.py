@@ -0,0 +1,972 @@
+import os
+import sys
+import sqlite3
+import time
+import queue
+import threading
+import faiss
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import (
+    DB_PATH, FAISS_INDEX_PATH, INDEX_CHUNK_SIZE, INDEX_CHECKPOINT_GROWTH,
+    INDEX_NPROBE, INDEX_EF_SEARCH, INDEX_TRAIN_SAMPLE,
+    INDEX_NUM_SHARDS, SHARD_DIR, INDEX_QUEUE_SIZE, EMBED_BATCH_SIZE, EMBED_WORKERS,
+    INDEX_RERANK_FACTOR, TOMBSTONE_RETIRE_SECONDS
+)
+from vector_index.load_index import write_index_atomic, MmapFlatIndex
+from services.metrics import INDEXING_STAGE_SECONDS
+from ingestion.deduplicate import collapse_near_duplicates
+from services.db_service import ensure_schema
+from embedding.embedding_store import EmbeddingStore, open_store
+
+# Supported index types. All of them use inner product on L2-normalized vectors
+# and sit behind the same IndexIDMap, so search results are always SQLite IDs.
+# sq_fp16 / sq8 / pq are exhaustive like flat but store each vector compressed
+# (2, 1 and 1/8 bytes per dimension instead of 4).
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq", "sq_fp16", "sq8", "pq")
+
+# Index types whose stored vectors are lossy; searches over them are re-ranked exactly
+COMPRESSED_TYPES = ("sq_fp16", "sq8", "pq", "ivf_pq")
+
+
+def choose_index_type(ntotal):
+    """
+    Picks an index type from the corpus size: exact search while it is cheap,
+    HNSW for mid-sized corpora, IVF once HNSW's graph gets too large to hold,
+    and IVF-PQ when even raw float32 vectors no longer fit comfortably in RAM.
+    """
+    if ntotal < 50_000:
+        return "flat"
+    if ntotal < 1_000_000:
+        return "hnsw"
+    if ntotal < 10_000_000:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+def _ivf_nlist(ntotal):
+    # ~4*sqrt(n) lists, with at least 39 training points per centroid
+    return int(max(1, min(4 * np.sqrt(max(ntotal, 1)), ntotal // 39)))
+
+
+def _pq_code(dim, ntotal):
+    # 8 dims per sub-quantizer; fewer bits per code when there is too little data to train 256 centroids
+    m = max(1, dim // 8)
+    while dim % m != 0:
+        m -= 1
+    nbits = int(min(8, max(1, np.log2(max(ntotal // 39, 2)))))
+    return f"PQ{m}x{nbits}"
+
+
+def _factory_string(dim, index_type, ntotal):
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "ivf_flat":
+        return f"IVF{_ivf_nlist(ntotal)},Flat"
+    if index_type == "hnsw":
+        return "HNSW32"
+    if index_type == "ivf_pq":
+        return f"IVF{_ivf_nlist(ntotal)},{_pq_code(dim, ntotal)}"
+    if index_type == "sq_fp16":
+        return "SQfp16"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "pq":
+        return _pq_code(dim, ntotal)
+    raise ValueError(f"Unknown index type '{index_type}'. Expected one of {INDEX_TYPES} or 'auto'")
+
+
+def create_index(dim, index_type="flat", ntotal=0):
+    """
+    Creates an empty ID-mapped index. IndexFlatIP-style inner product is used because our
+    OpenCLIP embeddings are L2 normalized, so Inner Product (IP) is equivalent to Cosine
+    Similarity, and IndexIDMap lets us map SQLite IDs directly to FAISS vectors.
+    `ntotal` is the expected corpus size, used to size IVF lists and PQ codes.
+    """
+    if index_type == "auto":
+        index_type = choose_index_type(ntotal)
+    base_index = faiss.index_factory(dim, _factory_string(dim, index_type, ntotal), faiss.METRIC_INNER_PRODUCT)
+    if index_type == "hnsw":
+        faiss.downcast_index(base_index).hnsw.efConstruction = 80
+    return faiss.IndexIDMap(base_index)
+
+
+def train_index(faiss_index, vectors, sample_size=INDEX_TRAIN_SAMPLE):
+    """
+    Trains an untrained index (IVF / PQ) on a random sample of existing embeddings.
+    """
+    if faiss_index.is_trained:
+        return
+    if len(vectors) > sample_size:
+        rng = np.random.default_rng(0)
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    print(f"Training index on {len(vectors)} sample vectors...")
+    faiss_index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+
+
+def index_type_of(faiss_index):
+    """
+    Returns the INDEX_TYPES name of an ID-mapped index.
+    """
+    if isinstance(faiss_index, MmapFlatIndex):
+        return "flat"
+    base_index = faiss.downcast_index(faiss_index.index)
+    if isinstance(base_index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base_index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(base_index, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(base_index, faiss.IndexScalarQuantizer):
+        return "sq_fp16" if base_index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    if isinstance(base_index, faiss.IndexPQ):
+        return "pq"
+    return "flat"
+
+
+def is_compressed(faiss_index):
+    """
+    True when the index only holds lossy codes, so its scores are approximate.
+    """
+    return index_type_of(faiss_index) in COMPRESSED_TYPES
+
+
+def bytes_per_vector(faiss_index):
+    """
+    Serialized size of the index (codes, ids, quantizer tables, graph links) per stored vector,
+    i.e. roughly what one vector costs in RAM once the index is loaded.
+    """
+    if faiss_index.ntotal == 0:
+        return None
+    return faiss.serialize_index(faiss_index).nbytes / faiss_index.ntotal
+
+
+def search_index(faiss_index, queries, k, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH):
+    """
+    Searches an ID-mapped index with per-query tuning of nprobe (IVF) or efSearch (HNSW).
+
+    The knobs are passed as SearchParameters rather than set on the shared index, so
+    concurrent searches with different settings do not interfere. IndexIDMap in our FAISS
+    version rejects SearchParameters, so the base index is searched directly and its
+    positions are mapped to SQLite IDs through a zero-copy view of id_map.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if isinstance(faiss_index, MmapFlatIndex):
+        return faiss_index.search(queries, k)
+    base_index = faiss.downcast_index(faiss_index.index)
+
+    if isinstance(base_index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(nprobe=min(nprobe, base_index.nlist))
+    elif isinstance(base_index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(efSearch=max(ef_search, k))
+    else:
+        return faiss_index.search(queries, k)
+
+    distances, positions = base_index.search(queries, k, params=params)
+    id_array = faiss.rev_swig_ptr(faiss_index.id_map.data(), faiss_index.id_map.size())
+    indices = np.where(positions >= 0, id_array[np.maximum(positions, 0)], -1)
+    return distances, indices
+
+
+def rerank_exact(queries, indices, approx_distances, fetch_vectors, k):
+    """
+    Re-scores candidate ids with exact inner products against their full-precision vectors
+    and keeps the best `k` per query.
+
+    `fetch_vectors(ids)` returns (vectors, found) aligned with a 1-D id array. Candidates
+    without a stored vector keep their approximate score. Returns (distances, indices)
+    shaped like a FAISS search with `k` columns.
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    unique_ids, inverse = np.unique(indices, return_inverse=True)
+    inverse = inverse.reshape(indices.shape)
+    vectors, found = fetch_vectors(unique_ids)
+
+    # (num_queries, candidates) exact scores: each query against its own candidates
+    exact = np.einsum("qd,qcd->qc", queries, np.asarray(vectors, dtype=np.float32)[inverse])
+    distances = np.where(found[inverse], exact, approx_distances).astype(np.float32)
+    distances = np.where(indices >= 0, distances, -np.inf)
+
+    order = np.argsort(-distances, axis=1, kind="stable")[:, :k]
+    return (np.take_along_axis(distances, order, axis=1),
+            np.take_along_axis(indices, order, axis=1))
+
+
+def load_or_create_index(dim, index_path=FAISS_INDEX_PATH):
+    """
+    Loads the index checkpoint at `index_path`, or creates an empty one.
+    """
+    if os.path.exists(index_path):
+        print(f"Loading existing FAISS index from {index_path}...")
+        faiss_index = faiss.read_index(index_path)
+        if faiss_index.d != dim:
+            raise ValueError(f"Embedding dimension ({dim}) != FAISS dimension ({faiss_index.d})")
+        return faiss_index
+
+    print(f"Creating new FAISS index (Dimension: {dim})...")
+    return create_index(dim)
+
+
+def shard_paths(num_shards=INDEX_NUM_SHARDS, index_path=FAISS_INDEX_PATH, shard_dir=SHARD_DIR):
+    """
+    Index files for a layout: the single faiss.index when unsharded, otherwise one file
+    per shard. Image ids are partitioned by `id % num_shards`.
+    """
+    if num_shards <= 1:
+        return [index_path]
+    return [os.path.join(shard_dir, f"shard-{i}-of-{num_shards}.index") for i in range(num_shards)]
+
+
+def get_index_ids(faiss_index):
+    """
+    Returns the SQLite IDs stored in an ID-mapped index as an int64 array.
+    """
+    return faiss.vector_to_array(faiss_index.id_map).astype(np.int64)
+
+
+def _mark_indexed(conn, image_ids):
+    """
+    Flips indexed = 1 for a whole chunk in a single transaction.
+    """
+    with conn:
+        conn.executemany("UPDATE images SET indexed = 1 WHERE id = ?",
+                         [(int(image_id),) for image_id in image_ids])
+
+
+def _reconcile(conn, faiss_indexes):
+    """
+    Recovers from a crash between an index checkpoint and the matching DB commit:
+    rows still flagged indexed = 0 whose vectors are already in a checkpoint are
+    marked indexed instead of being embedded and added a second time.
+    """
+    if sum(faiss_index.ntotal for faiss_index in faiss_indexes) == 0:
+        return 0
+    unindexed_ids = np.array([row[0] for row in conn.execute("SELECT id FROM images WHERE indexed = 0")],
+                             dtype=np.int64)
+    present_ids = np.concatenate([get_index_ids(faiss_index) for faiss_index in faiss_indexes])
+    already_added = unindexed_ids[np.isin(unindexed_ids, present_ids)]
+    if len(already_added) > 0:
+        _mark_indexed(conn, already_added)
+    return len(already_added)
+
+
+def _reset_without_index(conn, index_paths):
+    """
+    The index files are not tracked in git, so a fresh checkout (or a deleted index) has
+    rows flagged indexed = 1 with no index behind them. When none of the files exist, those
+    flags are cleared so the run rebuilds the index (from the embedding store where it can).
+    """
+    if any(os.path.exists(path) for path in index_paths):
+        return 0
+    with conn:
+        return conn.execute("UPDATE images SET indexed = 0 WHERE indexed = 1").rowcount
+
+
+class IndexingInProgressError(RuntimeError):
+    """
+    Raised when another process or job already holds the indexing lock.
+    """
+    pass
+
+
+def _lock_file(lock_file):
+    if os.name == "nt":
+        import msvcrt
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+@contextmanager
+def indexing_lock(index_path=FAISS_INDEX_PATH):
+    """
+    Exclusive OS-level lock on `<index_path>.lock` for the duration of a run that writes the
+    index, so two pipelines (API jobs, CLI, rebuilds) can never interleave checkpoints.
+    The OS drops the lock if the holder dies, so a crash never leaves it stale.
+    """
+    path = f"{index_path}.lock"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    lock_file = open(path, "a+")
+    try:
+        try:
+            _lock_file(lock_file)
+        except OSError:
+            raise IndexingInProgressError(f"Another indexing run holds {path}")
+        yield
+    finally:
+        # Closing the file releases the lock
+        lock_file.close()
+
+
+class _Chunk:
+    """
+    One page of unindexed rows travelling through the pipeline stages.
+    """
+    def __init__(self, ids, paths, hashes, embeddings, ok):
+        self.ids = ids
+        self.paths = paths
+        self.hashes = hashes
+        self.embeddings = embeddings
+        self.ok = ok
+        self.missing = np.flatnonzero(~ok)
+
+
+_DONE = object()
+
+
+def _put(target_queue, item, abort):
+    """
+    Bounded put that gives up if another stage has failed.
+    """
+    while not abort.is_set():
+        try:
+            target_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(source_queue, abort):
+    """
+    Blocking get that returns _DONE if another stage has failed.
+    """
+    while not abort.is_set():
+        try:
+            return source_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+def run_incremental_indexing(generator=None, chunk_size=INDEX_CHUNK_SIZE,
+                             db_path=DB_PATH, index_path=FAISS_INDEX_PATH, num_shards=INDEX_NUM_SHARDS,
+                             cancel_event=None, progress=None, checkpoint_growth=INDEX_CHECKPOINT_GROWTH):
+    """
+    Crash-safe incremental indexing of every image with indexed = 0.
+
+    Rows are processed in id order, `chunk_size` at a time. For each chunk the images are
+    embedded in batches, their vectors are appended to the embedding store and added to
+    the index in bulk. The index is checkpointed (written atomically, temp file + rename)
+    once it has grown by `checkpoint_growth` of its size at the previous checkpoint, and
+    at the end of the run; only then are the covered rows flagged indexed with one
+    executemany transaction. Writing the whole index after every chunk would cost
+    O(N^2 / chunk_size) bytes per run; growing the interval with the index keeps it O(N).
+    A restarted run resumes after the last checkpoint, and the vectors of any chunks
+    added since are read back from the embedding store instead of being embedded again.
+    Rows whose file is missing or unreadable stay indexed = 0, and near-duplicates
+    (duplicate_of set) are skipped.
+    With `num_shards` > 1 each chunk is split by `id % num_shards` and every shard file
+    that received vectors since the last checkpoint is written on its own.
+
+    The work runs as four overlapping stages connected by bounded queues, so reading and
+    decoding the next batch, running CLIP, adding to the index and committing to SQLite
+    all proceed at the same time:
+
+        read/decode (thread pool) -> embed -> index add + checkpoint -> DB commit
+
+    The whole run holds indexing_lock(index_path). Setting `cancel_event` stops it after
+    the chunks already in flight are committed; `progress(summary)` is called after every
+    commit.
+
+    Returns a summary dict with indexed / failed counts and the final index size.
+    """
+    summary = {"indexed": 0, "failed": 0, "recovered": 0, "reused": 0, "ntotal": 0,
+               "pending": 0, "cancelled": False}
+
+    if not os.path.exists(db_path):
+        print(f"Database not found at {db_path}. Run init_db.py and seed_db.py first.")
+        return summary
+
+    with indexing_lock(index_path):
+        conn = sqlite3.connect(db_path)
+        store = None
+        try:
+            # Near-duplicates of already known images are never embedded
+            collapse_near_duplicates(conn)
+            index_paths = shard_paths(num_shards, index_path)
+            reset = _reset_without_index(conn, index_paths)
+            if reset:
+                print(f"No index at {index_path}; {reset} images will be indexed again.")
+
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM images WHERE indexed = 0 AND duplicate_of IS NULL AND deleted_at IS NULL"
+            ).fetchone()[0]
+            summary["pending"] = pending
+            if pending == 0:
+                print("No new images to index. Database is fully synced.")
+                return summary
+
+            print(f"Found {pending} new images to index.")
+
+            if generator is None:
+                from embedding.clip_model import get_generator
+                generator = get_generator()
+
+            faiss_indexes = [load_or_create_index(generator.embedding_dim, path) for path in index_paths]
+            store = EmbeddingStore(generator.model_key, generator.embedding_dim, writer=True)
+
+            summary["recovered"] = _reconcile(conn, faiss_indexes)
+            if summary["recovered"]:
+                print(f"Recovered {summary['recovered']} images already present in the last checkpoint.")
+            if progress:
+                progress(dict(summary))
+
+            _run_stages(generator, store, faiss_indexes, index_paths, chunk_size, db_path,
+                        summary, cancel_event, progress, checkpoint_growth)
+
+            summary["ntotal"] = sum(faiss_index.ntotal for faiss_index in faiss_indexes)
+            return summary
+        finally:
+            if store is not None:
+                store.close()
+            conn.close()
+
+
+def _run_stages(generator, store, faiss_indexes, index_paths, chunk_size, db_path,
+                summary, cancel_event, progress, checkpoint_growth):
+    """
+    Runs the staged pipeline for run_incremental_indexing. The index stage runs on the
+    calling thread; read/decode, embed and commit each get their own thread (SQLite
+    connections are opened per thread).
+    """
+    abort = threading.Event()
+    errors = []
+    # Counters in `summary` are updated from several stages
+    summary_lock = threading.Lock()
+    embed_queue = queue.Queue(maxsize=INDEX_QUEUE_SIZE)
+    index_queue = queue.Queue(maxsize=INDEX_QUEUE_SIZE)
+    commit_queue = queue.Queue(maxsize=INDEX_QUEUE_SIZE)
+
+    def stage(fn, *args):
+        def run():
+            try:
+                fn(*args)
+            except Exception as e:
+                errors.append(e)
+                abort.set()
+        return threading.Thread(target=run, name=f"indexing-{fn.__name__.strip('_')}", daemon=True)
+
+    # 1. Read + decode: page through unindexed rows, reuse stored vectors, decode the rest
+    def _read_decode():
+        read_conn = sqlite3.connect(db_path)
+        try:
+            with ThreadPoolExecutor(max_workers=EMBED_WORKERS, thread_name_prefix="indexing-decode") as pool:
+                last_id = 0
+                while not abort.is_set():
+                    if cancel_event is not None and cancel_event.is_set():
+                        summary["cancelled"] = True
+                        break
+                    rows = read_conn.execute(
+                        "SELECT id, file_path, hash FROM images WHERE indexed = 0 AND duplicate_of IS NULL "
+                        "AND deleted_at IS NULL AND id > ? ORDER BY id LIMIT ?",
+                        (last_id, chunk_size)
+                    ).fetchall()
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+
+                    present_images = []
+                    for image_id, file_path, file_hash in rows:
+                        if not os.path.exists(file_path):
+                            print(f"Warning: Image file not found: {file_path}")
+                            with summary_lock:
+                                summary["failed"] += 1
+                            continue
+                        present_images.append((image_id, file_path, file_hash))
+                    if not present_images:
+                        continue
+
+                    # Reuse stored vectors; only images never embedded by this model go through CLIP
+                    hashes = [file_hash for _, _, file_hash in present_images]
+                    embeddings, ok = store.get_many(hashes)
+                    chunk = _Chunk(np.array([image_id for image_id, _, _ in present_images], dtype=np.int64),
+                                   [file_path for _, file_path, _ in present_images], hashes, embeddings, ok)
+                    with summary_lock:
+                        summary["reused"] += len(present_images) - len(chunk.missing)
+
+                    for start in range(0, len(chunk.missing), EMBED_BATCH_SIZE):
+                        positions = chunk.missing[start:start + EMBED_BATCH_SIZE]
+                        with INDEXING_STAGE_SECONDS.time("decode"):
+                            batch_tensor, valid = generator.preprocess_batch(
+                                [chunk.paths[i] for i in positions], pool
+                            )
+                        if batch_tensor is not None and not _put(embed_queue, (chunk, positions[valid], batch_tensor), abort):
+                            return
+                    # Chunk marker: every batch of this chunk is ahead of it in the queue
+                    if not _put(embed_queue, (chunk, None, None), abort):
+                        return
+        finally:
+            read_conn.close()
+            _put(embed_queue, _DONE, abort)
+
+    # 2. Embed: one forward pass per batch
+    def _embed():
+        while True:
+            item = _get(embed_queue, abort)
+            if item is _DONE:
+                _put(index_queue, _DONE, abort)
+                return
+            chunk, positions, batch_tensor = item
+            if positions is None:
+                if not _put(index_queue, chunk, abort):
+                    return
+                continue
+            with INDEXING_STAGE_SECONDS.time("embed"):
+                chunk.embeddings[positions] = generator.encode_tensors(batch_tensor)
+            chunk.ok[positions] = True
+
+    # 4. Commit: flip the DB flags once the chunk's checkpoint is on disk
+    def _commit():
+        commit_conn = sqlite3.connect(db_path)
+        t0 = time.time()
+        try:
+            while True:
+                chunk_ids = _get(commit_queue, abort)
+                if chunk_ids is _DONE:
+                    return
+                with INDEXING_STAGE_SECONDS.time("commit"):
+                    _mark_indexed(commit_conn, chunk_ids)
+                with summary_lock:
+                    summary["indexed"] += len(chunk_ids)
+                    snapshot = dict(summary)
+                elapsed = time.time() - t0
+                print(f"Indexed {summary['indexed']}/{summary['pending']} images "
+                      f"({summary['indexed'] / max(elapsed, 1e-9):.1f} images/sec)")
+                if progress:
+                    progress(snapshot)
+        finally:
+            commit_conn.close()
+
+    threads = [stage(_read_decode), stage(_embed), stage(_commit)]
+    for thread in threads:
+        thread.start()
+
+    # 3. Index add + checkpoint, on this thread (FAISS indexes are not shared with other stages)
+    uncommitted = []
+    dirty = set()
+    checkpointed = sum(faiss_index.ntotal for faiss_index in faiss_indexes)
+
+    def checkpoint():
+        for shard in sorted(dirty):
+            with INDEXING_STAGE_SECONDS.time("commit"):
+                write_index_atomic(faiss_indexes[shard], index_paths[shard])
+        dirty.clear()
+        chunk_ids = np.concatenate(uncommitted)
+        uncommitted.clear()
+        return _put(commit_queue, chunk_ids, abort)
+
+    try:
+        while True:
+            chunk = _get(index_queue, abort)
+            if chunk is _DONE:
+                if uncommitted and not abort.is_set():
+                    checkpoint()
+                break
+            new = chunk.missing[chunk.ok[chunk.missing]]
+            if len(new):
+                store.put_many([chunk.hashes[i] for i in new], chunk.embeddings[new])
+            with summary_lock:
+                summary["failed"] += int((~chunk.ok).sum())
+            if not chunk.ok.any():
+                continue
+
+            # 1. Add the chunk in bulk (per shard), 2. checkpoint once the index grew enough, 3. flip the flags
+            chunk_ids = chunk.ids[chunk.ok]
+            chunk_vectors = chunk.embeddings[chunk.ok]
+            for shard, faiss_index in enumerate(faiss_indexes):
+                in_shard = (chunk_ids % len(faiss_indexes)) == shard
+                if not in_shard.any():
+                    continue
+                with INDEXING_STAGE_SECONDS.time("add"):
+                    faiss_index.add_with_ids(np.ascontiguousarray(chunk_vectors[in_shard]), chunk_ids[in_shard])
+                dirty.add(shard)
+            uncommitted.append(chunk_ids)
+
+            ntotal = sum(faiss_index.ntotal for faiss_index in faiss_indexes)
+            if ntotal - checkpointed >= max(chunk_size, checkpoint_growth * checkpointed):
+                checkpointed = ntotal
+                if not checkpoint():
+                    break
+    except Exception as e:
+        errors.append(e)
+        abort.set()
+    finally:
+        _put(commit_queue, _DONE, abort)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def extract_vectors(faiss_index):
+    """
+    Returns (vectors, ids) for every vector stored in an ID-mapped index.
+    Exact for flat and HNSW indexes; compressed indexes (COMPRESSED_TYPES) only hold approximate codes.
+    """
+    ids = get_index_ids(faiss_index)
+    base_index = faiss.downcast_index(faiss_index.index)
+    if isinstance(base_index, faiss.IndexIVF):
+        base_index.make_direct_map()
+    vectors = base_index.reconstruct_n(0, faiss_index.ntotal) if faiss_index.ntotal else \
+        np.zeros((0, faiss_index.d), dtype=np.float32)
+    return np.ascontiguousarray(vectors, dtype=np.float32), ids
+
+
+def build_index(vectors, ids, index_type="auto"):
+    """
+    Builds, trains and fills a new ID-mapped index of the requested type.
+    """
+    if index_type == "auto":
+        index_type = choose_index_type(len(vectors))
+    print(f"Building '{index_type}' index over {len(vectors)} vectors...")
+    faiss_index = create_index(vectors.shape[1], index_type, len(vectors))
+    train_index(faiss_index, vectors)
+    if len(vectors):
+        faiss_index.add_with_ids(vectors, np.ascontiguousarray(ids, dtype=np.int64))
+    return faiss_index
+
+
+def _decision_stats(exact_d, exact_i, approx_d, approx_i, query_ids, k, threshold):
+    """
+    Compares approximate results with exact ones, ignoring each query's own id:
+    (recall@k, recall@k of matches at or above `threshold`, FOUND/SAFE decision agreement).
+    """
+    hits = total = hits_thr = total_thr = agree = 0
+    for q in range(len(query_ids)):
+        exact = [(d, i) for d, i in zip(exact_d[q], exact_i[q]) if i != query_ids[q] and i >= 0][:k]
+        approx = [(d, i) for d, i in zip(approx_d[q], approx_i[q]) if i != query_ids[q] and i >= 0][:k]
+        exact_ids = {i for _, i in exact}
+        exact_thr = {i for d, i in exact if d >= threshold}
+        approx_thr = {i for d, i in approx if d >= threshold}
+
+        hits += len(exact_ids & {i for _, i in approx})
+        total += len(exact_ids)
+        hits_thr += len(exact_thr & approx_thr)
+        total_thr += len(exact_thr)
+        agree += int(bool(exact_thr) == bool(approx_thr))
+
+    return (hits / total if total else 1.0,
+            hits_thr / total_thr if total_thr else 1.0,
+            agree / max(len(query_ids), 1))
+
+
+def evaluate_recall(candidate_index, vectors, ids, k=5, threshold=0.78, num_queries=1000,
+                    nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH, rerank_factor=INDEX_RERANK_FACTOR):
+    """
+    Measures an approximate index against exact flat search over the same stored vectors.
+
+    A sample of stored vectors is used as queries; each query's own id is dropped from both
+    result lists so it measures neighbours rather than self-matches. Reports plain recall@k,
+    recall@k restricted to matches at or above `threshold` (what decides FOUND/SAFE),
+    FOUND/SAFE decision agreement, per-query latency of both indexes and bytes per vector.
+    For compressed indexes the same figures are reported again after an exact re-rank of
+    the top k * `rerank_factor` candidates against `vectors`.
+    """
+    exact_index = build_index(vectors, ids, "flat")
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+    queries = vectors[sample]
+    query_ids = ids[sample]
+
+    t0 = time.time()
+    exact_d, exact_i = exact_index.search(queries, k + 1)
+    t_exact = time.time() - t0
+    t0 = time.time()
+    approx_d, approx_i = search_index(candidate_index, queries, k + 1, nprobe=nprobe, ef_search=ef_search)
+    t_approx = time.time() - t0
+
+    recall, recall_thr, agreement = _decision_stats(exact_d, exact_i, approx_d, approx_i, query_ids, k, threshold)
+    n = max(len(queries), 1)
+    report = {
+        "index_type": index_type_of(candidate_index),
+        "ntotal": int(candidate_index.ntotal),
+        "queries": len(queries),
+        f"recall@{k}": recall,
+        f"recall@{k}_at_threshold": recall_thr,
+        "threshold": threshold,
+        "decision_agreement": agreement,
+        "exact_ms_per_query": 1000 * t_exact / n,
+        "approx_ms_per_query": 1000 * t_approx / n,
+        "bytes_per_vector": bytes_per_vector(candidate_index),
+        "flat_bytes_per_vector": bytes_per_vector(exact_index)
+    }
+
+    if is_compressed(candidate_index) and rerank_factor > 0:
+        order = np.argsort(ids)
+        sorted_ids = ids[order]
+
+        def fetch_vectors(candidate_ids):
+            positions = np.minimum(np.searchsorted(sorted_ids, candidate_ids), len(sorted_ids) - 1)
+            found = sorted_ids[positions] == candidate_ids
+            return vectors[order[positions]], found
+
+        fetch_k = min((k + 1) * rerank_factor, candidate_index.ntotal)
+        t0 = time.time()
+        candidate_d, candidate_i = search_index(candidate_index, queries, fetch_k, nprobe=nprobe, ef_search=ef_search)
+        rerank_d, rerank_i = rerank_exact(queries, candidate_i, candidate_d, fetch_vectors, k + 1)
+        t_rerank = time.time() - t0
+
+        recall, recall_thr, agreement = _decision_stats(exact_d, exact_i, rerank_d, rerank_i, query_ids, k, threshold)
+        report.update({
+            "rerank_factor": rerank_factor,
+            f"reranked_recall@{k}": recall,
+            f"reranked_recall@{k}_at_threshold": recall_thr,
+            "reranked_decision_agreement": agreement,
+            "reranked_ms_per_query": 1000 * t_rerank / n
+        })
+    return report
+
+
+def compare_storage(index_types=("sq_fp16", "sq8", "pq"), db_path=DB_PATH, num_queries=1000):
+    """
+    Builds each storage type from the embedding store and reports bytes per vector and
+    decision agreement against the flat index, without replacing the index file.
+    """
+    loaded = load_vectors_from_store(db_path)
+    if loaded is None:
+        raise FileNotFoundError("No embedding store for the configured model; run indexing or --backfill-store first")
+    vectors, ids = loaded
+    reports = []
+    for index_type in index_types:
+        candidate_index = build_index(vectors, ids, index_type)
+        reports.append(evaluate_recall(candidate_index, vectors, ids, num_queries=num_queries))
+        del candidate_index
+    return reports
+
+
+def load_vectors_from_store(db_path=DB_PATH, key=None):
+    """
+    Returns (vectors, ids) for every canonical image whose embedding is in the store,
+    gathered straight from the memory-mapped matrix without running CLIP.
+    Returns None if no store exists for the model.
+    """
+    store = open_store(key)
+    if store is None:
+        return None
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(
+                "SELECT id, hash FROM images WHERE duplicate_of IS NULL AND hash IS NOT NULL "
+                "AND deleted_at IS NULL ORDER BY id"
+            ).fetchall()
+        finally:
+            conn.close()
+        ids = np.array([image_id for image_id, _ in rows], dtype=np.int64)
+        positions = store.rows_for([file_hash for _, file_hash in rows])
+        found = positions >= 0
+        vectors = np.ascontiguousarray(store.vectors()[positions[found]], dtype=np.float32)
+        return vectors, ids[found]
+    finally:
+        store.close()
+
+
+def backfill_store_from_index(db_path=DB_PATH, index_path=FAISS_INDEX_PATH, key=None):
+    """
+    Copies the vectors of an existing exact index into the embedding store, so an index
+    built before the store existed never has to be re-embedded. Returns rows added.
+    Holds indexing_lock, so it never appends concurrently with an indexing run.
+    """
+    with indexing_lock(index_path):
+        return _backfill_store(db_path, index_path, key)
+
+
+def _backfill_store(db_path, index_path, key):
+    faiss_index = faiss.read_index(index_path)
+    if is_compressed(faiss_index):
+        raise ValueError(f"'{index_type_of(faiss_index)}' indexes only hold approximate vectors; re-embed instead of backfilling")
+    vectors, ids = extract_vectors(faiss_index)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        hash_by_id = dict(conn.execute("SELECT id, hash FROM images WHERE hash IS NOT NULL"))
+    finally:
+        conn.close()
+    keep = [i for i, image_id in enumerate(ids) if int(image_id) in hash_by_id]
+
+    store = open_store(key, faiss_index.d, writer=True)
+    try:
+        return store.put_many([hash_by_id[int(ids[i])] for i in keep], vectors[keep])
+    finally:
+        store.close()
+
+
+def rebuild_index(index_type="auto", index_path=FAISS_INDEX_PATH, evaluate=True, source="store",
+                  db_path=DB_PATH):
+    """
+    Rebuilds the index file as `index_type` and atomically replaces it. Vectors come from the
+    embedding store (`source="store"`, no CLIP needed, every stored image is included) or
+    from the vectors the current index holds (`source="index"`).
+    Returns the recall report when `evaluate` is set.
+    """
+    with indexing_lock(index_path):
+        if source == "store":
+            loaded = load_vectors_from_store(db_path)
+            if loaded is None:
+                raise FileNotFoundError("No embedding store for the configured model; run indexing or --backfill-store first")
+            vectors, ids = loaded
+        else:
+            vectors, ids = extract_vectors(faiss.read_index(index_path))
+        new_index = build_index(vectors, ids, index_type)
+
+        report = None
+        if evaluate and len(vectors):
+            report = evaluate_recall(new_index, vectors, ids)
+
+        write_index_atomic(new_index, index_path)
+        print(f"Saved '{index_type_of(new_index)}' index with {new_index.ntotal} vectors to {index_path}")
+
+        if source == "store":
+            # Every stored image is in the new index now
+            conn = sqlite3.connect(db_path)
+            try:
+                _mark_indexed(conn, ids)
+            finally:
+                conn.close()
+        return report
+
+
+def rebuild_shards(num_shards=INDEX_NUM_SHARDS, index_type="auto", db_path=DB_PATH):
+    """
+    Builds every shard file independently from the embedding store, each one choosing
+    its index type from its own size when `index_type` is "auto".
+    """
+    with indexing_lock():
+        loaded = load_vectors_from_store(db_path)
+        if loaded is None:
+            raise FileNotFoundError("No embedding store for the configured model; run indexing or --backfill-store first")
+        vectors, ids = loaded
+        for shard, path in enumerate(shard_paths(num_shards)):
+            in_shard = (ids % num_shards) == shard
+            shard_index = build_index(np.ascontiguousarray(vectors[in_shard]), ids[in_shard], index_type)
+            write_index_atomic(shard_index, path)
+            print(f"Saved shard {shard} ({shard_index.ntotal} vectors) to {path}")
+
+        conn = sqlite3.connect(db_path)
+        try:
+            _mark_indexed(conn, ids)
+        finally:
+            conn.close()
+
+
+def _without_ids(faiss_index, dead_ids):
+    """
+    Returns the index without `dead_ids`. remove_ids is one O(n) pass, fine for a batched
+    compaction; HNSW cannot remove, so it is rebuilt from its own (exact) vectors instead.
+    """
+    try:
+        faiss_index.remove_ids(faiss.IDSelectorBatch(dead_ids))
+        return faiss_index
+    except RuntimeError:
+        vectors, ids = extract_vectors(faiss_index)
+        keep = ~np.isin(ids, dead_ids)
+        return build_index(np.ascontiguousarray(vectors[keep]), ids[keep], index_type_of(faiss_index))
+
+
+def compact_index(db_path=DB_PATH, index_path=FAISS_INDEX_PATH, num_shards=INDEX_NUM_SHARDS,
+                  cancel_event=None, progress=None):
+    """
+    Physically removes tombstoned images: their vectors from every index file (each
+    published as a new generation), then their image files and SQLite rows.
+
+    The index goes first, so a crash in between only leaves rows that the next compaction
+    deletes; until then the tombstones keep filtering them out of search results.
+    The deleted ids move to retired_images in the same transaction: readers still serving
+    the previous generation keep excluding them for TOMBSTONE_RETIRE_SECONDS.
+    `cancel_event` and `progress` make it runnable as a background job.
+    """
+    summary = {"tombstoned": 0, "removed_vectors": 0, "deleted_rows": 0, "deleted_files": 0}
+    with indexing_lock(index_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            ensure_schema(conn)
+            rows = conn.execute("SELECT id, file_path FROM images WHERE deleted_at IS NOT NULL").fetchall()
+            summary["tombstoned"] = len(rows)
+            if not rows:
+                return summary
+            dead_ids = np.array([image_id for image_id, _ in rows], dtype=np.int64)
+
+            # 1. Index files
+            for path in shard_paths(num_shards, index_path):
+                if cancel_event is not None and cancel_event.is_set():
+                    # Rows stay tombstoned; the next compaction finishes the job
+                    return summary
+                if not os.path.exists(path):
+                    continue
+                faiss_index = faiss.read_index(path)
+                before = faiss_index.ntotal
+                faiss_index = _without_ids(faiss_index, dead_ids)
+                if faiss_index.ntotal != before:
+                    write_index_atomic(faiss_index, path)
+                    summary["removed_vectors"] += before - faiss_index.ntotal
+                if progress is not None:
+                    progress(dict(summary))
+
+            # 2. Image files, then the rows themselves in one transaction
+            for _, file_path in rows:
+                try:
+                    os.remove(file_path)
+                    summary["deleted_files"] += 1
+                except OSError:
+                    pass
+            now = time.time()
+            with conn:
+                conn.execute("DELETE FROM retired_images WHERE retired_at < ?", (now - TOMBSTONE_RETIRE_SECONDS,))
+                conn.executemany("INSERT OR REPLACE INTO retired_images (id, retired_at) VALUES (?, ?)",
+                                 [(int(image_id), now) for image_id in dead_ids])
+                conn.executemany("DELETE FROM images WHERE id = ?", [(int(image_id),) for image_id in dead_ids])
+            summary["deleted_rows"] = len(dead_ids)
+        finally:
+            conn.close()
+
+    print(f"Compaction removed {summary['removed_vectors']} vectors and {summary['deleted_rows']} rows")
+    if progress is not None:
+        progress(dict(summary))
+    return summary
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Rebuild faiss.index as a different index type")
+    parser.add_argument("--type", default="auto", choices=("auto",) + INDEX_TYPES)
+    parser.add_argument("--source", default="store", choices=("store", "index"),
+                        help="Take vectors from the embedding store or from the current index")
+    parser.add_argument("--backfill-store", action="store_true",
+                        help="Copy the current index's vectors into the embedding store first")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Build this many independent shard files from the embedding store instead")
+    parser.add_argument("--no-evaluate", action="store_true", help="Skip the recall report")
+    parser.add_argument("--compare-storage", action="store_true",
+                        help="Report bytes per vector and decision agreement of sq_fp16 / sq8 / pq against flat, "
+                             "built from the embedding store, without replacing the index")
+    parser.add_argument("--compact", action="store_true",
+                        help="Remove tombstoned (deleted) images from the index files and the database")
+    args = parser.parse_args()
+
+    if args.compact:
+        print(json.dumps(compact_index(), indent=2))
+        sys.exit(0)
+    if args.compare_storage:
+        print(json.dumps(compare_storage(), indent=2))
+        sys.exit(0)
+
+    if args.backfill_store:
+        print(f"Backfilled {backfill_store_from_index()} vectors into the embedding store")
+    if args.shards > 1:
+        rebuild_shards(args.shards, args.type)
+        sys.exit(0)
+    result = rebuild_index(args.type, evaluate=not args.no_evaluate, source=args.source)
+    if result:
+        print(json.dumps(result, indent=2))
@@ -0,0 +1,294 @@
+import os
+import sys
+import struct
+import threading
+import time
+import logging
+import faiss
+import numpy as np
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import FAISS_INDEX_PATH, INDEX_RELOAD_INTERVAL, INDEX_MMAP, INDEX_KEEP_GENERATIONS
+
+logger = logging.getLogger("load_index")
+
+
+def generation_dir(path=FAISS_INDEX_PATH):
+    """
+    Directory holding the published generations of the index at `path`.
+    """
+    return os.path.join(os.path.dirname(path), "generations")
+
+
+def generation_files(path=FAISS_INDEX_PATH):
+    """
+    Returns [(number, file)] of the published generations of `path`, oldest first.
+    Generation files are named generations/<index file name>.<number>.
+    """
+    prefix = f"{os.path.basename(path)}."
+    try:
+        names = os.listdir(generation_dir(path))
+    except FileNotFoundError:
+        return []
+    generations = []
+    for name in names:
+        number = name[len(prefix):]
+        if name.startswith(prefix) and number.isdigit():
+            generations.append((int(number), os.path.join(generation_dir(path), name)))
+    return sorted(generations)
+
+
+def _point_to(path, target):
+    """
+    Atomically re-points `path` at `target`: a new symlink is created under a temporary
+    name and renamed over `path`. Falls back to a hard link where symlinks are unavailable.
+    """
+    tmp_path = f"{path}.link-{os.getpid()}-{threading.get_ident()}"
+    try:
+        try:
+            os.symlink(os.path.relpath(target, os.path.dirname(path)), tmp_path)
+        except (OSError, NotImplementedError):
+            os.link(target, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _remove_old_generations(path, keep=INDEX_KEEP_GENERATIONS):
+    """
+    Deletes all but the newest `keep` generations. Workers still searching an older one keep
+    their mapping: an unlinked file stays readable until its last mapping is closed.
+    """
+    current = os.path.realpath(path)
+    for _, old_path in generation_files(path)[:-max(keep, 1)]:
+        if os.path.realpath(old_path) == current:
+            continue
+        try:
+            os.remove(old_path)
+        except OSError as e:
+            # e.g. Windows refuses to delete a file another process has mapped; retried next publish
+            logger.warning(f"Could not remove old index generation {old_path}: {e}")
+
+
+def write_index_atomic(index, path=FAISS_INDEX_PATH):
+    """
+    Publishes a FAISS index as the next generation of `path`.
+
+    The index is written to a new, never reused file (generations/<name>.<number>, via a
+    temporary name) and `path` is then atomically re-pointed at it. Readers therefore only
+    ever open a complete previous or a complete new generation, and a generation file is
+    never modified once published, so workers can safely keep it memory-mapped.
+    """
+    os.makedirs(generation_dir(path), exist_ok=True)
+    generations = generation_files(path)
+    number = generations[-1][0] + 1 if generations else 1
+    generation_path = os.path.join(generation_dir(path), f"{os.path.basename(path)}.{number:06d}")
+    tmp_path = f"{generation_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, generation_path)
+        _point_to(path, generation_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _remove_old_generations(path)
+
+
+class MmapFlatIndex:
+    """
+    Read-only flat inner-product index searched straight from the memory-mapped index file.
+
+    faiss.read_index copies every vector into private memory (IO_FLAG_MMAP in FAISS 1.7 only
+    maps IVF inverted lists), so each uvicorn worker would hold its own copy. A serialized
+    IndexIDMap(IndexFlatIP) is two fixed-size headers followed by the float32 matrix and the
+    int64 id array, so both arrays are mapped in place with numpy and every worker on the
+    host searches the same page-cache pages.
+    """
+    # fourcc, d, ntotal, two unused int64 fields, is_trained, metric_type
+    _HEADER = struct.Struct("<4siqqq?i")
+
+    def __init__(self, path, d, ntotal, vectors_offset, ids_offset):
+        self.path = path
+        self.d = d
+        self.ntotal = ntotal
+        if ntotal:
+            self.vectors = np.memmap(path, dtype=np.float32, mode="r", offset=vectors_offset, shape=(ntotal, d))
+            self.ids = np.memmap(path, dtype=np.int64, mode="r", offset=ids_offset, shape=(ntotal,))
+        else:
+            self.vectors = np.zeros((0, d), dtype=np.float32)
+            self.ids = np.zeros(0, dtype=np.int64)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Maps `path`, or returns None if it is not an ID-mapped flat inner-product index.
+        The layout is checked against the exact file size before anything is mapped.
+        """
+        header_size = cls._HEADER.size
+        with open(path, "rb") as f:
+            head = f.read(2 * header_size + 8)
+        if len(head) < 2 * header_size + 8:
+            return None
+        outer = cls._HEADER.unpack_from(head, 0)
+        inner = cls._HEADER.unpack_from(head, header_size)
+        if outer[0] != b"IxMp" or inner[0] != b"IxFI" or outer[6] != 0 or inner[6] != 0:
+            return None
+        d, ntotal = inner[1], inner[2]
+        if (outer[1], outer[2]) != (d, ntotal):
+            return None
+        (num_floats,) = struct.unpack_from("<Q", head, 2 * header_size)
+        vectors_offset = 2 * header_size + 8
+        ids_offset = vectors_offset + ntotal * d * 4 + 8
+        if num_floats != ntotal * d or os.path.getsize(path) != ids_offset + ntotal * 8:
+            return None
+        return cls(path, d, ntotal, vectors_offset, ids_offset)
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.ntotal == 0:
+            return (np.full((len(queries), k), -np.inf, dtype=np.float32),
+                    np.full((len(queries), k), -1, dtype=np.int64))
+        distances, positions = faiss.knn(queries, self.vectors, k, faiss.METRIC_INNER_PRODUCT)
+        return distances, np.where(positions >= 0, self.ids[np.maximum(positions, 0)], -1)
+
+
+def read_index_shared(path, mmap=INDEX_MMAP):
+    """
+    Loads an index for serving. With `mmap`, flat indexes are opened as MmapFlatIndex and IVF
+    indexes with their inverted lists memory-mapped by FAISS, so both are shared between
+    worker processes; HNSW and scalar/product-quantized indexes are still read into private
+    memory (FAISS 1.7 cannot map them).
+    """
+    if not mmap:
+        return faiss.read_index(path)
+    flat_index = MmapFlatIndex.open(path)
+    if flat_index is not None:
+        return flat_index
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+
+
+class IndexHolder:
+    """
+    Keeps the FAISS index resident in memory and serves it to any number of reader threads.
+
+    FAISS CPU indexes are safe for concurrent searches, so readers simply take a reference
+    to the current index. When `index_path` points at a new generation (see
+    write_index_atomic), it is loaded in a background thread with read_index_shared and
+    swapped in with a single reference assignment. Searches already running keep using the
+    generation they started with; with memory mapping the switch costs a header read.
+    """
+    def __init__(self, index_path=FAISS_INDEX_PATH, reload_interval=INDEX_RELOAD_INTERVAL):
+        self.index_path = index_path
+        self.reload_interval = reload_interval
+        # (index, generation, file stamp) is replaced as a whole so readers see a consistent triple
+        self._current = (None, 0, None)
+        self._reload_lock = threading.Lock()
+        self._last_check = 0.0
+
+    def _file_stamp(self):
+        """
+        (resolved path, mtime, size, inode) of the generation `index_path` points at.
+        """
+        for _ in range(3):
+            path = os.path.realpath(self.index_path)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                if not os.path.lexists(self.index_path):
+                    return None
+                # Re-pointed and the old generation removed in between; resolve again
+                continue
+            return (path, st.st_mtime_ns, st.st_size, st.st_ino)
+        return None
+
+    def _load(self, stamp):
+        """
+        Reads (or maps) the generation `stamp` refers to and publishes it as the current index.
+        """
+        t0 = time.time()
+        index = read_index_shared(stamp[0])
+        _, generation, _ = self._current
+        self._current = (index, generation + 1, stamp)
+        logger.info(f"Loaded FAISS index generation {generation + 1} "
+                    f"({index.ntotal} vectors) in {time.time() - t0:.4f}s")
+
+    def _background_reload(self, stamp):
+        try:
+            self._load(stamp)
+        except Exception as e:
+            # A failed reload keeps the previous generation serving
+            logger.error(f"Failed to reload FAISS index: {e}")
+        finally:
+            self._reload_lock.release()
+
+    def _check_for_update(self):
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        # Only one thread checks / reloads at a time; everyone else keeps serving
+        if not self._reload_lock.acquire(blocking=False):
+            return
+        self._last_check = now
+        stamp = self._file_stamp()
+        if stamp is None or stamp == self._current[2]:
+            self._reload_lock.release()
+            return
+        threading.Thread(target=self._background_reload, args=(stamp,), daemon=True).start()
+
+    def snapshot(self):
+        """
+        Returns (index, generation) for the current index. The first call loads the index
+        synchronously; raises FileNotFoundError if no index has been built yet.
+        """
+        index, generation, _ = self._current
+        if index is None:
+            with self._reload_lock:
+                if self._current[0] is None:
+                    stamp = self._file_stamp()
+                    if stamp is None:
+                        raise FileNotFoundError(f"faiss.index file does not exist at {self.index_path}")
+                    self._load(stamp)
+                    self._last_check = time.monotonic()
+            index, generation, _ = self._current
+        else:
+            self._check_for_update()
+        return index, generation
+
+    def get(self):
+        """
+        Returns the current in-memory FAISS index.
+        """
+        return self.snapshot()[0]
+
+    @property
+    def generation(self):
+        return self._current[1]
+
+    @property
+    def loaded_stamp(self):
+        """
+        File stamp (resolved path, mtime, size, inode) of the generation currently served,
+        or None before the first load. Unlike `generation` it is comparable across processes.
+        """
+        return self._current[2]
+
+
+_holder = None
+_holder_lock = threading.Lock()
+
+
+def get_index_holder():
+    """
+    Returns the process-wide IndexHolder for FAISS_INDEX_PATH.
+    """
+    global _holder
+    if _holder is None:
+        with _holder_lock:
+            if _holder is None:
+                _holder = IndexHolder()
+    return _holder
@@ -0,0 +1,394 @@
+import os
+import sys
+import atexit
+import threading
+import time
+import itertools
+import logging
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+
+# Add project root to python path
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from services.config import (
+    DB_PATH, INDEX_NUM_SHARDS, INDEX_RELOAD_INTERVAL, INDEX_NPROBE, INDEX_EF_SEARCH, INDEX_RERANK_FACTOR,
+    SHARD_SEARCH_THREADS, ROBUST_FUSION, SEARCH_TOP_K
+)
+from services.metadata_service import connect_readonly, MAX_IN_PARAMS
+from services.tombstones import get_tombstones
+from embedding.embedding_store import open_store
+from vector_index.load_index import IndexHolder, get_index_holder
+from vector_index.faiss_index import search_index, shard_paths, is_compressed, rerank_exact
+
+logger = logging.getLogger("vector_search")
+
+
+def _empty_results(num_queries, k):
+    return (np.full((num_queries, k), -np.inf, dtype=np.float32),
+            np.full((num_queries, k), -1, dtype=np.int64))
+
+
+def _top_k(distances, indices, k):
+    """
+    Best `k` columns per query by score (missing hits carry -inf).
+    """
+    order = np.argsort(-distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def fuse_scores(distances, indices, fusion=ROBUST_FUSION, top_k=SEARCH_TOP_K):
+    """
+    Fuses the (V, k) per-view search results of one image into [(image_id, score), ...],
+    best first, at most `top_k` entries.
+
+    - max:  an image scores as well as its best matching view (crops and flips that only
+            line up with one view still count).
+    - mean: average over all views. An image missing from a view's top k is counted with
+            that view's k-th score, an upper bound of its true score there.
+    """
+    if fusion not in ("max", "mean"):
+        raise ValueError(f"Unknown score fusion '{fusion}'. Expected 'max' or 'mean'")
+    views = []
+    for row_distances, row_indices in zip(distances, indices):
+        views.append({int(image_id): float(score) for image_id, score in zip(row_indices, row_distances)
+                      if image_id >= 0})
+    candidates = set().union(*views)
+    if fusion == "max":
+        scores = {image_id: max(view[image_id] for view in views if image_id in view) for image_id in candidates}
+    else:
+        floors = [min(view.values()) if view else 0.0 for view in views]
+        scores = {image_id: sum(view.get(image_id, floor) for view, floor in zip(views, floors)) / len(views)
+                  for image_id in candidates}
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+class ExactReranker:
+    """
+    Re-ranks candidates from a compressed index (sq_fp16 / sq8 / pq / ivf_pq) with their
+    full-precision vectors: image ids -> images.hash (read-only SQLite) -> rows of the
+    memory-mapped embedding store. Only the top k * INDEX_RERANK_FACTOR candidates are
+    touched, so the float32 vectors stay on disk / in the page cache rather than in the index.
+    """
+    def __init__(self, db_path=DB_PATH, key=None, factor=INDEX_RERANK_FACTOR):
+        self.db_path = db_path
+        self.key = key
+        self.factor = factor
+        self._local = threading.local()
+        self._store = None
+        self._store_lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect_readonly(self.db_path)
+        return conn
+
+    def _get_store(self):
+        if self._store is None:
+            with self._store_lock:
+                if self._store is None:
+                    # None until the indexing pipeline has created the store
+                    self._store = open_store(self.key)
+        return self._store
+
+    def fetch_vectors(self, ids):
+        """
+        Returns (vectors, found) for a 1-D array of image ids.
+        """
+        ids = [int(image_id) for image_id in ids]
+        hash_by_id = {}
+        conn = self._conn()
+        for start in range(0, len(ids), MAX_IN_PARAMS):
+            part = ids[start:start + MAX_IN_PARAMS]
+            placeholders = ",".join("?" * len(part))
+            hash_by_id.update(conn.execute(f"SELECT id, hash FROM images WHERE id IN ({placeholders})", part))
+        return self._get_store().get_many([hash_by_id.get(image_id) for image_id in ids])
+
+    def rerank(self, queries, distances, indices, k):
+        """
+        Exact top-k from over-fetched approximate results; falls back to the approximate
+        order when there is no embedding store to re-rank against.
+        """
+        if self._get_store() is None:
+            return _top_k(distances, indices, k)
+        return rerank_exact(queries, indices, distances, self.fetch_vectors, k)
+
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker():
+    """
+    The process-wide ExactReranker, or None when INDEX_RERANK_FACTOR is 0.
+    """
+    global _reranker
+    if INDEX_RERANK_FACTOR <= 0:
+        return None
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = ExactReranker()
+    return _reranker
+
+
+class LocalSearcher:
+    """
+    Searches the single in-process faiss.index through the shared IndexHolder.
+    Compressed indexes are over-fetched and re-ranked exactly when a reranker is configured,
+    and tombstoned (deleted) ids are dropped, over-fetching a little so top-k stays full.
+    """
+    def __init__(self, index_holder=None, reranker=None, tombstones=None):
+        self.index_holder = index_holder or get_index_holder()
+        self.reranker = reranker or get_reranker()
+        self.tombstones = tombstones or get_tombstones()
+
+    def info(self):
+        """
+        Returns (ntotal, dim) of the current index generation.
+        """
+        faiss_index = self.index_holder.get()
+        return faiss_index.ntotal, faiss_index.d
+
+    def generation(self):
+        """
+        Identifies the index generation currently served (changes on every reload).
+        """
+        return self.index_holder.snapshot()[1]
+
+    def search(self, queries, k, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH):
+        faiss_index = self.index_holder.get()
+        rerank = self.reranker is not None and is_compressed(faiss_index)
+        extra_k = self.tombstones.extra_k()
+        if not rerank and extra_k == 0:
+            return search_index(faiss_index, queries, k, nprobe=nprobe, ef_search=ef_search)
+
+        fetch_k = (k * self.reranker.factor if rerank else k) + extra_k
+        distances, indices = search_index(faiss_index, queries, min(fetch_k, faiss_index.ntotal),
+                                          nprobe=nprobe, ef_search=ef_search)
+        distances, indices = self.tombstones.filter(distances, indices)
+        if rerank:
+            return self.reranker.rerank(queries, distances, indices, k)
+        return _top_k(distances, indices, k)
+
+
+def _shard_request(holder, message):
+    """
+    Answers one ("info",), ("generation",) or ("search", queries, k, nprobe, ef_search)
+    request against the shard's current index.
+    """
+    try:
+        faiss_index = holder.get()
+    except FileNotFoundError:
+        faiss_index = None
+
+    if message[0] == "generation":
+        return holder.loaded_stamp
+    if message[0] == "info":
+        return (faiss_index.ntotal, faiss_index.d) if faiss_index is not None else (0, None)
+
+    _, queries, k, nprobe, ef_search = message
+    if faiss_index is None or faiss_index.ntotal == 0:
+        return _empty_results(len(queries), k) + (False,)
+    shard_k = min(k, faiss_index.ntotal)
+    distances, indices = search_index(faiss_index, queries, shard_k, nprobe=nprobe, ef_search=ef_search)
+    return distances, indices, is_compressed(faiss_index)
+
+
+def _shard_worker(index_path, reload_interval, conn, threads=SHARD_SEARCH_THREADS):
+    """
+    Shard process main loop: keeps one shard resident (hot-reloaded like the single index)
+    and answers (request_id, message) requests on a small thread pool, so searches from
+    several coordinator threads run at the same time (FAISS releases the GIL).
+    Replies are (request_id, status, payload) and may come back in any order.
+    Search replies also say whether the shard is compressed, so the coordinator knows to re-rank.
+    """
+    holder = IndexHolder(index_path, reload_interval)
+    send_lock = threading.Lock()
+
+    def answer(request_id, message):
+        try:
+            reply = (request_id, "ok", _shard_request(holder, message))
+        except Exception as e:
+            reply = (request_id, "error", str(e))
+        with send_lock:
+            conn.send(reply)
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="shard-search") as pool:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            pool.submit(answer, *request)
+
+
+class ShardedSearcher:
+    """
+    Scatter-gather search over N shard files, each held by its own local worker process.
+
+    A query matrix is sent to every shard at once, the shards search in parallel, and the
+    coordinator merges the per-shard top-k lists by score into the global top-k. Shards
+    reload their own file when the indexing pipeline checkpoints it. When a reranker is
+    configured every shard returns k * factor candidates and, if any shard is compressed,
+    the merged list is re-ranked exactly in the coordinator. Tombstoned ids are filtered
+    from the merged list, with the same small over-fetch as LocalSearcher.
+    """
+    def __init__(self, num_shards=INDEX_NUM_SHARDS, reload_interval=INDEX_RELOAD_INTERVAL, reranker=None,
+                 tombstones=None):
+        self.paths = shard_paths(num_shards)
+        self.reranker = reranker or get_reranker()
+        self.tombstones = tombstones or get_tombstones()
+        context = multiprocessing.get_context("spawn")
+        self._request_ids = itertools.count()
+        # Per shard: the pipe, a lock for sending on it, and the requests awaiting a reply.
+        # A receiver thread per shard resolves replies by request id, so concurrent
+        # queries never wait for each other's round trip.
+        self._conns = []
+        self._send_locks = []
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._exited = set()
+        self._processes = []
+        self._receivers = []
+        for shard, path in enumerate(self.paths):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_shard_worker, args=(path, reload_interval, child_conn),
+                                      name=f"faiss-{os.path.basename(path)}", daemon=True)
+            process.start()
+            # Only the worker holds the other end, so its exit shows up as EOF in the receiver
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._send_locks.append(threading.Lock())
+            self._pending.append({})
+            self._processes.append(process)
+            receiver = threading.Thread(target=self._receive, args=(shard,),
+                                        name=f"shard-{shard}-receiver", daemon=True)
+            receiver.start()
+            self._receivers.append(receiver)
+        self._info = None
+        self._info_time = 0.0
+        self.reload_interval = reload_interval
+        atexit.register(self.close)
+
+    def _receive(self, shard):
+        """
+        Receiver thread of one shard: hands every reply to the request waiting for it.
+        If the worker goes away, every outstanding request on the shard fails.
+        """
+        conn = self._conns[shard]
+        pending = self._pending[shard]
+        while True:
+            try:
+                request_id, status, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future = pending.pop(request_id, None)
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(payload)
+            else:
+                future.set_exception(RuntimeError(f"Shard search failed: {payload}"))
+        with self._pending_lock:
+            self._exited.add(shard)
+            futures = list(pending.values())
+            pending.clear()
+        for future in futures:
+            future.set_exception(RuntimeError(f"Shard worker {shard} exited"))
+
+    def _scatter(self, message):
+        """
+        Sends one message to every shard and gathers the replies, in shard order.
+        """
+        request_id = next(self._request_ids)
+        futures = []
+        for shard, conn in enumerate(self._conns):
+            future = Future()
+            with self._pending_lock:
+                if shard in self._exited:
+                    raise RuntimeError(f"Shard worker {shard} exited")
+                self._pending[shard][request_id] = future
+            try:
+                with self._send_locks[shard]:
+                    conn.send((request_id, message))
+            except (BrokenPipeError, OSError) as e:
+                with self._pending_lock:
+                    self._pending[shard].pop(request_id, None)
+                raise RuntimeError(f"Shard worker {shard} is unreachable: {e}")
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def info(self):
+        """
+        Returns (ntotal, dim) summed over shards; cached for the reload interval.
+        """
+        now = time.monotonic()
+        if self._info is None or now - self._info_time >= self.reload_interval:
+            shard_info = self._scatter(("info",))
+            dims = [d for _, d in shard_info if d is not None]
+            if not dims:
+                raise FileNotFoundError(f"No shard index files found in {os.path.dirname(self.paths[0])}")
+            self._info = (sum(ntotal for ntotal, _ in shard_info), dims[0])
+            self._info_time = now
+        return self._info
+
+    def generation(self):
+        """
+        Identifies the generations the shard workers are serving right now, as each of them
+        reports it (not the files on disk, which workers pick up only on their next reload),
+        so a result cached under this value was computed from exactly those shards.
+        """
+        return tuple(self._scatter(("generation",)))
+
+    def search(self, queries, k, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        fetch_k = (k * self.reranker.factor if self.reranker is not None else k) + self.tombstones.extra_k()
+        results = self._scatter(("search", queries, fetch_k, nprobe, ef_search))
+
+        # Merge: concatenate every shard's candidates and keep the best scores per query
+        distances = np.concatenate([d for d, _, _ in results], axis=1)
+        indices = np.concatenate([i for _, i, _ in results], axis=1)
+        distances = np.where(indices >= 0, distances, -np.inf)
+        distances, indices = self.tombstones.filter(distances, indices)
+        if self.reranker is not None and any(compressed for _, _, compressed in results):
+            return self.reranker.rerank(queries, distances, indices, k)
+        return _top_k(distances, indices, k)
+
+    def close(self):
+        for conn, send_lock, process in zip(self._conns, self._send_locks, self._processes):
+            if process.is_alive():
+                try:
+                    with send_lock:
+                        conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+        for process in self._processes:
+            process.join(timeout=1)
+        for receiver in self._receivers:
+            receiver.join(timeout=1)
+        for conn in self._conns:
+            conn.close()
+        self._processes = []
+        self._conns = []
+        self._receivers = []
+
+
+_searcher = None
+_searcher_lock = threading.Lock()
+
+
+def get_searcher():
+    """
+    Returns the process-wide searcher: sharded when INDEX_NUM_SHARDS > 1, else the single index.
+    """
+    global _searcher
+    if _searcher is None:
+        with _searcher_lock:
+            if _searcher is None:
+                _searcher = ShardedSearcher() if INDEX_NUM_SHARDS > 1 else LocalSearcher()
+    return _searcher